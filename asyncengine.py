@@ -0,0 +1,280 @@
+"""
+Asyncio execution mode, turned on with ASYNC_ENGINE=1.
+
+Updates are received by a tornado webhook that answers at once and handles each update in an asyncio task, so
+an update waiting on Firestore or Telegram holds no thread. The read-only flows (/start, viewing orders and
+opening an order to view or upgrade) are coroutines: they read through google-cloud-firestore's AsyncClient
+(storage.async_store) and call the Bot API through AsyncTelegramClient, answering the callback query, showing
+"typing..." and reading the user and order documents concurrently with asyncio.gather.
+
+python-telegram-bot 13 has no asyncio support, so every other update (rescheduling, upgrades, payments,
+admin commands) is handed to the bot's usual Dispatcher on a small thread pool. Each chat's updates are
+handled one at a time and in order, whichever path they take.
+"""
+import asyncio
+import concurrent.futures
+import json
+import os
+import time
+
+import tornado.httpclient
+import tornado.web
+from telegram import Update
+from telegram.error import TelegramError
+
+import bot
+import botclient
+import callbackcodec
+import dedupe
+import metrics
+import sendqueue
+import workers
+import storage
+from storage import async_store
+
+# Threads handling the updates that have no coroutine handler
+THREADS = int(os.getenv("ASYNC_THREADS", "8"))
+# Concurrent connections to api.telegram.org
+MAX_CLIENTS = int(os.getenv("ASYNC_TELEGRAM_CONNECTIONS", "100"))
+
+ASYNC_UPDATES = metrics.REGISTRY.counter("ninja_async_updates_total", "Updates handled by the asyncio engine",
+                                         ["path"])
+
+
+class AsyncTelegramClient:
+    """ Bot API calls as coroutines, counted and timed like NinjaBot's and held back by the same send queue."""
+
+    def __init__(self, token, send_queue=None, base_url="https://api.telegram.org/bot"):
+        self.url = base_url + token + "/"
+        self.send_queue = send_queue
+        self.http = tornado.httpclient.AsyncHTTPClient(max_clients=MAX_CLIENTS)
+
+    async def call(self, method, **params):
+        """
+        Call a Bot API method, retrying after 429s.
+        :return: Returns the result field of Telegram's response.
+        """
+        metrics.TELEGRAM_CALLS.inc(method=method)
+        limited = self.send_queue is not None and method not in botclient.UNLIMITED_METHODS
+        for attempt in range(1, botclient.MAX_ATTEMPTS + 1):
+            if limited or attempt > 1:
+                await self._acquire(params.get("chat_id"))
+            response = await self._timed_call(method, params)
+            if response.get("ok"):
+                return response["result"]
+            retry_after = response.get("parameters", {}).get("retry_after")
+            if retry_after is None:
+                metrics.TELEGRAM_ERRORS.inc(method=method, exception="TelegramError")
+                raise TelegramError(response.get("description", "Unknown error"))
+            sendqueue.RATE_LIMITED.inc(method=method)
+            metrics.TELEGRAM_ERRORS.inc(method=method, exception="RetryAfter")
+            if self.send_queue is None or attempt == botclient.MAX_ATTEMPTS:
+                raise TelegramError("Flood control exceeded. Retry in {} seconds".format(retry_after))
+            self.send_queue.pause(retry_after)
+
+    async def _acquire(self, chat_id):
+        start = time.monotonic()
+        delay = self.send_queue.try_acquire(chat_id)
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.send_queue.try_acquire(chat_id)
+        sendqueue.QUEUE_WAIT.observe(time.monotonic() - start,
+                                     priority=sendqueue.PRIORITY_NAMES[sendqueue.INTERACTIVE])
+
+    async def _timed_call(self, method, params):
+        start = time.perf_counter()
+        try:
+            response = await self.http.fetch(self.url + method, method="POST", body=json.dumps(params),
+                                             headers={"Content-Type": "application/json"}, raise_error=False)
+            if response.code >= 500 or response.body is None:
+                raise TelegramError("Bad response from Telegram: {}".format(response.code))
+            return json.loads(response.body)
+        except (OSError, ValueError) as e:
+            metrics.TELEGRAM_ERRORS.inc(method=method, exception=type(e).__name__)
+            raise TelegramError(str(e))
+        finally:
+            metrics.TELEGRAM_LATENCY.observe(time.perf_counter() - start, method=method)
+
+
+class AsyncEngine:
+
+    def __init__(self, client, orders, users, dispatcher, threads=THREADS):
+        """
+        :param AsyncTelegramClient client: Bot API client of the coroutine handlers.
+        :param orders: Order repository with coroutine get and get_many, from storage.async_store.
+        :param users: User repository with a coroutine get.
+        :param dispatcher: The bot's telegram.ext.Dispatcher, for the updates that have no coroutine handler.
+        """
+        self.client = client
+        self.orders = orders
+        self.users = users
+        self.dispatcher = dispatcher
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix="dispatcher")
+        self._chat_locks = {}  # chat -> [asyncio.Lock, number of updates holding or waiting for it]
+        self.callbacks = {
+            callbackcodec.VIEW_ORDERS: lambda query, callback: self.view_orders(query),
+            callbackcodec.UPGRADE_ORDERS: lambda query, callback: self.view_orders(query, show_upgrades=True),
+            callbackcodec.VIEW_ORDER: lambda query, callback: self.get_order(query, callback.order_id),
+            callbackcodec.UPGRADE_ORDER:
+                lambda query, callback: self.get_order(query, callback.order_id, upgrade=True),
+        }
+
+    async def process(self, data):
+        """ Handle one update, after any earlier updates of its chat."""
+        update = Update.de_json(data, self.dispatcher.bot)
+        key = workers.shard_key(update)
+        entry = self._chat_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._handle(update)
+        except Exception as e:
+            print(e)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[key]
+
+    async def _handle(self, update):
+        handler = None
+        if update.callback_query is not None:
+            callback = callbackcodec.decode(update.callback_query.data)
+            if callback is not None and callback.action in self.callbacks:
+                name = callbackcodec.ACTION_NAMES[callback.action]
+                handler = self.callbacks[callback.action](update.callback_query, callback)
+        elif update.message is not None and (update.message.text or "").split("@")[0].split(" ")[0] == "/start":
+            name, handler = "start", self.start(update.message.chat_id)
+
+        if handler is None:
+            # Repeats are dropped by the Dispatcher's dedupe handler
+            ASYNC_UPDATES.inc(path="thread")
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.dispatcher.process_update, update)
+            return
+        kind = dedupe.repeat_kind(update) if dedupe.ENABLED else None
+        if kind is not None:
+            handler.close()
+            if kind == dedupe.CALLBACK:
+                try:
+                    await self.client.call("answerCallbackQuery", callback_query_id=update.callback_query.id)
+                except TelegramError:
+                    pass
+            return
+        ASYNC_UPDATES.inc(path="coroutine")
+        with metrics.track(name):
+            await handler
+
+    async def send(self, chat_id, text, keyboard=None):
+        params = {"chat_id": chat_id, "text": text}
+        if keyboard is not None:
+            params["reply_markup"] = keyboard.to_json()
+        return await self.client.call("sendMessage", **params)
+
+    async def start(self, chat_id):
+        await self.send(chat_id, bot.START_INSTRUCTION, bot.get_update_keyboard())
+
+    async def _answer(self, query):
+        """ Answer the callback query and show "typing..."."""
+        chat_id = query.message.chat.id
+        await asyncio.gather(self.client.call("answerCallbackQuery", callback_query_id=query.id),
+                             self.client.call("sendChatAction", chat_id=chat_id, action="typing"))
+
+    async def _user_orders(self, query):
+        username, chat_id = query.message.chat.username, query.message.chat.id
+        user_dict = await self.users.get(username)
+        orders = user_dict['orders']
+        summaries = user_dict.get('orderSummaries', {})
+        missing = [order_id for order_id in orders if order_id not in summaries]
+        order_dicts = await self.orders.get_many(missing) if missing else {}
+        if order_dicts or user_dict.get('chatId') != chat_id:
+            # Rare writes, done by the bot's synchronous repositories
+            await asyncio.get_running_loop().run_in_executor(self.executor, bot.backfill_user, username, chat_id,
+                                                             user_dict, order_dicts)
+        summaries.update({order_id: storage.order_summary(order_dict)
+                          for order_id, order_dict in order_dicts.items() if order_dict is not None})
+        return orders, summaries
+
+    async def view_orders(self, query, show_upgrades=False):
+        chat_id = query.message.chat.id
+        try:
+            _, (orders, order_dicts) = await asyncio.gather(self._answer(query), self._user_orders(query))
+            summaries = bot.format_order_summaries(orders, order_dicts, show_upgrades=show_upgrades)
+            if show_upgrades:
+                text = summaries + '\nWhich order do you want to upgrade?'
+                action = callbackcodec.UPGRADE_ORDER
+            else:
+                text = bot.VIEW_ORDERS_INSTRUCTION.format(len(orders), summaries)
+                action = callbackcodec.VIEW_ORDER
+            await self.send(chat_id, text, bot.get_orders_keyboard(None, None, orders, action))
+        except Exception as e:
+            print(e)
+            await self.send(chat_id, "Sorry, unable to retrieve orders.")
+
+    async def get_order(self, query, order_id, upgrade=False):
+        chat_id = query.message.chat.id
+        try:
+            _, order_dict = await asyncio.gather(self._answer(query), self.orders.get(order_id))
+            if upgrade:
+                await self.send(chat_id, bot.format_order_details(bot.UPGRADE_DETAILS_TEXT, order_id, order_dict),
+                                bot.get_upgrade_keyboard(order_id))
+            else:
+                await self.send(chat_id, bot.format_order_details(bot.ORDER_DETAILS_TEXT, order_id, order_dict),
+                                bot.get_order_keyboard(order_id))
+        except Exception as e:
+            print(e)
+            await self.send(chat_id, "Sorry, unable to retrieve order.")
+
+    def stop(self):
+        self.executor.shutdown()
+
+
+class AsyncWebhookHandler(tornado.web.RequestHandler):
+
+    def initialize(self, engine):
+        self.engine = engine
+
+    def post(self):
+        data = json.loads(self.request.body.decode())
+        task = asyncio.ensure_future(self.engine.process(data))
+        # The loop only keeps weak references to its tasks
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+
+
+_tasks = set()
+
+
+async def serve(engine, port, url_path, webhook_url):
+    routes = [
+        ("/" + url_path + "/?", AsyncWebhookHandler, {"engine": engine}),
+        ("/metrics", metrics.MetricsHandler),
+    ]
+    if bot.STRIPE_WEBHOOK:
+        from payments import stripePayment
+        routes.append(stripePayment.webhook_route(bot.order_cache, bot.event_log, bot.user_repository,
+                                                  engine.dispatcher.bot))
+    app = tornado.web.Application(routes)
+    app.listen(port, address="0.0.0.0")
+    await engine.client.call("setWebhook", url=webhook_url)
+    await asyncio.Event().wait()
+
+
+def run(port, token, webhook_url):
+    """ Serve the webhook with the asyncio engine until the process is stopped."""
+    dispatcher = bot.make_dispatcher()
+    bot.schedule_reminders(dispatcher.job_queue)
+    dispatcher.job_queue.start()
+    if os.getenv("STORAGE_BACKEND", "firestore") == "firestore":
+        orders, users = async_store.create_async_firestore_repositories()
+        orders = metrics.AsyncInstrumentedRepository(orders, "orders")
+        users = metrics.AsyncInstrumentedRepository(users, "users")
+    else:
+        # Already instrumented
+        orders = async_store.AsyncAdapter(bot.order_repository)
+        users = async_store.AsyncAdapter(bot.user_repository)
+    engine = AsyncEngine(AsyncTelegramClient(token, bot.send_queue), orders, users, dispatcher)
+    try:
+        asyncio.run(serve(engine, port, token, webhook_url))
+    finally:
+        engine.stop()
+        dispatcher.job_queue.stop()
+        bot.event_log.flush()
@@ -0,0 +1,71 @@
+"""
+Benchmarks encoding and decoding of callback_data with callbackcodec, against building and
+routing the string callbacks that query_handler used before.
+
+Usage: python benchmarks/bench_callbackcodec.py [--number N]
+"""
+import argparse
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import callbackcodec
+
+ORDER_ID = "Xq3ZkP0aB7mN2sT9vW4y"
+DATE = datetime.date(2022, 2, 25)
+
+
+def legacy_encode():
+    return 'reschedule-' + ORDER_ID + "-to-" + str(DATE)[:10] + '_12-15'
+
+
+LEGACY_ROUTES = ['reschedule-topup', 'upgrade_orders_action_', "view-order-id-", "reschedule_orders_action",
+                 "reschedule-order-id-", "upgrade-order-id-", "_to_express_tier", "_to_timeslot_tier", "9-12", "12-15"]
+
+
+def legacy_decode(data):
+    # Walks the substring chain the way the old query_handler did, then slices out the fields
+    if data == 'view_orders_action':
+        return None
+    for route in LEGACY_ROUTES:
+        if route in data:
+            return route, data[11:-20], data[-16:-6]
+
+
+def codec_encode():
+    return callbackcodec.encode(callbackcodec.RESCHEDULE_TO_TIME, ORDER_ID, DATE, 12)
+
+
+DISPATCH = {callbackcodec.RESCHEDULE_TO_TIME: lambda callback: (callback.order_id, callback.date, callback.arg)}
+
+
+def codec_decode(data):
+    callback = callbackcodec.decode(data)
+    return DISPATCH[callback.action](callback)
+
+
+def report(name, seconds, number, data=None):
+    size = " ({} bytes)".format(len(data.encode("utf-8"))) if data is not None else ""
+    print("{:<16} {:8.3f} us/op{}".format(name, seconds / number * 1e6, size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark callback_data encoding and routing")
+    parser.add_argument("--number", type=int, default=200000)
+    args = parser.parse_args()
+
+    legacy_data = legacy_encode()
+    codec_data = codec_encode()
+    assert codec_decode(codec_data) == (ORDER_ID, DATE, 12)
+
+    report("legacy encode", timeit.timeit(legacy_encode, number=args.number), args.number, legacy_data)
+    report("legacy route", timeit.timeit(lambda: legacy_decode(legacy_data), number=args.number), args.number)
+    report("codec encode", timeit.timeit(codec_encode, number=args.number), args.number, codec_data)
+    report("codec dispatch", timeit.timeit(lambda: codec_decode(codec_data), number=args.number), args.number)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""
+Cold start time of the bot.
+
+Each run starts a fresh interpreter and measures:
+- import: time to import bot, and how many modules that pulls in;
+- ready: from process start until the webhook accepts an update;
+- first response: from process start until the reply to /start comes back, answered inline in the
+  webhook response (WEBHOOK_INLINE_REPLY=1).
+
+The bot talks to a fake Telegram Bot (see loadtest.py) and uses the in-memory storage backend unless
+--backend is given; --backend firestore needs FIREBASE_CERT.
+
+Usage: python benchmarks/bench_startup.py [--runs N] [--backend BACKEND] [--warm-up]
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+URL_PATH = "startup"
+START_UPDATE = {"update_id": 1, "message": {
+    "message_id": 1, "date": 0, "text": "/start", "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+    "chat": {"id": 1000, "type": "private"}, "from": {"id": 1000, "is_bot": False, "first_name": "Startup"}}}
+PING_UPDATE = {"update_id": 0}
+
+IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import bot
+print(time.perf_counter() - start, len(sys.modules))
+"""
+
+SERVE_SCRIPT = """
+import sys
+import threading
+sys.path.insert(0, "benchmarks")
+import bot
+import loadtest
+import webhookreply
+from telegram.ext import Updater
+
+
+
+class StartupBot(loadtest.FakeBot):
+    # Like NinjaBot, the first call of an update goes into the webhook response
+    def _post(self, endpoint, data=None, timeout=None, api_kwargs=None):
+        if webhookreply.offer(endpoint, dict(data or {{}})):
+            return True
+        return super()._post(endpoint, data, timeout, api_kwargs)
+
+
+updater = Updater(bot=StartupBot(loadtest.CallCounter()), use_context=True)
+bot.add_handlers(updater.dispatcher)
+webhookreply.add_handlers(updater.dispatcher)
+updater.start_webhook(listen="127.0.0.1", port=int(sys.argv[1]), url_path="{url_path}")
+webhookreply.add_route(updater, "{url_path}")
+if bot.WARM_UP:
+    threading.Thread(target=bot.warm_up, args=(updater.bot,), daemon=True).start()
+updater.idle()
+""".format(url_path=URL_PATH)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def post(port, update):
+    request = urllib.request.Request("http://127.0.0.1:{}/{}".format(port, URL_PATH),
+                                     data=json.dumps(update).encode(), headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return response.read()
+
+
+def measure_import(env):
+    output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], cwd=ROOT, env=env, check=True,
+                            capture_output=True, text=True).stdout.split()
+    return float(output[-2]), int(output[-1])
+
+
+def measure_serve(env):
+    """ Returns (seconds until the webhook accepts updates, seconds until /start is answered)."""
+    port = free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-c", SERVE_SCRIPT, str(port)], cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                post(port, PING_UPDATE)
+                break
+            except (urllib.error.URLError, ConnectionError):
+                if process.poll() is not None:
+                    raise RuntimeError("the bot exited with code {}".format(process.returncode))
+                time.sleep(0.005)
+        ready = time.perf_counter() - start
+        reply = json.loads(post(port, START_UPDATE) or "{}")
+        if reply.get("method") != "sendMessage":
+            raise RuntimeError("expected the /start reply inline, got {!r}".format(reply))
+        return ready, time.perf_counter() - start
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the bot's cold start time")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--backend", default="memory", help="storage backend, default memory")
+    parser.add_argument("--warm-up", action="store_true", help="warm up storage before serving, as in production")
+    args = parser.parse_args()
+
+    env = dict(os.environ, STORAGE_BACKEND=args.backend, WEBHOOK_INLINE_REPLY="1",
+               WARM_UP="1" if args.warm_up else "0")
+    imports, modules, ready, first = [], [], [], []
+    for _ in range(args.runs):
+        seconds, count = measure_import(env)
+        imports.append(seconds)
+        modules.append(count)
+        ready_seconds, first_seconds = measure_serve(env)
+        ready.append(ready_seconds)
+        first.append(first_seconds)
+
+    print("backend {}, {} runs (median / max)".format(args.backend, args.runs))
+    print("import bot       {:8.0f} ms {:8.0f} ms   {} modules".format(statistics.median(imports) * 1000,
+                                                                        max(imports) * 1000, max(modules)))
+    print("ready to serve   {:8.0f} ms {:8.0f} ms".format(statistics.median(ready) * 1000, max(ready) * 1000))
+    print("first response   {:8.0f} ms {:8.0f} ms".format(statistics.median(first) * 1000, max(first) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Per-operation latency of the storage backends.
+
+Seeds each backend with --orders synthetic orders and times get, get_many, update, reschedule
+and find_by_delivery_date. The Firestore backend is only included with --firestore, as it needs
+FIREBASE_CERT and writes to the real project.
+
+Usage: python benchmarks/bench_storage.py [--orders N] [--repeat N] [--firestore]
+"""
+import argparse
+import datetime
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import storage
+import tiers
+
+START = datetime.datetime(2022, 2, 21)
+
+
+def make_order(i):
+    pick_up = START + datetime.timedelta(days=i % 30)
+    return {
+        "owner": "user{}".format(i % 1000),
+        "pickUpDate": pick_up,
+        "deliveryDate": pick_up + datetime.timedelta(days=3),
+        "deliveryType": tiers.TIER_NAMES[i % len(tiers.TIER_NAMES)],
+        "numReschedules": 2,
+    }
+
+
+def time_op(op, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        op()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1]
+
+
+def bench(name, order_repository, num_orders, repeat):
+    order_ids = ["bench-{}".format(i) for i in range(num_orders)]
+    for i, order_id in enumerate(order_ids):
+        order_repository.put(order_id, make_order(i))
+
+    day = START + datetime.timedelta(days=10)
+    ops = [
+        ("get", lambda: order_repository.get(random.choice(order_ids))),
+        ("get_many(20)", lambda: order_repository.get_many(random.sample(order_ids, 20))),
+        ("update", lambda: order_repository.update(random.choice(order_ids), {"deliveryType": "express"})),
+        ("reschedule", lambda: order_repository.reschedule(random.choice(order_ids), day)),
+        ("find_by_delivery_date", lambda: list(order_repository.find_by_delivery_date(
+            day, day + datetime.timedelta(days=1)))),
+    ]
+    for op_name, op in ops:
+        median, p95 = time_op(op, repeat)
+        print("{:<10} {:<22} p50 {:9.1f} us   p95 {:9.1f} us".format(name, op_name, median * 1e6, p95 * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the storage backends")
+    parser.add_argument("--orders", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=500)
+    parser.add_argument("--firestore", action="store_true", help="also benchmark the Firestore backend")
+    args = parser.parse_args()
+
+    bench("memory", storage.get_repositories("memory")[0], args.orders, args.repeat)
+    with tempfile.TemporaryDirectory() as directory:
+        order_repository, _ = storage.create_sqlite_repositories(os.path.join(directory, "bench.db"))
+        bench("sqlite", order_repository, args.orders, args.repeat)
+    if args.firestore:
+        bench("firestore", storage.get_repositories("firestore")[0], min(args.orders, 200), min(args.repeat, 50))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Throughput of multi-process mode by number of workers.
+
+Seeds the in-memory backend, then pushes the updates of --flows complete user flows (see loadtest.py)
+through a workers.WorkerPool of 1, 2, 4, ... processes, each with the bot's handlers and a fake Bot, and
+reports updates/sec and the speed-up over one worker. Scaling is bounded by the number of cores.
+
+Usage: python benchmarks/bench_workers.py [--flows N] [--workers N [N ...]]
+"""
+import argparse
+import contextlib
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from telegram import Update
+from telegram.ext import Dispatcher, JobQueue
+
+import loadtest
+import workers
+
+bot = loadtest.bot
+
+
+def make_dispatcher():
+    fake_bot = loadtest.FakeBot(loadtest.CallCounter())
+    fake_bot.get_me()
+    job_queue = JobQueue()
+    dispatcher = Dispatcher(fake_bot, None, workers=0, job_queue=job_queue, use_context=True)
+    job_queue.set_dispatcher(dispatcher)
+    bot.add_handlers(dispatcher)
+    return dispatcher
+
+
+def run(num_workers, updates):
+    pool = workers.WorkerPool(num_workers, make_dispatcher)
+    start = time.perf_counter()
+    for update in updates:
+        pool.put(update)
+    while pool.total_processed() < len(updates):
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    pool.stop()
+    return len(updates) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput of the bot by number of worker processes")
+    parser.add_argument("--flows", type=int, default=500)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    logging.getLogger("apscheduler").setLevel(logging.WARNING)
+    pick_up_date = loadtest.seed(args.flows, 1)
+    parser_bot = loadtest.FakeBot(loadtest.CallCounter())
+    updates = []
+    for user_index in range(args.flows):
+        flow = loadtest.FlowBuilder(user_index).flow("LT{}-0".format(user_index), pick_up_date)
+        updates.extend(Update.de_json(update_dict, parser_bot) for _, update_dict in flow)
+
+    print("{} updates, {} cores".format(len(updates), os.cpu_count()))
+    baseline = None
+    for num_workers in args.workers:
+        # Workers inherit the seeded data; the handlers print their debugging output
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            throughput = run(num_workers, updates)
+        baseline = baseline or throughput
+        print("{:>3} workers {:10.1f} updates/sec   x{:.2f}".format(num_workers, throughput, throughput / baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+"""
+Synthetic end-to-end load test.
+
+Generates Telegram updates for complete user flows (start -> view orders -> open order -> calendar navigation
+-> pick date -> time slot -> upgrade -> pay) and feeds them through a real Dispatcher with the bot's handlers,
+against a fake Bot that answers every API call locally and the in-memory storage backend.
+
+Reports p50/p95/p99 handler latency per step, updates/sec and Telegram/storage calls per flow, and saves the
+results as JSON so runs can be compared between commits.
+
+Usage: python benchmarks/loadtest.py [--flows N] [--threads N] [--output FILE] [--compare FILE]
+"""
+import argparse
+import collections
+import contextlib
+import datetime
+import itertools
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+os.environ["STORAGE_BACKEND"] = "memory"
+
+from telegram import Bot, Update
+from telegram.ext import Dispatcher, JobQueue
+
+import bot
+import callbackcodec
+import tiers
+
+BOT_TOKEN = "123456:LOADTEST"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Ninja Scheduler", "username": "ninja_scheduler_bot"}
+
+
+class CallCounter:
+    """ Thread-safe counters, one Counter per flow."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.totals = collections.Counter()
+
+    def start_flow(self):
+        self._local.counts = collections.Counter()
+
+    def flow_counts(self):
+        return self._local.counts
+
+    def add(self, name):
+        counts = getattr(self._local, "counts", None)
+        if counts is not None:
+            counts[name] += 1
+        with self._lock:
+            self.totals[name] += 1
+
+
+class FakeBot(Bot):
+    """ Answers every Bot API call locally with a plausible result instead of calling Telegram."""
+
+    def __init__(self, counter):
+        super().__init__(BOT_TOKEN)
+        self.counter = counter
+        self._message_ids = itertools.count(1)
+
+    def _post(self, endpoint, data=None, timeout=None, api_kwargs=None):
+        self.counter.add(endpoint)
+        if endpoint == "getMe":
+            return BOT_USER
+        if endpoint == "getMyCommands":
+            return []
+        if endpoint in ("sendMessage", "editMessageText", "sendInvoice"):
+            data = data or {}
+            return {"message_id": next(self._message_ids), "date": int(time.time()),
+                    "chat": {"id": data.get("chat_id", 0), "type": "private"}, "text": data.get("text", "")}
+        return True
+
+
+class CountingRepository:
+    """ Counts every storage call, standing in for Firestore RPCs."""
+
+    def __init__(self, repository, counter, prefix):
+        self._repository = repository
+        self._counter = counter
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attr = getattr(self._repository, name)
+        if not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            self._counter.add(self._prefix + name)
+            return attr(*args, **kwargs)
+
+        return counted
+
+
+class FlowBuilder:
+    """ Builds the Update dicts for one user's flow."""
+
+    _update_ids = itertools.count(1)
+    _update_ids_lock = threading.Lock()
+
+    def __init__(self, user_index):
+        self.chat = {"id": 10000 + user_index, "type": "private", "username": "loadtest{}".format(user_index)}
+        self.user = {"id": 10000 + user_index, "is_bot": False, "first_name": "Load",
+                     "username": self.chat["username"]}
+
+    def _update(self, **fields):
+        with self._update_ids_lock:
+            update_id = next(self._update_ids)
+        return dict(update_id=update_id, **fields)
+
+    def _message(self, sender, **fields):
+        message = {"message_id": 1, "date": int(time.time()), "chat": self.chat, "from": sender}
+        message.update(fields)
+        return message
+
+    def command(self, text):
+        return self._update(message=self._message(self.user, text=text, entities=[
+            {"type": "bot_command", "offset": 0, "length": len(text)}]))
+
+    def press(self, data):
+        return self._update(callback_query={"id": str(self.chat["id"]), "from": self.user, "chat_instance": "1",
+                                            "data": data, "message": self._message(BOT_USER, text="menu")})
+
+    def pre_checkout(self, payload):
+        return self._update(pre_checkout_query={"id": str(self.chat["id"]), "from": self.user, "currency": "SGD",
+                                                "total_amount": 200, "invoice_payload": payload})
+
+    def successful_payment(self, payload):
+        return self._update(message=self._message(self.user, successful_payment={
+            "currency": "SGD", "total_amount": 200, "invoice_payload": payload,
+            "telegram_payment_charge_id": "tg", "provider_payment_charge_id": "provider"}))
+
+    def flow(self, order_id, pick_up_date):
+        """ (step name, update dict) pairs for one complete flow."""
+        day = (pick_up_date + datetime.timedelta(days=2)).date()
+        month = day.replace(day=1)
+        payload = "ninja-scheduler/14day-timeslot/" + order_id
+        return [
+            ("start", self.command("/start")),
+            ("view_orders", self.press(callbackcodec.encode(callbackcodec.VIEW_ORDERS))),
+            ("view_order", self.press(callbackcodec.encode(callbackcodec.VIEW_ORDER, order_id))),
+            ("reschedule_order", self.press(callbackcodec.encode(callbackcodec.RESCHEDULE_ORDER, order_id))),
+            ("calendar_next", self.press(callbackcodec.encode(callbackcodec.CALENDAR_NEXT_MONTH, order_id, month))),
+            ("calendar_prev", self.press(callbackcodec.encode(callbackcodec.CALENDAR_PREV_MONTH, order_id, month))),
+            ("calendar_day", self.press(callbackcodec.encode(callbackcodec.CALENDAR_DAY, order_id, day))),
+            ("time_slot", self.press(callbackcodec.encode(callbackcodec.RESCHEDULE_TO_TIME, order_id, day, 12))),
+            ("upgrade_order", self.press(callbackcodec.encode(callbackcodec.UPGRADE_ORDER, order_id))),
+            ("upgrade_to", self.press(callbackcodec.encode(callbackcodec.UPGRADE_TO, order_id,
+                                                           arg=bot.UPGRADE_TIERS.index("14day-timeslot")))),
+            ("pre_checkout", self.pre_checkout(payload)),
+            ("successful_payment", self.successful_payment(payload)),
+        ]
+
+
+def seed(num_users, orders_per_user):
+    """ Create the users and their timeslot orders, picked up today so the calendar window is open."""
+    pick_up_date = tiers.today().replace(second=0, microsecond=0)
+    for user_index in range(num_users):
+        username = "loadtest{}".format(user_index)
+        order_ids = ["LT{}-{}".format(user_index, i) for i in range(orders_per_user)]
+        # The user first, putting an order adds its summary to the user document
+        bot.user_repository.put(username, {"orders": order_ids})
+        for order_id in order_ids:
+            bot.order_repository.put(order_id, {
+                "owner": username,
+                "pickUpDate": pick_up_date,
+                "deliveryDate": pick_up_date + datetime.timedelta(days=3),
+                "deliveryType": "timeslot",
+                "numReschedules": 2,
+            })
+    return pick_up_date
+
+
+def percentile(sorted_samples, fraction):
+    if not sorted_samples:
+        return 0.0
+    return sorted_samples[min(len(sorted_samples) - 1, int(len(sorted_samples) * fraction))]
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "p50_ms": percentile(samples, 0.50) * 1000,
+        "p95_ms": percentile(samples, 0.95) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(num_flows, threads, orders_per_user):
+    telegram_calls = CallCounter()
+    storage_calls = CallCounter()
+    fake_bot = FakeBot(telegram_calls)
+    fake_bot.get_me()
+
+    job_queue = JobQueue()
+    dispatcher = Dispatcher(fake_bot, None, workers=0, job_queue=job_queue, use_context=True)
+    job_queue.set_dispatcher(dispatcher)
+    bot.add_handlers(dispatcher)
+    bot.order_cache.repository = CountingRepository(bot.order_cache.repository, storage_calls, "orders.")
+    bot.user_repository = CountingRepository(bot.user_repository, storage_calls, "users.")
+    pick_up_date = seed(num_flows, orders_per_user)
+    job_queue.start()
+
+    latencies = collections.defaultdict(list)
+    latencies_lock = threading.Lock()
+    flow_telegram_calls = []
+    flow_storage_calls = []
+
+    def run_flow(user_index):
+        builder = FlowBuilder(user_index)
+        telegram_calls.start_flow()
+        storage_calls.start_flow()
+        timings = []
+        for step, update_dict in builder.flow("LT{}-0".format(user_index), pick_up_date):
+            update = Update.de_json(update_dict, fake_bot)
+            start = time.perf_counter()
+            dispatcher.process_update(update)
+            timings.append((step, time.perf_counter() - start))
+        with latencies_lock:
+            for step, seconds in timings:
+                latencies[step].append(seconds)
+            flow_telegram_calls.append(sum(telegram_calls.flow_counts().values()))
+            flow_storage_calls.append(sum(storage_calls.flow_counts().values()))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(run_flow, range(num_flows)))
+    elapsed = time.perf_counter() - start
+    job_queue.stop()
+
+    all_latencies = list(itertools.chain.from_iterable(latencies.values()))
+    return {
+        "revision": git_revision(),
+        "flows": num_flows,
+        "threads": threads,
+        "updates": len(all_latencies),
+        "elapsed_s": elapsed,
+        "updates_per_sec": len(all_latencies) / elapsed if elapsed > 0 else 0.0,
+        "latency": summarize(all_latencies),
+        "latency_per_step": {step: summarize(samples) for step, samples in latencies.items()},
+        # Telegram calls include the typing indicators sent from the job queue
+        "telegram_calls_per_flow": sum(flow_telegram_calls) / num_flows,
+        "storage_calls_per_flow": sum(flow_storage_calls) / num_flows,
+        "telegram_calls": dict(telegram_calls.totals),
+        "storage_calls": dict(storage_calls.totals),
+        "order_cache": bot.order_cache.stats(),
+    }
+
+
+def change(new, old):
+    return "  ({:+.1f}%)".format((new - old) / old * 100) if old else ""
+
+
+def print_report(results, baseline=None):
+    def compared(value, *keys):
+        if baseline is None:
+            return ""
+        old = baseline
+        for key in keys:
+            old = old[key]
+        return change(value, old)
+
+    print("revision {}: {} flows, {} updates on {} threads in {:.2f}s".format(
+        results["revision"], results["flows"], results["updates"], results["threads"], results["elapsed_s"]))
+    print("updates/sec         {:10.1f}{}".format(results["updates_per_sec"],
+                                                  compared(results["updates_per_sec"], "updates_per_sec")))
+    for name in ("p50_ms", "p95_ms", "p99_ms"):
+        value = results["latency"][name]
+        print("latency {:<11} {:10.3f}{}".format(name, value, compared(value, "latency", name)))
+    for name in ("telegram_calls_per_flow", "storage_calls_per_flow"):
+        print("{:<19} {:10.1f}{}".format(name, results[name], compared(results[name], name)))
+    print("{:<20} {:>8} {:>10} {:>10} {:>10}".format("step", "count", "p50 ms", "p95 ms", "p99 ms"))
+    for step, summary in results["latency_per_step"].items():
+        print("{:<20} {:>8} {:>10.3f} {:>10.3f} {:>10.3f}".format(step, summary["count"], summary["p50_ms"],
+                                                                  summary["p95_ms"], summary["p99_ms"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load test of the bot's handlers")
+    parser.add_argument("--flows", type=int, default=500, help="number of complete user flows")
+    parser.add_argument("--threads", type=int, default=4, help="flows run concurrently")
+    parser.add_argument("--orders-per-user", type=int, default=3)
+    parser.add_argument("--output", help="where to save the JSON results, default benchmarks/results/<revision>.json")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    logging.getLogger("apscheduler").setLevel(logging.WARNING)
+    # The handlers print their debugging output; keep it out of the report
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        results = run(args.flows, args.threads, args.orders_per_user)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_report(results, baseline)
+
+    output = args.output or os.path.join(ROOT, "benchmarks", "results", "loadtest-{}.json".format(results["revision"]))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    print("saved", output)
+
+
+if __name__ == '__main__':
+    main()
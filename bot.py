@@ -1,20 +1,45 @@
+import concurrent.futures
 import logging
 import os
 import datetime
-import time
-
+import threading
+
+import botclient
+import bulkreschedule
+import callbackcodec
+import dedupe
+import eventlog
+import metrics
+import ordercache
+import profiler
+import reminders
+import replybuffer
+import sendqueue
+import sharedstate
+import slotcapacity
 import telegramcalendar
+import tiers
+import webhookreply
+import workers
 
 from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, PreCheckoutQueryHandler, MessageHandler, Filters
+from telegram.ext import Dispatcher, JobQueue
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ChatAction, LabeledPrice, ReplyKeyboardRemove
-
-import firebase_admin
-from firebase_admin import firestore
-from firebase_admin import credentials
-
-cred = credentials.Certificate(os.getenv("FIREBASE_CERT"))
-firebase_admin.initialize_app(cred)
-firestore_db = firestore.client()
+from telegram.utils.request import Request
+
+import storage
+
+# Connected on first use (or by warm_up), so the webhook can bind before Firestore is ready
+order_repository, user_repository = storage.get_repositories(lazy=True)
+order_repository = metrics.InstrumentedRepository(order_repository, "orders")
+user_repository = metrics.InstrumentedRepository(user_repository, "users")
+order_cache = ordercache.OrderCache(order_repository,
+                                   max_size=int(os.getenv("ORDER_CACHE_SIZE", "1024")),
+                                   ttl=int(os.getenv("ORDER_CACHE_TTL", "300")))
+metrics.REGISTRY.add_collector(lambda: [
+    ("ninja_order_cache_hits_total", "counter", "Order reads served from the cache", order_cache.hits),
+    ("ninja_order_cache_misses_total", "counter", "Order reads that went to storage", order_cache.misses),
+])
 
 # Enable logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -24,6 +49,38 @@ logger = logging.getLogger(__name__)
 PORT = int(os.environ.get('PORT', '8443'))
 TOKEN = os.getenv("TELEGRAM_TOKEN")
 APP_NAME = os.getenv("APP_NAME")
+# Handle updates in this many processes, sharded by chat (see workers.py)
+WORKERS = int(os.getenv("WORKERS", "1"))
+# Handle updates on an asyncio event loop instead of dispatcher threads (see asyncengine.py)
+ASYNC_ENGINE = os.getenv("ASYNC_ENGINE", "0") == "1"
+# Connect to storage and Telegram in the background once the webhook is up
+WARM_UP = os.getenv("WARM_UP", "1") == "1"
+# Send delivery-day reminders every day at REMINDER_TIME (see reminders.py)
+REMINDERS = os.getenv("REMINDERS", "1") == "1"
+# Fulfil Stripe Checkout upgrades posted to the Stripe webhook (see payments/stripePayment.py)
+STRIPE_WEBHOOK = os.getenv("STRIPE_WEBHOOK", "0") == "1"
+ADMIN_USERNAMES = set(filter(None, os.getenv("ADMIN_USERNAMES", "").split(",")))
+# Keep-alive connections to api.telegram.org; the Updater needs at least its 4 workers + 4
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "8"))
+
+# Every process sending messages gets its share of the global rate: with workers, those and the webhook process,
+# which sends the reminders and payment notices
+send_queue = sendqueue.SendQueue(global_rate=float(os.getenv("TELEGRAM_GLOBAL_RATE", "30")) /
+                                 (WORKERS + 1 if WORKERS > 1 else 1),
+                                 chat_rate=float(os.getenv("TELEGRAM_CHAT_RATE", "1")))
+# Bot and conversation state, shared by the worker processes
+shared_state = sharedstate.get_store()
+# Order ids too long for callback data are looked up there
+callbackcodec.long_order_ids = shared_state
+# Parcels booked into each delivery time slot
+slot_capacity = slotcapacity.get_slot_capacity(lazy=True)
+# Reschedules, upgrades and top-ups, for ops analytics
+event_log = eventlog.EventLog(metrics.InstrumentedRepository(storage.get_event_repository(lazy=True), "events"))
+
+metrics.REGISTRY.add_collector(lambda: [
+    ("ninja_send_queue_depth", "gauge", "Outbound messages waiting for a send slot", send_queue.depth()),
+    ("ninja_order_event_queue_depth", "gauge", "Order events waiting to be written", event_log.depth()),
+])
 
 def get_chat_id(update, context):
     chat_id = -1
@@ -35,13 +92,26 @@ def get_chat_id(update, context):
         chat_id = update.callback_query.message.chat.id
     elif update.poll is not None:
         # answer in Poll
-        chat_id = context.bot_data[update.poll.id]
+        chat_id = shared_state.get("poll_chats", update.poll.id, -1)
 
     return chat_id
 
+# Threads sending chat actions
+chat_actions = concurrent.futures.ThreadPoolExecutor(4, thread_name_prefix="chat-action")
+
+
+# Shows the "typing..." indicator without holding up the handler; the chat action is sent from another
+# thread while the handler carries on with its Firestore work, and the replies wait for it (see replybuffer).
+def send_typing_action(update, context):
+    context.replies.precede(chat_actions.submit(context.bot.send_chat_action, chat_id=get_chat_id(update, context),
+                                                action=ChatAction.TYPING))
+
+
+@profiler.in_phase(profiler.KEYBOARD)
 def get_update_keyboard():
-    options = [InlineKeyboardButton(text='View Orders', callback_data='view_orders_action'),
-               InlineKeyboardButton(text='Upgrade Orders', callback_data='upgrade_orders_action_')]
+    options = [InlineKeyboardButton(text='View Orders', callback_data=callbackcodec.encode(callbackcodec.VIEW_ORDERS)),
+               InlineKeyboardButton(text='Upgrade Orders',
+                                    callback_data=callbackcodec.encode(callbackcodec.UPGRADE_ORDERS))]
     keyboard = InlineKeyboardMarkup([options])
     return keyboard
 
@@ -52,63 +122,25 @@ def query_handler(update, context):
     query = update.callback_query
     query.answer()
 
-    # Change your comparisons depending on what you chose as 'callback_data'
-    if query.data == 'view_orders_action':
-        view_orders(update, context)
-    elif 'reschedule-topup' in query.data:
-        order_id = query.data.split("/")[1]
-        top_up_reschedules(update, context, order_id)
-    elif 'upgrade_orders_action_' in query.data:
-        upgrade_orders(update, context)
-    elif "view-order-id-" in query.data:
-        order_id = query.data[14:]
-        get_order(update, context, order_id)
-    elif "reschedule_orders_action" in query.data:
-        order_id = query.data[24:]
-        order = firestore_db.collection(u'orders').document(order_id).get()
-        order_dict = order.to_dict()
-        date_time = order_dict["deliveryDate"].strftime("%d/%m/%Y")
-
-        context.bot.send_message(chat_id=get_chat_id(update, context),
-                                 text="Your delivery is currently scheduled to reach on " + date_time)
-        context.bot.send_message(chat_id=get_chat_id(update, context), text='Please select a date:',
-                                 reply_markup=telegramcalendar.create_calendar(order_id))
-    elif "reschedule-order-id-" in query.data:
-        splitQuery = query.data.split(';')
-        order_id = splitQuery[0][20:]
-        reschedule_order(update, context, order_id)
-    elif "upgrade-order-id-" in query.data:
-        order_id = query.data[17:]
-        upgrade_order(update, context, order_id)
-    elif "_to_express_tier" in query.data:
-        order_id = query.data[8:-16]
-        upgrade_to_express(update, context, order_id)
-    elif "_to_timeslot_tier" in query.data:
-        order_id = query.data[8:-17]
-        upgrade_to_timeslot(update, context, order_id)
-    elif "9-12" in query.data:
-        order_id = query.data[11:-19]
-        date = query.data[-15:-5]
-        reschedule_to_time(update, context, date, order_id, 9)
-    elif "12-15" in query.data:
-        order_id = query.data[11:-20]
-        date = query.data[-16:-6]
-        reschedule_to_time(update, context, date, order_id, 12)
-    elif "15-18" in query.data:
-        order_id = query.data[11:-20]
-        date = query.data[-16:-6]
-        reschedule_to_time(update, context, date, order_id, 15)
-    elif "_to_18-20" in query.data:
-        order_id = query.data[11:-20]
-        date = query.data[-16:-6]
-        reschedule_to_time(update, context, date, order_id, 18)
-    elif "_to_14daystd" in query.data:
-        order_id = query.data[8:-12]
-        upgrade_to_14daystd(update, context, order_id)
-    elif "_to_14dayts" in query.data:
-        order_id = query.data[8:-11]
-        upgrade_to_14dayts(update, context, order_id)
-    return
+    with profiler.phase(profiler.PARSE):
+        callback = callbackcodec.decode(query.data)
+    if callback is None or callback.action not in CALLBACK_HANDLERS:
+        # Button from a message sent before the callback format changed
+        start(update, context)
+        return
+    with metrics.track(callbackcodec.ACTION_NAMES[callback.action]):
+        CALLBACK_HANDLERS[callback.action](update, context, callback)
+
+
+def show_reschedule_calendar(update, context, order_id):
+    order_dict = order_cache.get(order_id)
+    date_time = order_dict["deliveryDate"].strftime("%d/%m/%Y")
+    minDate, maxDate = get_reschedule_window(order_dict)
+
+    context.replies.send("Your delivery is currently scheduled to reach on " + date_time)
+    context.replies.send('Please select a date:',
+                         reply_markup=telegramcalendar.create_calendar(order_id, min_date=minDate,
+                                                                       max_date=maxDate))
 
 
 START_INSTRUCTION = """Welcome to NinjaScheduler! I'm here to help you with your Ninja Van deliveries.\n
@@ -118,78 +150,146 @@ You can view all your orders, upgrade your orders or schedule your deliveries. H
 # Define a few command handlers. These usually take the two arguments update and
 # context. Error handlers also receive the raised TelegramError object in error.
 def start(update, context):
-    context.bot.send_message(chat_id=get_chat_id(update, context),
-                             text=START_INSTRUCTION,
-                             reply_markup=get_update_keyboard())
+    context.replies.send(START_INSTRUCTION,
+                         reply_markup=get_update_keyboard())
     # input from text message
 
 
 def convert_order_to_button(order_id, action):
-    return InlineKeyboardButton(text=str(order_id), callback_data=action + "-order-id-" + str(order_id))
+    return InlineKeyboardButton(text=str(order_id), callback_data=callbackcodec.encode(action, str(order_id)))
 
 
+@profiler.in_phase(profiler.KEYBOARD)
 def get_orders_keyboard(update, context, orders, action):
     options = list(map(convert_order_to_button, orders, (action,) * len(orders)))
     keyboard = InlineKeyboardMarkup([options])
     return keyboard
 
 
-VIEW_ORDERS_INSTRUCTION = "You currently have {} orders scheduled for delivery. \n Which order do you wish to " \
+VIEW_ORDERS_INSTRUCTION = "You currently have {} orders scheduled for delivery. \n{}\n Which order do you wish to " \
                           "view? "
+ORDER_SUMMARY_LINE = "{}. Order {}: arriving {} ({} delivery, {} reschedules left)"
+MISSING_ORDER_SUMMARY_LINE = "{}. Order {}: details unavailable"
+RESCHEDULE_WINDOW_LINE = ", can be rescheduled {} to {}"
+UPGRADE_FROM_LINE = ", upgrades from ${}"
+HIGHEST_TIER_LINE = ", already at the highest tier"
+
+
+def get_user_orders(update):
+    """
+    The user's orders with their summaries, read from the user document alone once it has a summary of each.
+    Summaries missing from older user documents are read from the orders and saved for next time.
+    :return: Returns a tuple (order ids, {order_id: summary}).
+    """
+    username = update.callback_query.message.chat.username
+    user_dict = user_repository.get(username)
+    orders = user_dict['orders']
+    summaries = user_dict.get('orderSummaries', {})
+    missing = [order_id for order_id in orders if order_id not in summaries]
+    order_dicts = order_cache.get_many(missing) if missing else {}
+    backfill_user(username, update.callback_query.message.chat.id, user_dict, order_dicts)
+    summaries.update({order_id: storage.order_summary(order_dict)
+                      for order_id, order_dict in order_dicts.items() if order_dict is not None})
+    return orders, summaries
+
+
+def backfill_user(username, chat_id, user_dict, order_dicts):
+    """
+    Save what the order menus found missing: the chat reminders are sent to, and the summaries of orders
+    that had none. Those orders get their owner set too, older orders have none and the order repositories
+    only keep the summaries of owned orders up to date.
+    :param dict order_dicts: {order_id: order_dict} of the orders read for their missing summaries.
+    """
+    if user_dict.get('chatId') != chat_id:
+        user_repository.update(username, {'chatId': chat_id})
+    found = {order_id: order_dict for order_id, order_dict in order_dicts.items() if order_dict is not None}
+    unowned = [(order_id, {'owner': username}) for order_id, order_dict in found.items()
+               if order_dict.get('owner') != username]
+    if unowned:
+        order_cache.update_many(unowned)
+    if found:
+        user_repository.update_order_summaries(username, {order_id: storage.order_summary(order_dict)
+                                                          for order_id, order_dict in found.items()})
+
+
+# Summarises every order in one message, so users don't have to open them one by one
+def format_order_summaries(orders, order_dicts, show_upgrades=False):
+    found = [order_dicts[order_id] for order_id in orders if order_dicts.get(order_id) is not None]
+    min_dates, max_dates, upgrade_offers = tiers.batch_windows_and_prices(
+        [order_dict.get("deliveryType") for order_dict in found],
+        [order_dict["pickUpDate"].replace(tzinfo=None) if order_dict.get("pickUpDate") else None
+         for order_dict in found])
+    policies = iter(zip(min_dates, max_dates, upgrade_offers))
+
+    lines = []
+    for index, order_id in enumerate(orders, start=1):
+        order_dict = order_dicts.get(order_id)
+        if order_dict is None:
+            lines.append(MISSING_ORDER_SUMMARY_LINE.format(index, order_id))
+            continue
+        min_date, max_date, upgrade_offer = next(policies)
+        date_time = date_time_formatter(order_dict["deliveryDate"].strftime("%m/%d/%Y, %H:%M:%S"))
+        line = ORDER_SUMMARY_LINE.format(index, order_id, date_time, order_dict["deliveryType"],
+                                         order_dict["numReschedules"])
+        if show_upgrades:
+            # No offer at all for a tier we don't know
+            if upgrade_offer is not None:
+                line += UPGRADE_FROM_LINE.format(min(upgrade_offer.values())) if upgrade_offer else HIGHEST_TIER_LINE
+        elif min_date is not None and min_date <= max_date:
+            line += RESCHEDULE_WINDOW_LINE.format(min_date.strftime("%d/%m"), max_date.strftime("%d/%m"))
+        lines.append(line)
+    return "\n".join(lines)
 
 
 # Retrieves the orders
 def view_orders(update, context):
     try:
-        users_collection = firestore_db.collection(u'users')
-        doc = users_collection.document(update.callback_query.message.chat.username).get()
-        doc_dict = doc.to_dict()
-        orders = doc_dict['orders']
-        num_orders = len(orders)
-        context.bot.send_chat_action(chat_id=get_chat_id(update, context), action=ChatAction.TYPING, timeout=1)
-        time.sleep(1)
-        context.bot.send_message(chat_id=get_chat_id(update, context),
-                                 text=VIEW_ORDERS_INSTRUCTION.format(num_orders),
-                                 reply_markup=get_orders_keyboard(update, context, orders, "view"))
+        send_typing_action(update, context)
+        orders, order_dicts = get_user_orders(update)
+        context.replies.send(VIEW_ORDERS_INSTRUCTION.format(len(orders),
+                                                            format_order_summaries(orders, order_dicts)),
+                             reply_markup=get_orders_keyboard(update, context, orders, callbackcodec.VIEW_ORDER))
     except Exception as e:
         print(e)
-        context.bot.send_message(chat_id=get_chat_id(update, context),
-                                 text="Sorry, unable to retrieve orders.")
+        context.replies.send("Sorry, unable to retrieve orders.")
 
 
+@profiler.in_phase(profiler.KEYBOARD)
 def get_order_keyboard(order_id):
-    options = [InlineKeyboardButton(text='Upgrade Plan', callback_data='upgrade-order-id-' + order_id),
-               InlineKeyboardButton(text='Reschedule Order', callback_data='reschedule_orders_action' + order_id)]
+    options = [InlineKeyboardButton(text='Upgrade Plan',
+                                    callback_data=callbackcodec.encode(callbackcodec.UPGRADE_ORDER, order_id)),
+               InlineKeyboardButton(text='Reschedule Order',
+                                    callback_data=callbackcodec.encode(callbackcodec.RESCHEDULE_ORDER, order_id))]
     keyboard = InlineKeyboardMarkup([options])
     return keyboard
 
 
+ORDER_DETAILS_TEXT = "Your order {} is due to arrive by {}. \n The current delivery type for this order is: " \
+                     "{}.\n You have {} reschedules left.\n What do you want to do? "
+UPGRADE_DETAILS_TEXT = "Your order {} is due to arrive on {}. \nThe current delivery type for this order is: {}.\n " \
+                       "You have {} reschedules left.\n What plan would you like to upgrade to? "
+
+
+def format_order_details(text, order_id, order_dict):
+    date_time = date_time_formatter(order_dict["deliveryDate"].strftime("%m/%d/%Y, %H:%M:%S"))
+    return text.format(order_id, date_time, order_dict["deliveryType"], str(order_dict["numReschedules"]))
+
+
 def get_order(update, context, order_id):
     try:
-        context.bot.send_chat_action(chat_id=get_chat_id(update, context), action=ChatAction.TYPING, timeout=1)
-        time.sleep(1)
-        order = firestore_db.collection(u'orders').document(order_id).get()
-        order_dict = order.to_dict()
-        date_time = date_time_formatter(order_dict["deliveryDate"].strftime("%m/%d/%Y, %H:%M:%S"))
-
-        del_type = order_dict["deliveryType"]
-        num_res = order_dict["numReschedules"]
-        text = "Your order {} is due to arrive by {}. \n The current delivery type for this order is: " \
-               "{}.\n You have {} reschedules left.\n What do you want to do? "
-        formatted_text = text.format(order_id, date_time, del_type, str(num_res))
-        context.bot.send_message(chat_id=get_chat_id(update, context),
-                                 text=formatted_text,
-                                 reply_markup=get_order_keyboard(order_id))
+        send_typing_action(update, context)
+        order_dict = order_cache.get(order_id)
+        context.replies.send(format_order_details(ORDER_DETAILS_TEXT, order_id, order_dict),
+                             reply_markup=get_order_keyboard(order_id))
     except Exception as e:
         print(e)
-        context.bot.send_message(chat_id=get_chat_id(update, context),
-                                 text="Sorry, unable to retrieve order.")
+        context.replies.send("Sorry, unable to retrieve order.")
 
 def date_time_formatter(date_time):
     date_details = date_time.split(", ")
     if date_details[1] == "00:00:00":
         return date_details[0]
-    elif date_details[0] == "09:00:00":
+    elif date_details[1] == "09:00:00":
         return date_details[0] + " 9am-12pm"
     elif date_details[1] == "12:00:00":
         return date_details[0] + " 12pm-3pm"
@@ -198,65 +298,62 @@ def date_time_formatter(date_time):
     else:
         return date_details[0] + " 6pm-10pm"
 
+def send_top_up_offer(update, context, order_id):
+    options = [InlineKeyboardButton(text='Yes!', callback_data=callbackcodec.encode(callbackcodec.TOP_UP, order_id))]
+    keyboard = InlineKeyboardMarkup([options])
+    context.replies.send("Number of reschedules has already exceeded the limit! Would you like to pay to reschedule?"
+                         ,reply_markup=keyboard)
+
 def dateInRange(dateToCheck, minDate, maxDate):
     return minDate <= dateToCheck <= maxDate
 
+# Earliest and latest dates the order can be rescheduled to under its delivery tier
+def get_reschedule_window(order_dict):
+    return tiers.reschedule_window(order_dict['deliveryType'], order_dict['pickUpDate'].replace(tzinfo=None))
+
 def reschedule_order(update, context, order_id):
-    selected, rescheduledDateTime = telegramcalendar.process_calendar_selection(update, context)
-    order = firestore_db.collection(u'orders').document(order_id).get()
-    order_dict = order.to_dict()
-    deliveryDate = order_dict['deliveryDate'].replace(tzinfo=None)
+    order_dict = order_cache.get(order_id)
+    minDate, maxDate = get_reschedule_window(order_dict)
+    selected, rescheduledDateTime = telegramcalendar.process_calendar_selection(update, context, minDate, maxDate)
+    if not selected:
+        # Month navigation only redraws the calendar
+        return
     deliveryType = order_dict['deliveryType']
     numReschedules = int(order_dict['numReschedules'])
-    pickUpDate = order_dict['pickUpDate'].replace(tzinfo=None)
-    today = datetime.datetime.now().replace(hour=0, minute=0)
-    back_button = InlineKeyboardButton(text='←', callback_data='reschedule_orders_action' + order_id)
+    back_button = InlineKeyboardButton(text='←',
+                                       callback_data=callbackcodec.encode(callbackcodec.RESCHEDULE_ORDER, order_id))
     if numReschedules <= 0:
-        options = [InlineKeyboardButton(text='Yes!', callback_data='reschedule-topup/' + order_id)]
-        keyboard = InlineKeyboardMarkup([options])
-        context.bot.send_message(chat_id=get_chat_id(update, context),
-                                 text="Number of reschedules has already exceeded the limit! Would you like to pay to reschedule?"
-                                    ,reply_markup=keyboard)
+        send_top_up_offer(update, context, order_id)
     else:
-        if deliveryType == "standard" and selected:
-            minDate = max([today, pickUpDate + datetime.timedelta(days=3)])
-            maxDate = pickUpDate + datetime.timedelta(days=7)
-        elif (deliveryType == "express" or deliveryType == "timeslot") and selected:
-            minDate = max([today, pickUpDate + datetime.timedelta(days=1)])
-            maxDate = pickUpDate + datetime.timedelta(days=7)
-        elif deliveryType == "14day-standard" and selected:
-            minDate = max([today, pickUpDate + datetime.timedelta(days=3)])
-            maxDate = pickUpDate + datetime.timedelta(days=14)
-        elif deliveryType == "14day-timeslot" and selected:
-            minDate = max([today, pickUpDate + datetime.timedelta(days=1)])
-            maxDate = pickUpDate + datetime.timedelta(days=14)
-
         print("minDate", minDate.strftime("%d/%m/%Y"))
         print("maxDate", maxDate.strftime("%d/%m/%Y"))
         if dateInRange(rescheduledDateTime, minDate, maxDate):
-            if "timeslot" in deliveryType:
-                context.bot.send_message(chat_id=get_chat_id(update, context),
-                                        text=f"Please select a time slot",
-                                        reply_markup=get_time_keyboard(update, context, rescheduledDateTime, order_id, False))
+            if tiers.TIERS[deliveryType].timeslot:
+                keyboard = get_time_keyboard(update, context, rescheduledDateTime, order_id, False)
+                if keyboard is None:
+                    context.replies.send(ALL_SLOTS_FULL_MESSAGE, reply_markup=InlineKeyboardMarkup([[back_button]]))
+                else:
+                    context.replies.send(f"Please select a time slot", reply_markup=keyboard)
             else:
-                numReschedules -= 1
-                firestore_db.collection(u'orders').document(order_id).update({
-                    "deliveryDate": rescheduledDateTime,
-                    "numReschedules": str(numReschedules)
-                })
-                context.bot.send_message(chat_id=get_chat_id(update, context),
-                                         text=f"Your delivery has been rescheduled to " + rescheduledDateTime.strftime("%d/%m/%Y") +
-                                         f"!\nYou now have {numReschedules} reschedules left.",
-                                         reply_markup=get_update_keyboard())
+                numReschedules = order_cache.reschedule(order_id, rescheduledDateTime)
+                if numReschedules is None:
+                    send_top_up_offer(update, context, order_id)
+                    return
+                # No time slot any more
+                slot_capacity.release(slot_capacity.order_slot(order_dict))
+                event_log.record(eventlog.RESCHEDULE, order_id, order_dict, to_date=rescheduledDateTime)
+                context.replies.send(f"Your delivery has been rescheduled to " + rescheduledDateTime.strftime("%d/%m/%Y") +
+                                     f"!\nYou now have {numReschedules} reschedules left.",
+                                     reply_markup=get_update_keyboard())
         else:
-            context.bot.send_message(chat_id=update.callback_query.from_user.id,
-                                 text="Date is out of range",
+            context.replies.send("Date is out of range",
                                  reply_markup=InlineKeyboardMarkup([[back_button]]))
     # if deliveryType == "timeslot":
     # choose timeslot
 
 
 def top_up_reschedules(update, context, order_id):
+    context.replies.flush()
     context.bot.send_invoice(chat_id=get_chat_id(update, context),
                              title="Pay to reschedule",
                              description="Pay to reschedule after 2 times rescheduled",
@@ -270,49 +367,38 @@ def top_up_reschedules(update, context, order_id):
 
 def upgrade_orders(update, context):
     try:
-        users_collection = firestore_db.collection(u'users')
-        doc = users_collection.document(update.callback_query.message.chat.username).get()
-        doc_dict = doc.to_dict()
-        orders = doc_dict['orders']
-        context.bot.send_chat_action(chat_id=get_chat_id(update, context), action=ChatAction.TYPING, timeout=1)
-        time.sleep(1)
-        context.bot.send_message(chat_id=get_chat_id(update, context),
-                                 text='Which order do you want to upgrade?',
-                                 reply_markup=get_orders_keyboard(update, context, orders, "upgrade"))
+        send_typing_action(update, context)
+        orders, order_dicts = get_user_orders(update)
+        context.replies.send(format_order_summaries(orders, order_dicts, show_upgrades=True) +
+                             '\nWhich order do you want to upgrade?',
+                             reply_markup=get_orders_keyboard(update, context, orders, callbackcodec.UPGRADE_ORDER))
     except Exception as e:
         print(e)
-        context.bot.send_message(chat_id=get_chat_id(update, context),
-                                 text="Sorry, unable to retrieve orders.")
+        context.replies.send("Sorry, unable to retrieve orders.")
 
 
 def upgrade_order(update, context, order_id):
     try:
-        context.bot.send_chat_action(chat_id=get_chat_id(update, context), action=ChatAction.TYPING, timeout=1)
-        time.sleep(1)
-        order = firestore_db.collection(u'orders').document(order_id).get()
-        order_dict = order.to_dict()
-        date_time = date_time_formatter(order_dict["deliveryDate"].strftime("%m/%d/%Y, %H:%M:%S"))
-        del_type = order_dict["deliveryType"]
-        num_res = order_dict["numReschedules"]
-        text = "Your order {} is due to arrive on {}. \nThe current delivery type for this order is: {}.\n You have {" \
-               "} reschedules left.\n What plan would you like to upgrade to? "
-        formatted_text = text.format(order_id, date_time, del_type, str(num_res))
-        context.bot.send_message(chat_id=get_chat_id(update, context),
-                                 text=formatted_text,
-                                 reply_markup=get_upgrade_keyboard(order_id))
+        send_typing_action(update, context)
+        order_dict = order_cache.get(order_id)
+        context.replies.send(format_order_details(UPGRADE_DETAILS_TEXT, order_id, order_dict),
+                             reply_markup=get_upgrade_keyboard(order_id))
     except Exception as e:
         print(e)
-        context.bot.send_message(chat_id=get_chat_id(update, context),
-                                 text="Sorry, unable to retrieve order.")
+        context.replies.send("Sorry, unable to retrieve order.")
+
+
+# Tiers offered by get_upgrade_keyboard, indexed by the arg of an UPGRADE_TO callback
+UPGRADE_TIERS = tiers.TIER_NAMES[1:]
 
 
+@profiler.in_phase(profiler.KEYBOARD)
 def get_upgrade_keyboard(order_id):
-    options = [[InlineKeyboardButton(text='Express Tier', callback_data="upgrade-" + order_id + "_to_express_tier")],
-               [InlineKeyboardButton(text='TimeSlot Tier', callback_data="upgrade-" + order_id + "_to_timeslot_tier")],
-               [
-                   InlineKeyboardButton(text='14 Day Standard Tier',
-                                        callback_data="upgrade-" + order_id + "_to_14daystd")],
-               [InlineKeyboardButton(text='14 Day Timeslot Tier', callback_data="upgrade-" + order_id + "_to_14dayts")]]
+    def upgrade_button(text, tier):
+        return [InlineKeyboardButton(text=text, callback_data=callbackcodec.encode(callbackcodec.UPGRADE_TO, order_id,
+                                                                                   arg=UPGRADE_TIERS.index(tier)))]
+
+    options = [upgrade_button(tiers.TIERS[tier].label, tier) for tier in UPGRADE_TIERS]
     keyboard = InlineKeyboardMarkup(options)
     return keyboard
 
@@ -325,150 +411,101 @@ UPGRADE_FAIL_MESSAGE = """Sorry, unable to upgrade order."""
 
 
 
-def upgrade_to_express(update, context, order_id):
-    try:
-        context.bot.send_chat_action(chat_id=get_chat_id(update, context), action=ChatAction.TYPING, timeout=1)
-        time.sleep(1)
-        order = firestore_db.collection(u'orders').document(order_id).get()
-        order_dict = order.to_dict()
-        del_type = order_dict["deliveryType"]
-        if "express" in del_type:
-            context.bot.send_message(chat_id=get_chat_id(update, context),
-                                     text=ALREADY_AT_TIER_MESSAGE,
-                                     reply_markup=get_update_keyboard())
-        elif "timeslot" in del_type:
-            context.bot.send_message(chat_id=get_chat_id(update, context),
-                                     text=ALREADY_AT_HIGHER_TIER_MESSAGE,
-                                     reply_markup=get_update_keyboard())
-        else:
-            payment(update, context, del_type, "express", "Receive your package within 1 day of pickup!", order_id)
-    except Exception as e:
-        print(e)
-        context.bot.send_message(chat_id=get_chat_id(update, context),
-                                 text=UPGRADE_FAIL_MESSAGE)
-
-
-def upgrade_to_timeslot(update, context, order_id):
-    try:
-        context.bot.send_chat_action(chat_id=get_chat_id(update, context), action=ChatAction.TYPING, timeout=1)
-        time.sleep(1)
-        order = firestore_db.collection(u'orders').document(order_id).get()
-        order_dict = order.to_dict()
-        del_type = order_dict["deliveryType"]
-        if "timeslot" in del_type:
-            context.bot.send_message(chat_id=get_chat_id(update, context),
-                                     text=ALREADY_AT_TIER_MESSAGE,
-                                     reply_markup=get_update_keyboard())
-        else:
-            payment(update, context, del_type, "timeslot",
-                    "Choose the time slot which you want to receive your parcel (within 7 days)!", order_id)
-    except Exception as e:
-        print(e)
-        context.bot.send_message(chat_id=get_chat_id(update, context),
-                                 text=UPGRADE_FAIL_MESSAGE)
-
-
-def upgrade_to_14dayts(update, context, order_id):
+def upgrade_to_tier(update, context, order_id, new_type):
     try:
-        context.bot.send_chat_action(chat_id=get_chat_id(update, context), action=ChatAction.TYPING, timeout=1)
-        time.sleep(1)
-        order = firestore_db.collection(u'orders').document(order_id).get()
-        order_dict = order.to_dict()
+        send_typing_action(update, context)
+        order_dict = order_cache.get(order_id)
         del_type = order_dict["deliveryType"]
-        if "14day-timeslot" in del_type:
-            context.bot.send_message(chat_id=get_chat_id(update, context),
-                                     text=ALREADY_AT_TIER_MESSAGE,
-                                     reply_markup=get_update_keyboard())
+        if del_type == new_type:
+            context.replies.send(ALREADY_AT_TIER_MESSAGE,
+                                 reply_markup=get_update_keyboard())
+        elif tiers.is_higher_tier(del_type, new_type):
+            context.replies.send(ALREADY_AT_HIGHER_TIER_MESSAGE,
+                                 reply_markup=get_update_keyboard())
         else:
-            payment(update, context, del_type, "14day-timeslot",
-                    "Not at home in the coming week? Delay your delivery up to 14 days and choose a timeslot!", order_id)
-
+            payment(update, context, del_type, new_type, tiers.TIERS[new_type].description, order_id)
     except Exception as e:
         print(e)
-        context.bot.send_message(chat_id=get_chat_id(update, context),
-                                 text=UPGRADE_FAIL_MESSAGE)
+        context.replies.send(UPGRADE_FAIL_MESSAGE)
 
+ALL_SLOTS_FULL_MESSAGE = """Sorry, every time slot on this day is full. Please pick another day."""
+SLOT_FULL_MESSAGE = """Sorry, that time slot has just filled up. Please pick another one."""
 
-def upgrade_to_14daystd(update, context, order_id):
-    try:
-        context.bot.send_chat_action(chat_id=get_chat_id(update, context), action=ChatAction.TYPING, timeout=1)
-        time.sleep(1)
-        order = firestore_db.collection(u'orders').document(order_id).get()
-        order_dict = order.to_dict()
-        del_type = order_dict["deliveryType"]
-        if "14day-standard" in del_type:
-            context.bot.send_message(chat_id=get_chat_id(update, context),
-                                     text=ALREADY_AT_TIER_MESSAGE,
-                                     reply_markup=get_update_keyboard())
-        else:
-            payment(update, context, del_type, "14day-standard",
-                    "Not at home in the coming week? Delay your delivery up to 14 days!", order_id)
-    except Exception as e:
-        print(e)
-        context.bot.send_message(chat_id=get_chat_id(update, context),
-                                 text=UPGRADE_FAIL_MESSAGE)
 
+# Offers the slots of the day that still have room, None if there are none
+@profiler.in_phase(profiler.KEYBOARD)
 def get_time_keyboard(update, context, date, order_id, isShowBack = True):
     ReplyKeyboardRemove()
-    print('reschedule-' + order_id + "-to-" + str(date)[:10] + '_9-12')
-    print('reschedule-' + order_id + "-to-" + str(date)[:10] + '_12-15')
-    options = [
-                InlineKeyboardButton(text='9am-12pm', callback_data= 'reschedule-' + order_id + "-to-" + str(date)[:10] + '_9-12'),
-               InlineKeyboardButton(text='12pm-3pm', callback_data= 'reschedule-' + order_id + "-to-" + str(date)[:10] + '_12-15'),
-               InlineKeyboardButton(text='3pm-6pm', callback_data= 'reschedule-' + order_id + "-to-" + str(date)[:10] + '_15-18'),
-               InlineKeyboardButton(text='6pm-10pm', callback_data= 'reschedule-' + order_id + "-to-" + str(date)[:10] +'_18-22')]
-    back = InlineKeyboardButton(text='←', callback_data='reschedule_orders_action' + order_id),
+    order_dict = order_cache.get(order_id)
+    hours = set(slot_capacity.free_hours(date, order_dict.get("zone")))
+    current = order_dict["deliveryDate"]
+    if current.date() == date.date() and current.hour:
+        # The order's own slot
+        hours.add(current.hour)
+    if not hours:
+        return None
+
+    def slot_button(text, hour):
+        return InlineKeyboardButton(text=text, callback_data=callbackcodec.encode(callbackcodec.RESCHEDULE_TO_TIME,
+                                                                                  order_id, date.date(), hour))
+
+    options = [slot_button(text, hour) for hour, text in tiers.TIME_SLOTS if hour in hours]
+    back = InlineKeyboardButton(text='←', callback_data=callbackcodec.encode(callbackcodec.RESCHEDULE_ORDER, order_id)),
     keyboard = [back, options] if isShowBack else [options]
     keyboard = InlineKeyboardMarkup(keyboard)
     return keyboard
 
-def reschedule_to_time(update, context, dateString, order_id, rescheduleTime):
+def reschedule_to_time(update, context, rescheduleDate, order_id, rescheduleTime):
     try:
-        context.bot.send_chat_action(chat_id=get_chat_id(update, context), action=ChatAction.TYPING, timeout=1)
-        time.sleep(1)
-        date = datetime.datetime(int(dateString[0:4]), int(dateString[5:7]), int(dateString[8:10]))
-        firestore_db.collection(u'orders').document(order_id).update({
-            "deliveryDate": date.replace(hour=rescheduleTime)
-        })
-        if time == 9:
+        send_typing_action(update, context)
+        date = datetime.datetime(rescheduleDate.year, rescheduleDate.month, rescheduleDate.day)
+        order_dict = order_cache.get(order_id)
+        old_slot = slot_capacity.order_slot(order_dict)
+        new_slot = slot_capacity.slot_key(date.replace(hour=rescheduleTime), order_dict.get("zone"))
+        if new_slot != old_slot and not slot_capacity.reserve(new_slot):
+            keyboard = get_time_keyboard(update, context, date, order_id)
+            context.replies.send(SLOT_FULL_MESSAGE if keyboard is not None else ALL_SLOTS_FULL_MESSAGE,
+                                 reply_markup=keyboard or get_update_keyboard())
+            return
+        try:
+            numReschedules = order_cache.reschedule(order_id, date.replace(hour=rescheduleTime))
+        except Exception:
+            # The order didn't move, give its new place back
+            if new_slot != old_slot:
+                slot_capacity.release(new_slot)
+            raise
+        if numReschedules is None:
+            if new_slot != old_slot:
+                slot_capacity.release(new_slot)
+            send_top_up_offer(update, context, order_id)
+            return
+        if new_slot != old_slot:
+            slot_capacity.release(old_slot)
+        event_log.record(eventlog.RESCHEDULE, order_id, order_dict, to_date=date.replace(hour=rescheduleTime))
+        if rescheduleTime == 9:
             time_string = " between 9am to 12pm"
-        elif time == 12:
+        elif rescheduleTime == 12:
             time_string = " between 12pm to 3pm"
-        elif time == 15:
+        elif rescheduleTime == 15:
             time_string = " between 3pm to 6pm"
         else:
             time_string = " between 6pm to 10pm"
-        numReschedules = int(firestore_db.collection(u'orders').document(order_id).get().to_dict()['numReschedules']) - 1
-        firestore_db.collection(u'orders').document(order_id).update({
-            "numReschedules": str(numReschedules)
-        })
-        context.bot.send_message(chat_id=get_chat_id(update, context),
-                                 text=f"Your delivery has been rescheduled to " + (
-                                     date.strftime("%d/%m/%Y") + time_string + f"!\nYou now have {numReschedules} reschedules left.")
-                                 , reply_markup=get_update_keyboard())
+        context.replies.send(f"Your delivery has been rescheduled to " + (
+                                 date.strftime("%d/%m/%Y") + time_string + f"!\nYou now have {numReschedules} reschedules left.")
+                             , reply_markup=get_update_keyboard())
     except Exception as e:
         print(e)
-        context.bot.send_message(chat_id=get_chat_id(update, context),
-                                 text=UPGRADE_FAIL_MESSAGE)
+        context.replies.send(UPGRADE_FAIL_MESSAGE)
 
 def payment(update, context, current_type, new_type, type_description, order_id):
-    def get_price():
-        prices = {
-            "standard": 3,
-            "express": 5,
-            "timeslot": 7,
-            "14day-standard": 9,
-            "14day-timeslot": 11
-        }
-        return prices[new_type] - prices[current_type]
-
+    context.replies.flush()
     context.bot.send_invoice(chat_id=get_chat_id(update, context),
                              title=new_type,
                              description=type_description,
                              payload="ninja-scheduler/" + new_type + "/" + order_id,
                              provider_token="284685063:TEST:YTM1ZGYzNDlhMWI3",
                              currency="SGD",
-                             prices=[LabeledPrice("Payment for " + new_type + " delivery", get_price() * 100)],
+                             prices=[LabeledPrice("Payment for " + new_type + " delivery", tiers.upgrade_price(current_type, new_type) * 100)],
                              start_parameter="asdhjasdj")
 
 
@@ -484,9 +521,11 @@ def precheckout_callback(update, context):
         query.answer(ok=False, error_message="Something went wrong...")
     elif 'top-up' in query.invoice_payload:
         payload_split = update.pre_checkout_query.invoice_payload.split('/')
-        firestore_db.collection(u'orders').document(payload_split[2]).update({
+        order_dict = order_cache.get(payload_split[2])
+        order_cache.update(payload_split[2], {
             "numReschedules": 2
         })
+        event_log.record(eventlog.TOP_UP, payload_split[2], order_dict)
         query.answer(ok=True)
     else:
         payload_split = update.pre_checkout_query.invoice_payload.split('/')
@@ -495,9 +534,11 @@ def precheckout_callback(update, context):
 
 
 def update_db_after_payment(order_id, del_type):
-    firestore_db.collection(u'orders').document(order_id).update({
+    order_dict = order_cache.get(order_id)
+    order_cache.update(order_id, {
         "deliveryType": del_type
     })
+    event_log.record(eventlog.UPGRADE, order_id, order_dict, to_type=del_type)
 
 
 # finally, after contacting the payment provider...
@@ -506,63 +547,242 @@ def successful_payment_callback(update, context):
     # do something after successfully receiving payment?
     invoice_split = update.message.successful_payment.invoice_payload.split("/")
     order_id = invoice_split[2]
-    doc_ref = firestore_db.collection(u'orders').document(order_id)
-    order_dict = doc_ref.get().to_dict()
+    order_dict = order_cache.get(order_id)
     date_time = order_dict["deliveryDate"]
+    # The replies below and the start menu go out as one message
     if 'timeslot' in invoice_split[1]:
-        update.message.reply_text("Thank you for your payment! Please choose your timeslot by doing View Orders > "
-                                  "Choose your order id > Reschedule Order")
+        context.replies.send("Thank you for your payment! Please choose your timeslot by doing View Orders > "
+                             "Choose your order id > Reschedule Order")
     elif 'top-up' in update.message.successful_payment.invoice_payload:
-        update.message.reply_text("Thank you for your payment! You may now reschedule your order!")
+        context.replies.send("Thank you for your payment! You may now reschedule your order!")
     else:
         new_time = date_time.replace(hour=0)
-        update.message.reply_text("Thank you for your payment! Please choose your timeslot:")
-        context.bot.send_message(chat_id=get_chat_id(update, context),
-                                 text=f"Please select a time slot",
-                                 reply_markup=get_time_keyboard(update, context, date_time, order_id))
-        doc_ref.update({
+        keyboard = get_time_keyboard(update, context, date_time, order_id)
+        if keyboard is None:
+            context.replies.send("Thank you for your payment! " + ALL_SLOTS_FULL_MESSAGE)
+        else:
+            context.replies.send("Thank you for your payment! Please choose your timeslot:", reply_markup=keyboard)
+        order_cache.update(order_id, {
             "deliveryDate": new_time
         })
-        update.message.reply_text("Thank you for your payment!")
+        slot_capacity.release(slot_capacity.order_slot(order_dict))
     start(update, context)
 
 
+# Maps each callback action to its handler, called as handler(update, context, callback)
+CALLBACK_HANDLERS = {
+    callbackcodec.VIEW_ORDERS: lambda update, context, callback: view_orders(update, context),
+    callbackcodec.UPGRADE_ORDERS: lambda update, context, callback: upgrade_orders(update, context),
+    callbackcodec.VIEW_ORDER: lambda update, context, callback: get_order(update, context, callback.order_id),
+    callbackcodec.UPGRADE_ORDER: lambda update, context, callback: upgrade_order(update, context, callback.order_id),
+    callbackcodec.RESCHEDULE_ORDER:
+        lambda update, context, callback: show_reschedule_calendar(update, context, callback.order_id),
+    # Already answered by query_handler; greyed-out days and labels cost nothing else
+    callbackcodec.CALENDAR_IGNORE: lambda update, context, callback: None,
+    callbackcodec.CALENDAR_DAY: lambda update, context, callback: reschedule_order(update, context, callback.order_id),
+    callbackcodec.CALENDAR_PREV_MONTH:
+        lambda update, context, callback: reschedule_order(update, context, callback.order_id),
+    callbackcodec.CALENDAR_NEXT_MONTH:
+        lambda update, context, callback: reschedule_order(update, context, callback.order_id),
+    callbackcodec.UPGRADE_TO:
+        lambda update, context, callback: upgrade_to_tier(update, context, callback.order_id,
+                                                          UPGRADE_TIERS[callback.arg]),
+    callbackcodec.RESCHEDULE_TO_TIME:
+        lambda update, context, callback: reschedule_to_time(update, context, callback.date, callback.order_id,
+                                                             callback.arg),
+    callbackcodec.TOP_UP: lambda update, context, callback: top_up_reschedules(update, context, callback.order_id)
+}
+
+
+BULK_RESCHEDULE_USAGE = """Usage: /bulkreschedule <DD/MM/YYYY | id,id,...> <+N | -N | DD/MM/YYYY | tier> [tier]
+Moves every order due on that day (or the listed orders) by N days or to the given day, and/or changes their tier."""
+
+
+# Admin only: reschedule or change the tier of many orders at once
+# A run can take minutes, so it goes to the job queue's threads instead of holding up the chat's updates.
+# run_async would need a started Dispatcher, and the worker processes' Dispatchers are never started.
+def bulk_reschedule(update, context):
+    if update.message.chat.username not in ADMIN_USERNAMES:
+        return
+    context.job_queue.run_once(_bulk_reschedule_job, 0, context=(update, list(context.args)))
+
+
+def _bulk_reschedule_job(context):
+    update, args = context.job.context
+    run_bulk_reschedule(update, args)
+
+
+def run_bulk_reschedule(update, args):
+    try:
+        shift_days = new_date = new_type = None
+        for arg in args[1:]:
+            if arg in tiers.TIERS:
+                new_type = arg
+            elif arg[0] in "+-":
+                shift_days = int(arg)
+            else:
+                new_date = bulkreschedule.parse_date(arg)
+        if "/" in args[0]:
+            orders = list(bulkreschedule.query_orders(order_cache, bulkreschedule.parse_date(args[0])))
+        else:
+            orders = list(bulkreschedule.fetch_orders(order_cache, args[0].split(",")))
+    except (IndexError, ValueError):
+        update.message.reply_text(BULK_RESCHEDULE_USAGE)
+        return
+
+    changes, rejected = bulkreschedule.plan_changes(orders, shift_days, new_date, new_type)
+    status = update.message.reply_text("{} of {} orders can be changed, {} rejected{}".format(
+        len(changes), len(orders), len(rejected),
+        "".join("\n" + order_id + ": " + reason for order_id, reason in rejected[:20])))
+    order_dicts = dict(orders)
+    changed = []
+
+    def progress(done, total, elapsed):
+        status.edit_text(bulkreschedule.format_progress(done, total, elapsed))
+
+    def committed(chunk):
+        changed.extend(order_id for order_id, _ in chunk)
+        slot_capacity.apply_changes(orders, chunk)
+        for order_id, fields in chunk:
+            event_log.record(eventlog.BULK_CHANGE, order_id, order_dicts[order_id], fields.get("deliveryType"),
+                             fields["deliveryDate"])
+
+    try:
+        bulkreschedule.commit_changes(order_cache, changes, progress, committed)
+    except Exception as e:
+        print(e)
+        update.message.reply_text("Bulk reschedule stopped after {} of {} orders: {}".format(len(changed),
+                                                                                             len(changes), e))
+
+
+def format_reminder(order_id, order_dict):
+    return reminders.REMINDER_TEXT.format(
+        order_id, date_time_formatter(order_dict["deliveryDate"].strftime("%m/%d/%Y, %H:%M:%S")))
+
+
+def send_reminders(context):
+    reminders.send_reminders(context.bot, order_repository, user_repository, format_reminder, get_order_keyboard)
+
+
+def schedule_reminders(job_queue):
+    """Send the delivery-day reminders from job_queue once a day."""
+    if REMINDERS:
+        job_queue.run_daily(send_reminders, reminders.reminder_time(), name="reminders")
+
+
+def warm_up(bot):
+    """Open the storage and Telegram connections ahead of the first update."""
+    try:
+        order_repository.get("warm-up")
+        bot.get_me()
+    except Exception as e:
+        print(e)
+
+
 def error(update, context):
     """Log Errors caused by Updates."""
     logger.warning('Update "%s" caused error "%s"', update, context.error)
 
 
-def main():
-    """Start the bot."""
-    # Create the Updater and pass it your bot's token.
-    # Make sure to set use_context=True to use the new context based callbacks
-    # Post version 12 this will no longer be necessary
-    updater = Updater(TOKEN, use_context=True)
+def handler_callback(name, callback):
+    """Time the callback for /metrics; profiling sits outside, so writing a profile isn't counted."""
+    return profiler.profiled(name)(metrics.timed(name)(callback))
 
-    # Get the dispatcher to register handlers
-    dp = updater.dispatcher
 
+def add_handlers(dp):
+    """Register the bot's handlers on a Dispatcher."""
+    dedupe.add_handlers(dp)
     # on different commands - answer in Telegram
-    dp.add_handler(CommandHandler("start", start))
-    dp.add_handler(CallbackQueryHandler(query_handler))
+    dp.add_handler(CommandHandler("start", handler_callback("start", replybuffer.buffered(start))))
+    dp.add_handler(CommandHandler("bulkreschedule", handler_callback("bulk_reschedule", bulk_reschedule)))
+    dp.add_handler(CallbackQueryHandler(handler_callback("callback_query", replybuffer.buffered(query_handler))))
 
-    dp.add_handler(PreCheckoutQueryHandler(precheckout_callback))
-    dp.add_handler(MessageHandler(Filters.successful_payment, successful_payment_callback))
+    dp.add_handler(PreCheckoutQueryHandler(handler_callback("precheckout", precheckout_callback)))
+    dp.add_handler(MessageHandler(Filters.successful_payment,
+                                  handler_callback("successful_payment",
+                                                   replybuffer.buffered(successful_payment_callback))))
 
     # log all errors
     dp.add_error_handler(error)
 
+
+def make_bot():
+    # NinjaBot counts every Bot API call for /metrics and sends messages through the rate-limited send queue
+    return botclient.NinjaBot(TOKEN, send_queue=send_queue, request=Request(con_pool_size=TELEGRAM_POOL_SIZE))
+
+
+def make_dispatcher():
+    """Create the Dispatcher of a worker process."""
+    job_queue = JobQueue()
+    dispatcher = Dispatcher(make_bot(), None, job_queue=job_queue,
+                            persistence=sharedstate.StorePersistence(shared_state), use_context=True)
+    job_queue.set_dispatcher(dispatcher)
+    add_handlers(dispatcher)
+    if WARM_UP:
+        threading.Thread(target=warm_up, args=(dispatcher.bot,), name="warm_up", daemon=True).start()
+    return dispatcher
+
+
+def main():
+    """Start the bot."""
+    if ASYNC_ENGINE:
+        # Imported here, asyncengine builds on this module
+        import asyncengine
+        asyncengine.run(PORT, TOKEN, APP_NAME + TOKEN)
+        return
+
+    pool = None
+    if WORKERS > 1:
+        # Forked before the Updater starts any threads
+        pool = workers.WorkerPool(WORKERS, make_dispatcher, teardown=event_log.flush)
+        metrics.REGISTRY.add_collector(lambda: [
+            ("ninja_worker_queue_depth", "gauge", "Updates waiting for a worker process", pool.depth()),
+            ("ninja_worker_updates_total", "counter", "Updates handled by the worker processes",
+             pool.total_processed()),
+        ])
+        metrics.REGISTRY.add_snapshots(pool.metric_snapshots)
+
+    # Create the Updater and pass it your bot's token.
+    # Make sure to set use_context=True to use the new context based callbacks
+    # Post version 12 this will no longer be necessary
+    updater = Updater(bot=make_bot(), use_context=True,
+                      persistence=sharedstate.StorePersistence(shared_state))
+
+    if pool is not None:
+        # The webhook hands updates straight to the workers
+        updater.update_queue = pool
+    else:
+        # Get the dispatcher to register handlers
+        add_handlers(updater.dispatcher)
+        if webhookreply.ENABLED:
+            webhookreply.add_handlers(updater.dispatcher)
+
     # Start the Bot
     updater.start_webhook(listen="0.0.0.0",
                           port=PORT,
                           url_path=TOKEN)
 
     updater.bot.set_webhook(APP_NAME + TOKEN)
+    metrics.add_route(updater)
+    if STRIPE_WEBHOOK:
+        # Imported here, stripe is only needed with the webhook
+        from payments import stripePayment
+        stripePayment.add_route(updater, order_cache, event_log, user_repository)
+    # Only this process sends reminders, whether or not the updates go to workers
+    schedule_reminders(updater.job_queue)
+    # Inline answers need the update handled in this process
+    if webhookreply.ENABLED and pool is None:
+        webhookreply.add_route(updater, TOKEN)
+    if WARM_UP and pool is None:
+        threading.Thread(target=warm_up, args=(updater.bot,), name="warm_up", daemon=True).start()
 
     # # Run the bot until you press Ctrl-C or the process receives SIGINT,
     # # SIGTERM or SIGABRT. This should be used most of the time, since
     # # start_polling() is non-blocking and will stop the bot gracefully.
     updater.idle()
+    if pool is not None:
+        pool.stop()
+    event_log.flush()
 
 
 if __name__ == '__main__':
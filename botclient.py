@@ -0,0 +1,57 @@
+import time
+
+from telegram import Bot
+from telegram.error import RetryAfter, TelegramError
+
+import metrics
+import profiler
+import sendqueue
+import webhookreply
+
+# Calls that don't post a message to a chat and aren't held back by the send queue
+UNLIMITED_METHODS = frozenset(["getMe", "getMyCommands", "setWebhook", "deleteWebhook", "getWebhookInfo",
+                               "answerCallbackQuery", "answerPreCheckoutQuery", "sendChatAction"])
+MAX_ATTEMPTS = 3
+
+
+class NinjaBot(Bot):
+    """
+    telegram.Bot that counts and times every Bot API call for /metrics, hands the first call of an update
+    to webhookreply when inline webhook answers are on, and sends messages through a sendqueue.SendQueue,
+    retrying after 429s.
+    """
+
+    def __init__(self, token, send_queue=None, **kwargs):
+        super().__init__(token, **kwargs)
+        self.send_queue = send_queue
+
+    def _post(self, endpoint, data=None, timeout=None, api_kwargs=None):
+        with profiler.phase(profiler.TELEGRAM):
+            return self._queued_post(endpoint, data, timeout, api_kwargs)
+
+    def _queued_post(self, endpoint, data, timeout, api_kwargs):
+        metrics.TELEGRAM_CALLS.inc(method=endpoint)
+        if webhookreply.offer(endpoint, dict(data or {}, **(api_kwargs or {}))):
+            return True
+        limited = self.send_queue is not None and endpoint not in UNLIMITED_METHODS
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            if limited or attempt > 1:
+                self.send_queue.acquire((data or {}).get("chat_id"))
+            try:
+                return self._timed_post(endpoint, data, timeout, api_kwargs)
+            except RetryAfter as e:
+                sendqueue.RATE_LIMITED.inc(method=endpoint)
+                if self.send_queue is None or attempt == MAX_ATTEMPTS:
+                    raise
+                self.send_queue.pause(e.retry_after)
+
+    def _timed_post(self, endpoint, data, timeout, api_kwargs):
+        start = time.perf_counter()
+        try:
+            # Request.post rewrites data, keep the original for a retry
+            return super()._post(endpoint, dict(data) if data else data, timeout, api_kwargs)
+        except TelegramError as e:
+            metrics.TELEGRAM_ERRORS.inc(method=endpoint, exception=type(e).__name__)
+            raise
+        finally:
+            metrics.TELEGRAM_LATENCY.observe(time.perf_counter() - start, method=endpoint)
@@ -0,0 +1,179 @@
+"""
+Bulk reschedule / tier change for ops, e.g. when a hub closes or a public holiday moves.
+
+Orders are picked by id or by delivery date. Every order is checked against its tier's reschedule window
+in one pass over the whole batch, and the changes are committed in chunks of 500 (one Firestore WriteBatch each).
+
+Usage: python bulkreschedule.py (--ids ID [ID ...] | --on DD/MM/YYYY)
+                               [--shift-days N | --to DD/MM/YYYY] [--tier TIER] [--dry-run]
+"""
+import argparse
+import datetime
+import time
+
+import eventlog
+import slotcapacity
+import storage
+import tiers
+
+# Firestore accepts at most 500 writes per batch
+BATCH_SIZE = 500
+
+
+def parse_date(text):
+    return datetime.datetime.strptime(text, "%d/%m/%Y")
+
+
+def fetch_orders(order_repository, order_ids):
+    """ Yield (order_id, order_dict) for the given ids, reading BATCH_SIZE orders at a time."""
+    for i in range(0, len(order_ids), BATCH_SIZE):
+        for order_id, order_dict in order_repository.get_many(order_ids[i:i + BATCH_SIZE]).items():
+            if order_dict is not None:
+                yield order_id, order_dict
+
+
+def query_orders(order_repository, delivery_date):
+    """ Yield (order_id, order_dict) for every order due on the given day."""
+    start = delivery_date.replace(hour=0, minute=0, second=0, microsecond=0)
+    return order_repository.find_by_delivery_date(start, start + datetime.timedelta(days=1))
+
+
+def plan_changes(orders, shift_days=None, new_date=None, new_type=None, now=None):
+    """
+    Work out the new delivery date and tier of every order and check them against the tier windows.
+    :param list orders: (order_id, order_dict) pairs.
+    :param int shift_days: Move each order by this many days.
+    :param datetime.datetime new_date: Move every order to this day, keeping its time slot.
+    :param str new_type: Change every order to this delivery tier.
+    :return: Returns a tuple (changes, rejected), with changes as (order_id, fields) pairs and rejected
+                as (order_id, reason) pairs. Orders missing a date or of an unknown tier are rejected too.
+    """
+    rejected = []
+    valid = []
+    for order_id, order_dict in orders:
+        reason = malformed(order_dict, new_type)
+        if reason is None:
+            valid.append((order_id, order_dict))
+        else:
+            rejected.append((order_id, reason))
+    orders = valid
+
+    order_ids = [order_id for order_id, _ in orders]
+    current_dates = [order_dict['deliveryDate'].replace(tzinfo=None) for _, order_dict in orders]
+    pick_up_dates = [order_dict['pickUpDate'].replace(tzinfo=None) for _, order_dict in orders]
+    types = [new_type or order_dict['deliveryType'] for _, order_dict in orders]
+
+    if new_date is not None:
+        targets = [new_date.replace(hour=date.hour) for date in current_dates]
+    else:
+        shift = datetime.timedelta(days=shift_days or 0)
+        targets = [date + shift for date in current_dates]
+    # Orders moving off a timeslot tier no longer have a slot
+    targets = [target if tiers.TIERS[delivery_type].timeslot else target.replace(hour=0)
+               for target, delivery_type in zip(targets, types)]
+    days = [target.replace(hour=0, minute=0, second=0, microsecond=0) for target in targets]
+
+    min_dates, max_dates, _ = tiers.batch_windows_and_prices(types, pick_up_dates, now)
+    in_window = [min_date <= day <= max_date for day, min_date, max_date in zip(days, min_dates, max_dates)]
+
+    changes = []
+    for order_id, target, delivery_type, ok, min_date, max_date in zip(order_ids, targets, types, in_window,
+                                                                          min_dates, max_dates):
+        if ok:
+            fields = {"deliveryDate": target}
+            if new_type is not None:
+                fields["deliveryType"] = delivery_type
+            changes.append((order_id, fields))
+        else:
+            rejected.append((order_id, "{} is outside {} to {}".format(target.strftime("%d/%m/%Y"),
+                                                                       min_date.strftime("%d/%m/%Y"),
+                                                                       max_date.strftime("%d/%m/%Y"))))
+    return changes, rejected
+
+
+def malformed(order_dict, new_type=None):
+    """ Why plan_changes can't change the order, or None if it can."""
+    for field in ("deliveryDate", "pickUpDate"):
+        if not isinstance(order_dict.get(field), datetime.datetime):
+            return "malformed order, no {}".format(field)
+    if new_type is None and order_dict.get("deliveryType") not in tiers.TIERS:
+        return "malformed order, unknown tier {!r}".format(order_dict.get("deliveryType"))
+    return None
+
+
+def change_events(orders, changes):
+    """
+    Order events (see eventlog) of committed changes.
+    :param dict orders: {order_id: order_dict} before the changes.
+    :param list changes: (order_id, fields) pairs.
+    """
+    return [eventlog.make_event(eventlog.BULK_CHANGE, order_id, orders[order_id], fields.get("deliveryType"),
+                                fields["deliveryDate"])
+            for order_id, fields in changes]
+
+
+def commit_changes(order_repository, changes, progress=None, committed=None):
+    """
+    Write the changes BATCH_SIZE orders per commit.
+    :param list changes: (order_id, fields) pairs from plan_changes.
+    :param progress: Called as progress(done, total, elapsed_seconds) after every commit.
+    :param committed: Called as committed(chunk) with the (order_id, fields) pairs of every commit, so the
+                        changes that made it are followed up even if a later commit fails.
+    :return: Returns the throughput in orders/sec.
+    """
+    start = time.perf_counter()
+    done = 0
+    for i in range(0, len(changes), BATCH_SIZE):
+        chunk = changes[i:i + BATCH_SIZE]
+        order_repository.update_many(chunk)
+        done += len(chunk)
+        if committed is not None:
+            committed(chunk)
+        if progress is not None:
+            progress(done, len(changes), time.perf_counter() - start)
+    elapsed = time.perf_counter() - start
+    return done / elapsed if elapsed > 0 else 0.0
+
+
+def format_progress(done, total, elapsed):
+    rate = done / elapsed if elapsed > 0 else 0.0
+    return "{}/{} orders updated ({:.0f} orders/sec)".format(done, total, rate)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk reschedule or change the tier of orders")
+    selection = parser.add_mutually_exclusive_group(required=True)
+    selection.add_argument("--ids", nargs="+", help="order ids to change")
+    selection.add_argument("--on", type=parse_date, help="change every order due on this day (DD/MM/YYYY)")
+    change = parser.add_mutually_exclusive_group()
+    change.add_argument("--shift-days", type=int, help="move the orders by this many days")
+    change.add_argument("--to", type=parse_date, help="move the orders to this day (DD/MM/YYYY)")
+    parser.add_argument("--tier", choices=tiers.TIER_NAMES, help="change the orders to this delivery tier")
+    parser.add_argument("--dry-run", action="store_true", help="validate without writing")
+    args = parser.parse_args()
+    if args.shift_days is None and args.to is None and args.tier is None:
+        parser.error("nothing to change: pass --shift-days, --to or --tier")
+
+    order_repository, _ = storage.get_repositories()
+    orders = list(fetch_orders(order_repository, args.ids) if args.ids else query_orders(order_repository, args.on))
+    changes, rejected = plan_changes(orders, args.shift_days, args.to, args.tier)
+    for order_id, reason in rejected:
+        print("Rejected", order_id + ":", reason)
+    print(len(changes), "of", len(orders), "orders can be changed")
+    if args.dry_run or not changes:
+        return
+
+    slot_capacity = slotcapacity.get_slot_capacity()
+    event_repository = storage.get_event_repository()
+    order_dicts = dict(orders)
+
+    def committed(chunk):
+        slot_capacity.apply_changes(orders, chunk)
+        event_repository.append_many(change_events(order_dicts, chunk))
+
+    throughput = commit_changes(order_repository, changes, lambda *p: print(format_progress(*p)), committed)
+    print("Done at {:.0f} orders/sec".format(throughput))
+
+
+if __name__ == '__main__':
+    main()
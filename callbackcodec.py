@@ -0,0 +1,108 @@
+import base64
+import binascii
+import datetime
+import hashlib
+import struct
+from collections import namedtuple
+
+import sharedstate
+
+# Bump when the layout below changes; callbacks from an older layout decode to None.
+VERSION = 1
+
+# Action codes
+VIEW_ORDERS = 1
+UPGRADE_ORDERS = 2
+VIEW_ORDER = 3
+UPGRADE_ORDER = 4
+RESCHEDULE_ORDER = 5
+CALENDAR_IGNORE = 6
+CALENDAR_DAY = 7
+CALENDAR_PREV_MONTH = 8
+CALENDAR_NEXT_MONTH = 9
+UPGRADE_TO = 10
+RESCHEDULE_TO_TIME = 11
+TOP_UP = 12
+
+# Action names used in logs and metrics
+ACTION_NAMES = {
+    VIEW_ORDERS: "view_orders",
+    UPGRADE_ORDERS: "upgrade_orders",
+    VIEW_ORDER: "view_order",
+    UPGRADE_ORDER: "upgrade_order",
+    RESCHEDULE_ORDER: "reschedule_order",
+    CALENDAR_IGNORE: "calendar_ignore",
+    CALENDAR_DAY: "calendar_day",
+    CALENDAR_PREV_MONTH: "calendar_prev_month",
+    CALENDAR_NEXT_MONTH: "calendar_next_month",
+    UPGRADE_TO: "upgrade_to",
+    RESCHEDULE_TO_TIME: "reschedule_to_time",
+    TOP_UP: "top_up",
+}
+
+# Telegram rejects callback_data longer than 64 bytes
+MAX_CALLBACK_DATA = 64
+
+EPOCH = datetime.date(2000, 1, 1)
+NO_DATE = 0xFFFF
+
+# version, action, days since EPOCH, arg (time slot hour, tier code, ...); the order id follows as utf-8
+_HEADER = struct.Struct(">BBHB")
+MAX_ORDER_ID_BYTES = MAX_CALLBACK_DATA * 3 // 4 - _HEADER.size
+
+# Longer order ids are sent as LONG_ID_MARKER and a digest of the id, which decode looks up in long_order_ids,
+# a sharedstate store (the bot's shared state, so any worker can decode them)
+LONG_ID_MARKER = b"\x00"
+LONG_ID_NAMESPACE = "long_order_ids"
+long_order_ids = sharedstate.MemoryStore()
+# Digests this process has stored
+_stored_digests = set()
+
+Callback = namedtuple("Callback", ["action", "order_id", "date", "arg"])
+
+
+def encode(action, order_id="", date=None, arg=0):
+    """
+    Pack a callback into a compact url-safe base64 string for use as callback_data.
+    :param int action: One of the action codes above.
+    :param str order_id: Order the callback refers to, if any.
+    :param datetime.date date: Date the callback refers to, if any.
+    :param int arg: Small integer argument (0-255) such as a time slot hour or tier code.
+    :return: The encoded callback_data string.
+    """
+    order_key = order_id.encode("utf-8")
+    if len(order_key) > MAX_ORDER_ID_BYTES:
+        order_key = _long_id_key(order_id, order_key)
+    days = NO_DATE if date is None else (date - EPOCH).days
+    packed = _HEADER.pack(VERSION, action, days, arg) + order_key
+    return base64.urlsafe_b64encode(packed).rstrip(b"=").decode("ascii")
+
+
+def decode(data):
+    """
+    Unpack callback_data produced by encode.
+    :return: A Callback, or None if data is not a callback of the current version.
+    """
+    try:
+        packed = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+        version, action, days, arg = _HEADER.unpack_from(packed)
+        order_key = packed[_HEADER.size:]
+        order_id = None if order_key.startswith(LONG_ID_MARKER) else order_key.decode("utf-8")
+    except (binascii.Error, struct.error, UnicodeDecodeError, ValueError):
+        return None
+    if version != VERSION:
+        return None
+    if order_id is None:
+        order_id = long_order_ids.get(LONG_ID_NAMESPACE, order_key[len(LONG_ID_MARKER):].hex())
+        if order_id is None:
+            return None
+    date = None if days == NO_DATE else EPOCH + datetime.timedelta(days=days)
+    return Callback(action, order_id, date, arg)
+
+
+def _long_id_key(order_id, order_key):
+    digest = hashlib.blake2b(order_key, digest_size=16).hexdigest()
+    if digest not in _stored_digests:
+        long_order_ids.set(LONG_ID_NAMESPACE, digest, order_id)
+        _stored_digests.add(digest)
+    return LONG_ID_MARKER + bytes.fromhex(digest)
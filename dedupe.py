@@ -0,0 +1,116 @@
+"""
+Drops repeated updates before they reach the bot's handlers.
+
+Telegram delivers a webhook update again when the response is slow, and users tap the same inline button
+several times before the first tap is answered. Handled again, a repeat redoes its reads and writes: a second
+reschedule to the same slot uses up another reschedule, a second pre-checkout records the top-up twice.
+
+An update is a repeat when its update_id was seen in the last DEDUPE_UPDATE_WINDOW seconds (default 300), or,
+for a callback query, when the same button (callback data) was tapped in the same chat in the last
+DEDUPE_CALLBACK_WINDOW seconds (default 2). Each kind remembers at most DEDUPE_MAX_ENTRIES keys (default
+10000), oldest dropped first. Repeats are counted on /metrics, with the checks and the keys dropped before
+their window ended, to size the windows and the bound. Set DEDUPE=0 to handle every update.
+"""
+import collections
+import os
+import threading
+import time
+
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import DispatcherHandlerStop, TypeHandler
+
+import metrics
+import webhookreply
+import workers
+
+ENABLED = os.getenv("DEDUPE", "1") == "1"
+UPDATE_WINDOW = float(os.getenv("DEDUPE_UPDATE_WINDOW", "300"))
+CALLBACK_WINDOW = float(os.getenv("DEDUPE_CALLBACK_WINDOW", "2"))
+MAX_ENTRIES = int(os.getenv("DEDUPE_MAX_ENTRIES", "10000"))
+
+# Kinds of repeat
+UPDATE = "update"
+CALLBACK = "callback"
+
+CHECKS = metrics.REGISTRY.counter("ninja_dedupe_checks_total", "Keys checked for repeats", ["kind"])
+DUPLICATES = metrics.REGISTRY.counter("ninja_duplicate_updates_total", "Repeated updates dropped", ["kind"])
+EVICTIONS = metrics.REGISTRY.counter("ninja_dedupe_evictions_total",
+                                     "Keys forgotten before their window ended, to stay within the bound", ["kind"])
+
+
+class Deduplicator:
+    """ Remembers keys for window seconds, and at most max_entries of them."""
+
+    def __init__(self, kind, window, max_entries=MAX_ENTRIES):
+        self.kind = kind
+        self.window = window
+        self.max_entries = max_entries
+        # key -> time it is forgotten; every key has the same window, so the oldest come first
+        self._expiries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, key, now=None):
+        """
+        Check key and remember it.
+        :return: Returns True if key was seen within the window.
+        """
+        now = time.monotonic() if now is None else now
+        CHECKS.inc(kind=self.kind)
+        with self._lock:
+            while self._expiries and next(iter(self._expiries.values())) <= now:
+                self._expiries.popitem(last=False)
+            if key in self._expiries:
+                DUPLICATES.inc(kind=self.kind)
+                return True
+            self._expiries[key] = now + self.window
+            if len(self._expiries) > self.max_entries:
+                self._expiries.popitem(last=False)
+                EVICTIONS.inc(kind=self.kind)
+        return False
+
+    def __len__(self):
+        return len(self._expiries)
+
+
+updates = Deduplicator(UPDATE, UPDATE_WINDOW)
+callbacks = Deduplicator(CALLBACK, CALLBACK_WINDOW)
+
+metrics.REGISTRY.add_collector(lambda: [
+    ("ninja_dedupe_entries", "gauge", "Keys remembered for spotting repeated updates", len(updates) + len(callbacks)),
+])
+
+
+def repeat_kind(update):
+    """
+    Check an update against the ones seen before, and remember it.
+    :return: Returns UPDATE or CALLBACK if it is a repeat, else None.
+    """
+    if updates.seen(update.update_id):
+        return UPDATE
+    query = update.callback_query
+    if query is not None and query.data is not None and callbacks.seen((workers.shard_key(update), query.data)):
+        return CALLBACK
+    return None
+
+
+def drop_repeats(update, context):
+    """ TypeHandler callback stopping the handling of repeated updates."""
+    kind = repeat_kind(update)
+    if kind is None:
+        return
+    if kind == CALLBACK:
+        # The first tap gets the real answer; this one only stops the button's spinner
+        try:
+            context.bot.answer_callback_query(callback_query_id=update.callback_query.id)
+        except TelegramError:
+            pass
+    # The handlers that would answer inline don't run
+    webhookreply.close_current()
+    raise DispatcherHandlerStop
+
+
+def add_handlers(dispatcher):
+    """ Drop repeated updates ahead of the bot's handlers (group 0), after webhookreply's tracking."""
+    if ENABLED:
+        dispatcher.add_handler(TypeHandler(Update, drop_repeats), group=-1)
@@ -0,0 +1,135 @@
+"""
+Append-only log of what happens to orders, for ops analytics: reschedules, upgrades and top-ups, and the
+changes ops make in bulk.
+
+Order documents are overwritten in place, so the log is the only record of the changes. Handlers record an
+event next to each such write; a background thread appends the events to the storage.EventRepository in
+batches, keeping the write off the reply path. A batch that fails to write is retried, backing off up to
+RETRY_WAIT_MAX seconds, while newer events queue up behind it. The processes flush() the log when they shut
+down; only events queued when a process is killed outright are lost.
+export.py streams the log out for analysis.
+"""
+import datetime
+import queue
+import threading
+import time
+
+import metrics
+
+RESCHEDULE = "reschedule"
+UPGRADE = "upgrade"
+TOP_UP = "top_up"
+# bulkreschedule.py and /bulkreschedule
+BULK_CHANGE = "bulk_change"
+
+# Every event has these fields, so exports have the same columns whatever the mix of events
+EVENT_FIELDS = ("at", "type", "orderId", "owner", "fromType", "toType", "fromDate", "toDate")
+
+RETRY_WAIT_MAX = 60.0
+
+EVENTS_LOGGED = metrics.REGISTRY.counter("ninja_order_events_total", "Order events written to the event log",
+                                         ["type"])
+WRITE_FAILURES = metrics.REGISTRY.counter("ninja_order_event_write_failures_total",
+                                          "Failed writes of a batch of order events")
+
+
+def make_event(event_type, order_id, order_dict, to_type=None, to_date=None, at=None):
+    """
+    The event of a change to an order.
+    :param dict order_dict: The order before the change.
+    :param str to_type: The new deliveryType, if it changed.
+    :param datetime.datetime to_date: The new deliveryDate, if it changed.
+    """
+    return {
+        "at": at or datetime.datetime.now(),
+        "type": event_type,
+        "orderId": order_id,
+        "owner": order_dict.get("owner"),
+        "fromType": order_dict.get("deliveryType"),
+        "toType": to_type or order_dict.get("deliveryType"),
+        "fromDate": order_dict.get("deliveryDate"),
+        "toDate": to_date or order_dict.get("deliveryDate"),
+    }
+
+
+class EventLog:
+
+    def __init__(self, repository, batch_size=100, batch_wait=1.0, retry_wait=1.0):
+        """
+        :param storage.EventRepository repository: Where the events are appended.
+        :param int batch_size: Most events appended in one write.
+        :param float batch_wait: Seconds the writer waits for more events before appending a partial batch.
+        :param float retry_wait: Seconds before a failed batch is written again, doubling for every further try.
+        """
+        self.repository = repository
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.retry_wait = retry_wait
+        self._queue = queue.Queue()
+        self._writer = None
+        self._lock = threading.Lock()
+        # The batch the writer is waiting to retry, taken over by flush
+        self._unwritten = None
+
+    def record(self, event_type, order_id, order_dict, to_type=None, to_date=None):
+        """ Queue the event of a change to an order, see make_event."""
+        self._start()
+        self._queue.put(make_event(event_type, order_id, order_dict, to_type, to_date))
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def flush(self):
+        """ Append the queued events now, from the calling thread, e.g. when the process shuts down."""
+        with self._lock:
+            events, self._unwritten = self._unwritten or [], None
+        while True:
+            try:
+                events.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        for i in range(0, len(events), self.batch_size):
+            if not self._append(events[i:i + self.batch_size]):
+                print("Lost {} order events".format(len(events) - i))
+                return
+
+    def _start(self):
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write_forever, name="event-log", daemon=True)
+                    self._writer.start()
+
+    def _write_forever(self):
+        while True:
+            events = [self._queue.get()]
+            try:
+                while len(events) < self.batch_size:
+                    events.append(self._queue.get(timeout=self.batch_wait))
+            except queue.Empty:
+                pass
+            wait = self.retry_wait
+            while not self._append(events):
+                with self._lock:
+                    self._unwritten = events
+                time.sleep(wait)
+                wait = min(wait * 2, RETRY_WAIT_MAX)
+                with self._lock:
+                    if self._unwritten is not events:
+                        # Written by flush
+                        break
+                    self._unwritten = None
+
+    def _append(self, events):
+        """ :return: Returns False if the events could not be written."""
+        if not events:
+            return True
+        try:
+            self.repository.append_many(events)
+        except Exception as e:
+            WRITE_FAILURES.inc()
+            print("Could not write {} order events: {}".format(len(events), e))
+            return False
+        for event in events:
+            EVENTS_LOGGED.inc(type=event["type"])
+        return True
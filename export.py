@@ -0,0 +1,151 @@
+"""
+Export of orders or order events (see eventlog.py) for ops analytics, e.g. reschedules and upgrades per tier
+and per day.
+
+Rows are streamed from storage one page at a time, through the repositories' pagination cursors, and each
+page is written out before the next is read (one Parquet row group or Arrow record batch per page), so memory
+use does not grow with the number of rows. Parquet and Arrow IPC files need pyarrow; without it CSV is written.
+
+Usage: python export.py (orders | events) --from DD/MM/YYYY --to DD/MM/YYYY
+                        [--format parquet | arrow | csv] [--output PATH] [--page-size N]
+"""
+import argparse
+import csv
+import datetime
+
+import eventlog
+import storage
+
+# Column types, for the Arrow schema
+DATE = "date"
+INT = "int"
+STRING = "string"
+
+ORDER_COLUMNS = (("orderId", STRING), ("owner", STRING), ("deliveryType", STRING), ("deliveryDate", DATE),
+                 ("pickUpDate", DATE), ("numReschedules", INT), ("zone", STRING))
+EVENT_COLUMNS = tuple((field, DATE if field in ("at", "fromDate", "toDate") else STRING)
+                      for field in eventlog.EVENT_FIELDS)
+
+EXTENSIONS = {"parquet": ".parquet", "arrow": ".arrow", "csv": ".csv"}
+
+
+def _value(value):
+    # Firestore returns timestamps in UTC, the offline backends naive datetimes; a column holds one kind
+    if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+        return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def order_rows(pages):
+    """ Yield a list of row dicts for each page of (order_id, order_dict) pairs."""
+    for page in pages:
+        yield [dict({"orderId": order_id}, **{name: _value(order_dict.get(name)) for name, _ in ORDER_COLUMNS[1:]})
+               for order_id, order_dict in page]
+
+
+def event_rows(pages):
+    """ Yield a list of row dicts for each page of events."""
+    for page in pages:
+        yield [{name: _value(event.get(name)) for name, _ in EVENT_COLUMNS} for event in page]
+
+
+class CSVWriter:
+
+    def __init__(self, path, columns):
+        self._file = open(path, "w", newline="")
+        self._writer = csv.DictWriter(self._file, [name for name, _ in columns])
+        self._writer.writeheader()
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+
+class ArrowWriter:
+    """ Writes each page as a Parquet row group, or as a record batch of an Arrow IPC file."""
+
+    def __init__(self, path, columns, file_format):
+        import pyarrow
+
+        self._pyarrow = pyarrow
+        types = {DATE: pyarrow.timestamp("us"), INT: pyarrow.int64(), STRING: pyarrow.string()}
+        self.schema = pyarrow.schema([(name, types[column_type]) for name, column_type in columns])
+        if file_format == "parquet":
+            import pyarrow.parquet
+            self._writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+            self._write = lambda batch: self._writer.write_table(pyarrow.Table.from_batches([batch]))
+        else:
+            import pyarrow.ipc
+            self._writer = pyarrow.ipc.new_file(path, self.schema)
+            self._write = self._writer.write_batch
+
+    def write(self, rows):
+        self._write(self._pyarrow.RecordBatch.from_pylist(rows, schema=self.schema))
+
+    def close(self):
+        self._writer.close()
+
+
+def open_writer(path, columns, file_format):
+    """ A writer for the format; Parquet and Arrow fall back to CSV when pyarrow isn't installed."""
+    if file_format != "csv":
+        try:
+            return ArrowWriter(path, columns, file_format), path
+        except ImportError:
+            path = path.rsplit(".", 1)[0] + EXTENSIONS["csv"]
+            print("pyarrow is not installed, writing CSV to", path)
+    return CSVWriter(path, columns), path
+
+
+def export(row_pages, writer, progress=None):
+    """
+    Write every page of rows.
+    :param progress: Called as progress(rows_written) after every page.
+    :return: Returns the number of rows written.
+    """
+    written = 0
+    try:
+        for rows in row_pages:
+            if rows:
+                writer.write(rows)
+                written += len(rows)
+                if progress is not None:
+                    progress(written)
+    finally:
+        writer.close()
+    return written
+
+
+def parse_date(text):
+    return datetime.datetime.strptime(text, "%d/%m/%Y")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export orders or order events for analytics")
+    parser.add_argument("kind", choices=["orders", "events"],
+                        help="orders by delivery date, or reschedule/upgrade events by time")
+    parser.add_argument("--from", dest="start", type=parse_date, required=True, help="first day (DD/MM/YYYY)")
+    parser.add_argument("--to", dest="end", type=parse_date, required=True, help="last day (DD/MM/YYYY)")
+    parser.add_argument("--format", choices=sorted(EXTENSIONS), default="parquet")
+    parser.add_argument("--output", help="file to write, by default <kind><extension>")
+    parser.add_argument("--page-size", type=int, default=1000, help="rows read and written at a time")
+    args = parser.parse_args()
+
+    start, end = args.start, args.end + datetime.timedelta(days=1)
+    if args.kind == "orders":
+        order_repository, _ = storage.get_repositories()
+        row_pages = order_rows(order_repository.find_pages_by_delivery_date(start, end, args.page_size))
+        columns = ORDER_COLUMNS
+    else:
+        row_pages = event_rows(storage.get_event_repository().find_pages(start, end, args.page_size))
+        columns = EVENT_COLUMNS
+
+    writer, path = open_writer(args.output or args.kind + EXTENSIONS[args.format], columns, args.format)
+    written = export(row_pages, writer, lambda rows: print(rows, "rows written", end="\r"))
+    print("{} rows written to {}".format(written, path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+"""
+Prometheus-style metrics for the bot: handler latency histograms and counters for storage calls,
+Telegram API calls and exceptions, rendered in the text exposition format on /metrics.
+
+In multi-process mode the counters and histograms of the worker processes are sent to the webhook process
+as snapshots (see workers.py) and added to its own values when /metrics is rendered. Values reported by
+collectors are those of the webhook process.
+"""
+import bisect
+import contextlib
+import functools
+import threading
+import time
+
+import tornado.web
+
+import profiler
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _combine(values, snapshots, add):
+    """ values, a dict of metric values by labels, with the values of the snapshots added."""
+    combined = dict(values)
+    for snapshot in snapshots:
+        for key, value in snapshot.items():
+            combined[key] = add(combined[key], value) if key in combined else value
+    return combined
+
+
+def _format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace('"', '\\"')) for name, value in pairs) + "}"
+
+
+class Counter:
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels[name] for name in self.label_names), 0)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self, snapshots=()):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} counter".format(self.name)]
+        for key, value in sorted(_combine(self.snapshot(), snapshots, lambda a, b: a + b).items()):
+            lines.append("{}{} {}".format(self.name, _format_labels(self.label_names, key), value))
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            return {key: list(counts) for key, counts in self._values.items()}
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self, snapshots=()):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} histogram".format(self.name)]
+        values = _combine(self.snapshot(), snapshots, lambda a, b: [x + y for x, y in zip(a, b)])
+        for key, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(self.name, _format_labels(self.label_names, key,
+                                                                               [("le", bound)]), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, _format_labels(self.label_names, key), counts[-1]))
+            lines.append("{}_count{} {}".format(self.name, _format_labels(self.label_names, key), cumulative))
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._snapshot_sources = []
+
+    def counter(self, name, documentation, label_names=()):
+        metric = Counter(name, documentation, label_names)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, documentation, label_names, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """
+        Register a function called on every scrape, for values kept elsewhere (e.g. cache statistics).
+        :param collector: Returns a list of (name, type, documentation, value) tuples.
+        """
+        self._collectors.append(collector)
+
+    def add_snapshots(self, source):
+        """
+        Register a function called on every scrape for the metrics of other processes.
+        :param source: Returns a list of snapshots (see snapshot), whose values are added to this registry's.
+        """
+        self._snapshot_sources.append(source)
+
+    def snapshot(self):
+        """ The values of the counters and histograms by metric name, picklable to send to another process."""
+        return {metric.name: metric.snapshot() for metric in self._metrics}
+
+    def reset(self):
+        """ Forget the counters' and histograms' values, e.g. those a forked process inherited."""
+        for metric in self._metrics:
+            metric.reset()
+
+    def render(self):
+        lines = []
+        snapshots = [snapshot for source in self._snapshot_sources for snapshot in source()]
+        for metric in self._metrics:
+            lines.extend(metric.render([snapshot.get(metric.name, {}) for snapshot in snapshots]))
+        for collector in self._collectors:
+            for name, metric_type, documentation, value in collector():
+                lines.extend(["# HELP {} {}".format(name, documentation), "# TYPE {} {}".format(name, metric_type),
+                              "{} {}".format(name, value)])
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HANDLER_LATENCY = REGISTRY.histogram("ninja_handler_latency_seconds",
+                                     "Time spent handling an update, by handler or callback action", ["handler"])
+HANDLER_EXCEPTIONS = REGISTRY.counter("ninja_handler_exceptions_total",
+                                      "Exceptions raised by handlers", ["handler", "exception"])
+STORAGE_CALLS = REGISTRY.counter("ninja_storage_calls_total",
+                                 "Calls to the storage backend (Firestore RPCs in production)",
+                                 ["collection", "operation", "kind"])
+STORAGE_LATENCY = REGISTRY.histogram("ninja_storage_latency_seconds",
+                                     "Latency of calls to the storage backend", ["collection", "operation"])
+TELEGRAM_CALLS = REGISTRY.counter("ninja_telegram_calls_total", "Telegram Bot API calls", ["method"])
+TELEGRAM_LATENCY = REGISTRY.histogram("ninja_telegram_latency_seconds", "Latency of Telegram Bot API calls",
+                                      ["method"])
+TELEGRAM_ERRORS = REGISTRY.counter("ninja_telegram_errors_total", "Failed Telegram Bot API calls",
+                                   ["method", "exception"])
+
+
+@contextlib.contextmanager
+def track(handler):
+    """ Time a block of handler code and count any exception it raises."""
+    try:
+        with HANDLER_LATENCY.time(handler=handler):
+            yield
+    except Exception as e:
+        HANDLER_EXCEPTIONS.inc(handler=handler, exception=type(e).__name__)
+        raise
+
+
+def timed(handler):
+    """ Decorator form of track for handler callbacks."""
+    def decorator(callback):
+        @functools.wraps(callback)
+        def wrapper(*args, **kwargs):
+            with track(handler):
+                return callback(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+WRITE_OPERATIONS = frozenset(["put", "update", "update_many", "reschedule", "update_order_summaries"])
+
+
+class InstrumentedRepository:
+    """ Wraps a storage repository to count and time every call made through it."""
+
+    def __init__(self, repository, collection):
+        self._repository = repository
+        self._collection = collection
+
+    def __getattr__(self, name):
+        attr = getattr(self._repository, name)
+        if not callable(attr) or name.startswith("_"):
+            return attr
+        kind = "write" if name in WRITE_OPERATIONS else "read"
+
+        def instrumented(*args, **kwargs):
+            STORAGE_CALLS.inc(collection=self._collection, operation=name, kind=kind)
+            with STORAGE_LATENCY.time(collection=self._collection, operation=name), \
+                    profiler.phase(profiler.STORAGE):
+                return attr(*args, **kwargs)
+
+        return instrumented
+
+
+class AsyncInstrumentedRepository(InstrumentedRepository):
+    """ InstrumentedRepository for repositories whose methods are coroutines."""
+
+    def __getattr__(self, name):
+        attr = getattr(self._repository, name)
+        if not callable(attr) or name.startswith("_"):
+            return attr
+        kind = "write" if name in WRITE_OPERATIONS else "read"
+
+        async def instrumented(*args, **kwargs):
+            STORAGE_CALLS.inc(collection=self._collection, operation=name, kind=kind)
+            with STORAGE_LATENCY.time(collection=self._collection, operation=name):
+                return await attr(*args, **kwargs)
+
+        return instrumented
+
+
+def render():
+    return REGISTRY.render()
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(render())
+
+
+def add_route(updater, path="/metrics"):
+    """ Serve the metrics from the webhook server started by updater.start_webhook, once it has started."""
+    updater.httpd.http_server.request_callback.add_handlers(r".*", [(path, MetricsHandler)])
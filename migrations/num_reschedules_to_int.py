@@ -0,0 +1,68 @@
+"""
+One-off migration: convert orders whose numReschedules is stored as a string into an integer,
+so the counter has one type across orders; Firestore orders and compares values of different types apart.
+
+Usage: FIREBASE_CERT=<path> python migrations/num_reschedules_to_int.py [--dry-run]
+"""
+import argparse
+import os
+
+import firebase_admin
+from firebase_admin import credentials
+from firebase_admin import firestore
+
+BATCH_SIZE = 500
+
+
+def string_counters(firestore_db):
+    # Firestore orders values by type first, so ">= ''" matches exactly the orders whose
+    # numReschedules is a string without scanning the rest of the collection.
+    return firestore_db.collection(u'orders').where(u'numReschedules', u'>=', u'').stream()
+
+
+def migrate(firestore_db, dry_run=False):
+    """
+    :return: Returns (migrated, skipped): the number of orders converted, and the ids of the orders whose
+                numReschedules is not a number, which are left as they are.
+    """
+    batch = None if dry_run else firestore_db.batch()
+    pending = 0
+    migrated = 0
+    skipped = []
+    for snapshot in string_counters(firestore_db):
+        value = snapshot.get(u'numReschedules')
+        try:
+            number = int(value)
+        except ValueError:
+            print(snapshot.id, repr(value), "is not a number, skipped")
+            skipped.append(snapshot.id)
+            continue
+        print(snapshot.id, repr(value), "->", number)
+        migrated += 1
+        if dry_run:
+            continue
+        batch.update(snapshot.reference, {u'numReschedules': number})
+        pending += 1
+        if pending == BATCH_SIZE:
+            batch.commit()
+            batch = firestore_db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    return migrated, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true", help="list the orders without writing them")
+    args = parser.parse_args()
+
+    firebase_admin.initialize_app(credentials.Certificate(os.getenv("FIREBASE_CERT")))
+    migrated, skipped = migrate(firestore.client(), dry_run=args.dry_run)
+    print(("Would migrate" if args.dry_run else "Migrated"), migrated, "orders")
+    if skipped:
+        print(len(skipped), "orders need fixing by hand:", ", ".join(skipped))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+One-off migration: set the owner of every order listed in a user's orders, and rewrite the user's order
+summaries from the orders. Older orders have no owner, so reschedules, upgrades and top-ups don't refresh
+their summaries and reminders don't reach their owners.
+
+Usage: FIREBASE_CERT=<path> python migrations/order_owners.py [--dry-run]
+"""
+import argparse
+import os
+import sys
+
+import firebase_admin
+from firebase_admin import credentials
+from firebase_admin import firestore
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from storage.base import order_summary  # noqa: E402
+
+BATCH_SIZE = 500
+
+
+def migrate(firestore_db, dry_run=False):
+    """
+    :return: Returns (migrated, conflicts): the number of orders given an owner, and the ids of the orders
+                that already belong to another user or are listed by several users, which are left as they are.
+    """
+    batch = None if dry_run else firestore_db.batch()
+    pending = 0
+    migrated = 0
+    conflicts = []
+    owners = {}
+    orders = firestore_db.collection(u'orders')
+
+    def write(reference, fields):
+        nonlocal batch, pending
+        if dry_run:
+            return
+        batch.set(reference, fields, merge=True)
+        pending += 1
+        if pending == BATCH_SIZE:
+            batch.commit()
+            batch = firestore_db.batch()
+            pending = 0
+
+    for user in firestore_db.collection(u'users').stream():
+        order_ids = user.to_dict().get(u'orders', [])
+        if not order_ids:
+            continue
+        summaries = {}
+        for snapshot in firestore_db.get_all([orders.document(order_id) for order_id in order_ids]):
+            order_dict = snapshot.to_dict()
+            if order_dict is None:
+                print(user.id, "lists", snapshot.id, "which does not exist")
+                continue
+            owner = owners.setdefault(snapshot.id, order_dict.get(u'owner') or user.id)
+            if owner != user.id:
+                print(snapshot.id, "is listed by", user.id, "but belongs to", owner, "- skipped")
+                conflicts.append(snapshot.id)
+                continue
+            summaries[snapshot.id] = order_summary(order_dict)
+            if order_dict.get(u'owner') != user.id:
+                print(snapshot.id, "->", user.id)
+                migrated += 1
+                write(snapshot.reference, {u'owner': user.id})
+        if summaries:
+            write(user.reference, {u'orderSummaries': summaries})
+    if pending:
+        batch.commit()
+    return migrated, conflicts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true", help="list the orders without writing them")
+    args = parser.parse_args()
+
+    firebase_admin.initialize_app(credentials.Certificate(os.getenv("FIREBASE_CERT")))
+    migrated, conflicts = migrate(firestore.client(), dry_run=args.dry_run)
+    print(("Would give" if args.dry_run else "Gave"), migrated, "orders an owner")
+    if conflicts:
+        print(len(conflicts), "orders need fixing by hand:", ", ".join(conflicts))
+
+
+if __name__ == '__main__':
+    main()
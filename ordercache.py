@@ -0,0 +1,168 @@
+import threading
+import time
+from collections import OrderedDict
+
+from storage.base import OrderRepository
+
+
+class OrderCache(OrderRepository):
+    """
+    In-process read-through cache in front of an OrderRepository.
+    Entries are evicted least-recently-used once max_size is reached and expire after ttl seconds. Our own
+    writes are written through immediately; writes made elsewhere (ops scripts, other worker processes) are
+    picked up once the entry expires, so ttl bounds how stale an entry can get.
+    A write that lands while a read of the same order is in flight bumps the order's generation, and the
+    possibly older value read is then returned but not cached.
+    """
+
+    def __init__(self, repository, max_size=1024, ttl=300):
+        """
+        :param OrderRepository repository: Where the orders are stored.
+        :param int max_size: Maximum number of orders kept in memory.
+        :param float ttl: Seconds an entry is served before it is read again.
+        """
+        self.repository = repository
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # order_id -> (expires_at, order_dict)
+        # order_id -> [reads in flight, generation], kept only while the order is being read
+        self._reads = {}
+        self._lock = threading.Lock()
+
+    def get(self, order_id):
+        """ Return the order as a dict, reading from the repository only on a miss."""
+        with self._lock:
+            entry = self._entries.get(order_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(order_id)
+                self.hits += 1
+                return dict(entry[1])
+            self.misses += 1
+            generations = self._begin_reads([order_id])
+
+        order_dict = None
+        try:
+            order_dict = self.repository.get(order_id)
+        finally:
+            self._end_reads(generations, {order_id: order_dict})
+        return order_dict
+
+    def get_many(self, order_ids):
+        """
+        Return {order_id: order_dict} for all the given orders.
+        Every order that is not cached is fetched in a single batched read.
+        """
+        orders = {}
+        missing = []
+        now = time.monotonic()
+        with self._lock:
+            # Each read is counted once per order, see _begin_reads
+            for order_id in dict.fromkeys(order_ids):
+                entry = self._entries.get(order_id)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(order_id)
+                    self.hits += 1
+                    orders[order_id] = dict(entry[1])
+                else:
+                    self.misses += 1
+                    missing.append(order_id)
+            generations = self._begin_reads(missing)
+
+        if missing:
+            fetched = {}
+            try:
+                fetched = self.repository.get_many(missing)
+            finally:
+                self._end_reads(generations, fetched)
+            orders.update(fetched)
+        return orders
+
+    def put(self, order_id, order_dict):
+        self.repository.put(order_id, order_dict)
+        self.invalidate(order_id)
+
+    def update(self, order_id, fields):
+        """ Update the order in the repository and write the new values through to the cache."""
+        self.repository.update(order_id, fields)
+        self._write_through(order_id, fields)
+
+    def update_many(self, changes):
+        self.repository.update_many(changes)
+        for order_id, fields in changes:
+            self._write_through(order_id, fields)
+
+    def reschedule(self, order_id, delivery_date):
+        """
+        Move the order to delivery_date and use up one of its reschedules, atomically.
+        :return: The number of reschedules left, or None if the order had none left to use.
+        """
+        num_left = self.repository.reschedule(order_id, delivery_date)
+        if num_left is None:
+            self.invalidate(order_id)
+            return None
+        self._write_through(order_id, {"deliveryDate": delivery_date, "numReschedules": num_left})
+        return num_left
+
+    def find_by_delivery_date(self, start, end):
+        return self.repository.find_by_delivery_date(start, end)
+
+    def find_by_owner(self, owner):
+        return self.repository.find_by_owner(owner)
+
+    def invalidate(self, order_id):
+        with self._lock:
+            self._entries.pop(order_id, None)
+            self._written(order_id)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _begin_reads(self, order_ids):
+        """ Note reads of the orders starting, with the lock held; returns their current generations."""
+        generations = {}
+        for order_id in order_ids:
+            read = self._reads.setdefault(order_id, [0, 0])
+            read[0] += 1
+            generations[order_id] = read[1]
+        return generations
+
+    def _end_reads(self, generations, order_dicts):
+        """ Cache what the reads returned, unless the order was written while it was being read."""
+        with self._lock:
+            for order_id, generation in generations.items():
+                read = self._reads[order_id]
+                order_dict = order_dicts.get(order_id)
+                if order_dict is not None and read[1] == generation:
+                    self._store(order_id, order_dict)
+                read[0] -= 1
+                if read[0] == 0:
+                    del self._reads[order_id]
+
+    def _written(self, order_id):
+        # With the lock held
+        read = self._reads.get(order_id)
+        if read is not None:
+            read[1] += 1
+
+    def _store(self, order_id, order_dict):
+        # With the lock held
+        self._entries[order_id] = (time.monotonic() + self.ttl, dict(order_dict))
+        self._entries.move_to_end(order_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _write_through(self, order_id, fields):
+        with self._lock:
+            entry = self._entries.get(order_id)
+            if entry is not None:
+                entry[1].update(fields)
+            self._written(order_id)
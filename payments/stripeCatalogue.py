@@ -0,0 +1,95 @@
+"""
+Caches that keep Stripe API calls off the interactive upgrade path.
+
+PriceCatalogue holds the Stripe price list, refreshed in the background every ttl seconds. Prices are matched
+to delivery tiers by their lookup_key, and a price that disagrees with the tier price charged in bot.payment()
+is reported on every refresh. SessionCache hands out the same open checkout session for repeated taps by one
+user on one order and price, instead of creating a new Stripe object each time.
+"""
+import threading
+import time
+
+import tiers
+
+
+class PriceCatalogue:
+
+    def __init__(self, list_prices, ttl=600):
+        """
+        :param list_prices: Called with no arguments, returns the Stripe prices, e.g. stripe.Price.list.
+        :param int ttl: Seconds between refreshes.
+        """
+        self.list_prices = list_prices
+        self.ttl = ttl
+        self._prices = None
+        self._by_tier = {}
+        self._lock = threading.Lock()
+        self._refresher = None
+
+    def get(self):
+        """ The cached prices, loaded on the first call, which also starts the background refresh."""
+        if self._prices is None:
+            with self._lock:
+                if self._prices is None:
+                    self.refresh()
+                    self._refresher = threading.Thread(target=self._refresh_forever, name="stripe-prices",
+                                                       daemon=True)
+                    self._refresher.start()
+        return self._prices
+
+    def price_for_tier(self, tier):
+        """ The Stripe price whose lookup_key is the tier's name, or None."""
+        self.get()
+        return self._by_tier.get(tier)
+
+    def refresh(self):
+        prices = list(self.list_prices())
+        by_tier = {price.get('lookup_key'): price for price in prices if price.get('lookup_key') in tiers.TIERS}
+        for tier, price in by_tier.items():
+            expected = tiers.TIERS[tier].price * 100
+            if price.get('unit_amount') != expected:
+                print("Stripe price {} for {} is {}, expected {}".format(price.get('id'), tier,
+                                                                         price.get('unit_amount'), expected))
+        self._prices, self._by_tier = prices, by_tier
+
+    def _refresh_forever(self):
+        while True:
+            time.sleep(self.ttl)
+            try:
+                self.refresh()
+            except Exception as e:
+                # Keep serving the last good catalogue
+                print(e)
+
+
+class SessionCache:
+
+    def __init__(self, ttl=600):
+        """
+        :param int ttl: Seconds a checkout session is reused for, well inside Stripe's own session expiry.
+        """
+        self.ttl = ttl
+        self._sessions = {}  # (user, order_id, price_id) -> (url, expires_at)
+        self._lock = threading.Lock()
+
+    def get_or_create(self, key, create):
+        """
+        The url of the open session for key, or of a new one from create() if there is none.
+        :param tuple key: (user, order_id, price_id).
+        :param create: Called with no arguments, returns the checkout session url.
+        """
+        now = time.monotonic()
+        with self._lock:
+            cached = self._sessions.get(key)
+            if cached is not None and cached[1] > now:
+                return cached[0]
+        url = create()
+        with self._lock:
+            self._sessions = {k: v for k, v in self._sessions.items() if v[1] > now}
+            self._sessions[key] = (url, now + self.ttl)
+        return url
+
+    def forget(self, key):
+        """ Drop the session for key, e.g. once it has been paid."""
+        with self._lock:
+            self._sessions.pop(key, None)
@@ -0,0 +1,185 @@
+"""
+Background processing of Stripe webhook events.
+
+The webhook only verifies an event and hands it to an EventQueue. Worker threads take the queued events in
+batches and fulfil them with one batched write. Stripe delivers events at least once, so ids of handled
+events are kept in ProcessedEvents, a bounded in-memory LRU backed by a SQLite table that survives restarts,
+and repeats are dropped.
+
+The webhook has acknowledged an event before it is fulfilled, so Stripe never sends it again. Events are
+therefore written to the SQLite file as pending before the webhook answers, and only removed once fulfilled;
+pending events, whether still queued when the process stopped or failed, are queued again when it starts.
+When a batch fails its events are retried one at a time, so one bad order doesn't hold up the others;
+fulfilment only sets fields, so applying an event twice is harmless.
+"""
+import collections
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+import metrics
+
+EVENTS = metrics.REGISTRY.counter("ninja_stripe_events_total", "Stripe webhook events by type and outcome",
+                                  ["type", "outcome"])
+WEBHOOK_LATENCY = metrics.REGISTRY.histogram("ninja_stripe_webhook_seconds",
+                                             "Time to verify and acknowledge a Stripe webhook call")
+FULFILMENT_LATENCY = metrics.REGISTRY.histogram("ninja_stripe_fulfilment_seconds",
+                                                "Time from receiving a Stripe event to fulfilling it")
+
+# Stripe retries for up to 3 days
+RETENTION_SECONDS = 7 * 24 * 3600
+
+
+class ProcessedEvents:
+    """ Ids of Stripe events already handled."""
+
+    def __init__(self, path, max_size=10000):
+        self.max_size = max_size
+        self._recent = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS stripe_events (id TEXT PRIMARY KEY, handled REAL)")
+        # Events taken but not fulfilled yet, with the error of the last try if it failed
+        self._connection.execute("CREATE TABLE IF NOT EXISTS pending_stripe_events "
+                                 "(id TEXT PRIMARY KEY, event TEXT NOT NULL, received REAL, error TEXT)")
+        # Files written before pending events were kept only had the failed ones
+        if self._connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'failed_stripe_events'").fetchone():
+            self._connection.execute("INSERT OR IGNORE INTO pending_stripe_events "
+                                     "SELECT id, event, failed, error FROM failed_stripe_events")
+            self._connection.execute("DROP TABLE failed_stripe_events")
+        self._connection.execute("DELETE FROM stripe_events WHERE handled < ?", (time.time() - RETENTION_SECONDS,))
+        self._connection.commit()
+
+    def claim(self, event):
+        """
+        Mark an event as taken, keeping it as pending until mark_handled; it is on disk once this returns.
+        :return: Returns False if the event was taken before, in this process or a previous one.
+        """
+        event_id = event['id']
+        with self._lock:
+            if event_id in self._recent:
+                self._recent.move_to_end(event_id)
+                return False
+            self._remember(event_id)
+            if self._connection.execute("SELECT 1 FROM stripe_events WHERE id = ?", (event_id,)).fetchone():
+                return False
+            cursor = self._connection.execute("INSERT OR IGNORE INTO pending_stripe_events VALUES (?, ?, ?, NULL)",
+                                              (event_id, json.dumps(event), time.time()))
+            self._connection.commit()
+            return cursor.rowcount == 1
+
+    def mark_handled(self, event_ids):
+        """ Record fulfilled events so they are still recognised after a restart."""
+        now = time.time()
+        with self._lock:
+            self._connection.executemany("INSERT OR IGNORE INTO stripe_events VALUES (?, ?)",
+                                         [(event_id, now) for event_id in event_ids])
+            self._connection.executemany("DELETE FROM pending_stripe_events WHERE id = ?",
+                                         [(event_id,) for event_id in event_ids])
+            self._connection.commit()
+
+    def mark_failed(self, event, error):
+        """ Note why a pending event could not be fulfilled; it stays pending, to be replayed."""
+        with self._lock:
+            self._connection.execute("UPDATE pending_stripe_events SET error = ? WHERE id = ?",
+                                     (str(error), event['id']))
+            self._connection.commit()
+
+    def pending(self):
+        """ The events taken but not fulfilled, oldest first."""
+        with self._lock:
+            rows = self._connection.execute("SELECT event FROM pending_stripe_events ORDER BY received").fetchall()
+        return [json.loads(event) for event, in rows]
+
+    def _remember(self, event_id):
+        self._recent[event_id] = True
+        if len(self._recent) > self.max_size:
+            self._recent.popitem(last=False)
+
+
+class EventQueue:
+    """ Worker threads that fulfil queued events in batches."""
+
+    def __init__(self, processed_events, fulfil, workers=2, batch_size=100, batch_wait=0.05, attempts=3,
+                 retry_wait=1.0):
+        """
+        :param ProcessedEvents processed_events: Where handled and failed events are recorded.
+        :param fulfil: Called as fulfil(events) with a list of Stripe events from a worker thread.
+        :param float batch_wait: Seconds a worker waits for more events before fulfilling a batch.
+        :param int attempts: Tries at fulfilling an event on its own, once its batch failed.
+        :param float retry_wait: Seconds before the second try, doubling for every further one.
+        """
+        self.processed_events = processed_events
+        self.fulfil = fulfil
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.attempts = attempts
+        self.retry_wait = retry_wait
+        self._queue = queue.Queue()
+        # Left over from an earlier run, queued or failed; they are claimed already, so they skip put
+        for event in processed_events.pending():
+            self._queue.put((event, time.perf_counter()))
+        self._workers = [threading.Thread(target=self._work, name="stripe-events-{}".format(i), daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def put(self, event):
+        """
+        Queue a verified event unless it is a repeat.
+        :return: Returns False if the event was dropped as a duplicate.
+        """
+        if not self.processed_events.claim(event):
+            EVENTS.inc(type=event['type'], outcome="duplicate")
+            return False
+        self._queue.put((event, time.perf_counter()))
+        return True
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def _work(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self.fulfil([event for event, _ in batch])
+            except Exception as e:
+                print("Could not fulfil {} Stripe events, retrying them one by one: {}".format(len(batch), e))
+                for event, received in batch:
+                    self._fulfil_alone(event, received)
+                continue
+            self._handled(batch)
+
+    def _fulfil_alone(self, event, received):
+        for attempt in range(1, self.attempts + 1):
+            try:
+                self.fulfil([event])
+            except Exception as e:
+                error = e
+                if attempt < self.attempts:
+                    time.sleep(self.retry_wait * 2 ** (attempt - 1))
+                continue
+            self._handled([(event, received)])
+            return
+        print("Could not fulfil Stripe event {}, kept for replay: {}".format(event['id'], error))
+        self.processed_events.mark_failed(event, error)
+        EVENTS.inc(type=event['type'], outcome="failed")
+
+    def _handled(self, batch):
+        self.processed_events.mark_handled([event['id'] for event, _ in batch])
+        now = time.perf_counter()
+        for event, received in batch:
+            EVENTS.inc(type=event['type'], outcome="handled")
+            FULFILMENT_LATENCY.observe(now - received)
@@ -1,44 +1,99 @@
+"""
+Upgrades paid through Stripe Checkout: checkout sessions for an order's new tier, and the webhook Stripe
+calls once a payment completes or fails. Turned on with STRIPE_WEBHOOK=1, which serves the webhook on
+STRIPE_WEBHOOK_PATH of the bot's webhook port.
+"""
 import os
-from flask import request
-import stripe
 
-from bot import app
+import tornado.web
+from telegram.error import TelegramError
+
+import eventlog
+import metrics
+from payments import stripeCatalogue, stripeEvents
 
 STRIPE_KEY = os.getenv('STRIPE_KEY')
+STRIPE_WEBHOOK_PATH = os.getenv('STRIPE_WEBHOOK_PATH', '/stripe/webhook')
+
+# Checkout events that pay for a session; with an async payment method (bank debits, vouchers) a completed
+# session is still unpaid, and async_payment_succeeded or async_payment_failed follows
+PAID_EVENTS = frozenset(['checkout.session.completed', 'checkout.session.async_payment_succeeded'])
+PAID_STATUSES = frozenset(['paid', 'no_payment_required'])
+# Checkout events that end a session without a payment
+FAILURE_EVENTS = frozenset(['checkout.session.async_payment_failed', 'checkout.session.expired'])
+
+PAYMENT_FAILED_MESSAGE = "Your payment for order {} did not go through, so it has not been upgraded. " \
+                         "Please try upgrading it again."
+
+_stripe = None
+
+
+# stripe is imported and given the API key on first use instead of at start-up
+def get_stripe():
+    global _stripe
+    if _stripe is None:
+        import stripe
+        stripe.api_key = STRIPE_KEY
+        _stripe = stripe
+    return _stripe
+
+price_catalogue = stripeCatalogue.PriceCatalogue(lambda: get_stripe().Price.list().auto_paging_iter(),
+                                                 ttl=int(os.getenv('STRIPE_PRICE_TTL', '600')))
+checkout_sessions = stripeCatalogue.SessionCache(ttl=int(os.getenv('STRIPE_SESSION_TTL', '600')))
+
 
 def get_delivery_types():
-    stripe.api_key = os.getenv('STRIPE_KEY')
-    return stripe.Price.list()
+    return price_catalogue.get()
 
 # Gets checkout session url for user to navigate to
-def create_checkout_session(priceId):
-    stripe.api_key = os.getenv('STRIPE_KEY')
+# order_id and deliveryType are passed back in the session's metadata to fulfil the payment; with a user,
+# repeated calls for the same order and price reuse the open session
+def create_checkout_session(priceId, order_id=None, deliveryType=None, user=None):
     try:
-        checkout_session = stripe.checkout.Session.create(
-            line_items=[
-                {
-                    # Provide the exact Price ID (for example, pr_1234) of the product you want to sell
-                    'price': priceId,
-                    'quantity': 1,
-                },
-            ],
-            mode='payment',
-            success_url='https://t.me/ninja_scheduler_bot',
-            cancel_url='https://t.me/ninja_scheduler_bot',
-        )
+        if user is None or order_id is None:
+            return _create_checkout_session(priceId, order_id, deliveryType, user)
+        return checkout_sessions.get_or_create(
+            (str(user), order_id, priceId), lambda: _create_checkout_session(priceId, order_id, deliveryType, user))
     except Exception as e:
         return str(e)
 
+
+def _create_checkout_session(priceId, order_id, deliveryType, user):
+    stripe = get_stripe()
+    metadata = {'order_id': order_id, 'deliveryType': deliveryType, 'user': user, 'price': priceId}
+    checkout_session = stripe.checkout.Session.create(
+        metadata={key: value for key, value in metadata.items() if value is not None} if order_id else {},
+        line_items=[
+            {
+                # Provide the exact Price ID (for example, pr_1234) of the product you want to sell
+                'price': priceId,
+                'quantity': 1,
+            },
+        ],
+        mode='payment',
+        success_url='https://t.me/ninja_scheduler_bot',
+        cancel_url='https://t.me/ninja_scheduler_bot',
+    )
     return checkout_session.url
 
 # Webhook that stripe calls upon success/failed payment by user
-@app.route('/webhook', methods=['POST'])
-def post_payment():
-    stripe.api_key = os.getenv('STRIPE_KEY')
-    payload = request.get_data(as_text=True)
-    sig_header = request.headers.get('Stripe-Signature')
-    event = None
+# Events are only verified here and acknowledged; fulfilment happens on the event queue's workers
+class StripeWebhookHandler(tornado.web.RequestHandler):
 
+    def initialize(self, event_queue):
+        self.event_queue = event_queue
+
+    def post(self):
+        with stripeEvents.WEBHOOK_LATENCY.time():
+            status, text = verify_and_queue(self.event_queue, self.request.body.decode(),
+                                            self.request.headers.get('Stripe-Signature'))
+        self.set_status(status)
+        self.write(text)
+
+
+def verify_and_queue(event_queue, payload, sig_header):
+    """ :return: Returns the (status, body) of the webhook response."""
+    stripe = get_stripe()
     try:
         event = stripe.Webhook.construct_event(
             payload, sig_header, os.getenv('ENDPOINT_SECRET')
@@ -46,30 +101,106 @@ def post_payment():
 
     except ValueError as e:
         # Invalid payload
-        return 'Invalid payload', 400
+        return 400, 'Invalid payload'
     except stripe.error.SignatureVerificationError as e:
         # Invalid signature
-        return 'Invalid signature', 400
+        return 400, 'Invalid signature'
+
+    event_queue.put(event)
+    return 200, 'Success'
+
 
-    # Handle the checkout.session.completed event
-    if event['type'] == 'checkout.session.completed':
-        session = event['data']['object']
-        # Fulfill the purchase...
-        payment_success(session)
-    else:
-        session = event['data']['object']
-        payment_failure(session)
+class Fulfilment:
+    """ Applies Stripe events to the orders."""
 
-    return 'Success', 200
+    def __init__(self, order_repository, event_log, user_repository, bot):
+        """
+        :param order_repository: Where the orders are updated (the bot's order cache).
+        :param eventlog.EventLog event_log: Where upgrades are recorded.
+        :param user_repository: For the chat to tell users about failed payments.
+        :param bot: The telegram.Bot to tell them with.
+        """
+        self.order_repository = order_repository
+        self.event_log = event_log
+        self.user_repository = user_repository
+        self.bot = bot
+
+    def fulfil_events(self, events):
+        """ Apply a batch of Stripe events, with every deliveryType change in one batched write."""
+        changes = []
+        failures = []
+        for event in events:
+            session = event['data']['object']
+            if event['type'] in PAID_EVENTS and session.get('payment_status') in PAID_STATUSES:
+                change = payment_success(session)
+                if change is not None:
+                    changes.append(change)
+            elif event['type'] == 'checkout.session.completed':
+                print("Awaiting payment for checkout session", session.get('id'))
+            elif event['type'] in FAILURE_EVENTS:
+                failures.append(session)
+            else:
+                print("Ignored Stripe event", event['type'])
+        if changes:
+            order_dicts = self.order_repository.get_many([order_id for order_id, _ in changes])
+            self.order_repository.update_many(changes)
+            for order_id, fields in changes:
+                self.event_log.record(eventlog.UPGRADE, order_id, order_dicts.get(order_id) or {},
+                                      to_type=fields["deliveryType"])
+            print("Updated delivery type of", len(changes), "orders.")
+        for session in failures:
+            self.payment_failure(session)
+
+    def payment_failure(self, session):
+        """ Drop the failed session, so the next try gets a new one, and tell the user if we know their chat."""
+        metadata = session.get('metadata') or {}
+        print("Payment failed for order {}: {}".format(metadata.get('order_id'), session.get('id')))
+        if not metadata.get('order_id'):
+            return
+        order_dict = self.order_repository.get(metadata['order_id']) or {}
+        if order_dict.get('checkoutSession') == session.get('id'):
+            # Paid and fulfilled before, the user was not let down
+            return
+        checkout_sessions.forget((metadata.get('user'), metadata['order_id'], metadata.get('price')))
+        chat_id = (self.user_repository.get(metadata['user']) or {}).get('chatId') if metadata.get('user') else None
+        if chat_id is None:
+            return
+        try:
+            self.bot.send_message(chat_id=chat_id, text=PAYMENT_FAILED_MESSAGE.format(metadata['order_id']))
+        except TelegramError as e:
+            print("Could not tell {} about the failed payment: {}".format(metadata['user'], e))
 
 
 def payment_success(session):
-    # TODO: Add logic for updating delivery type
-    print(session)
+    """
+    The (order_id, fields) change paying for session makes, or None if it isn't for an order. The order keeps
+    the id of the session that paid for it, so a later failure event for that session is not reported.
+    """
+    metadata = session.get('metadata') or {}
+    if not metadata.get('order_id') or not metadata.get('deliveryType'):
+        print("Payment success without an order:", session.get('id'))
+        return None
     print("Payment success!")
-    print("Updated delivery type.")
+    checkout_sessions.forget((metadata.get('user'), metadata['order_id'], metadata.get('price')))
+    return metadata['order_id'], {"deliveryType": metadata['deliveryType'], "checkoutSession": session.get('id')}
+
+
+def webhook_route(order_repository, event_log, user_repository, bot, path=STRIPE_WEBHOOK_PATH):
+    """
+    Start fulfilling Stripe events.
+    :return: Returns the tornado route of the webhook.
+    """
+    fulfilment = Fulfilment(order_repository, event_log, user_repository, bot)
+    event_queue = stripeEvents.EventQueue(
+        stripeEvents.ProcessedEvents(os.getenv('STRIPE_EVENTS_DB', 'stripe-events.db')), fulfilment.fulfil_events,
+        workers=int(os.getenv('STRIPE_WORKERS', '2')))
+    metrics.REGISTRY.add_collector(lambda: [
+        ("ninja_stripe_event_queue_depth", "gauge", "Stripe events waiting to be fulfilled", event_queue.depth()),
+    ])
+    return path, StripeWebhookHandler, {"event_queue": event_queue}
+
 
-def payment_failure(session):
-    # TODO: Add logic for failure
-    print(session.failure_message)
-    print("Failed to process payment, please try again.")
+def add_route(updater, order_repository, event_log, user_repository):
+    """ Serve the Stripe webhook from the webhook server started by updater.start_webhook, once it has started."""
+    route = webhook_route(order_repository, event_log, user_repository, updater.bot)
+    updater.httpd.http_server.request_callback.add_handlers(r".*", [route])
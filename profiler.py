@@ -0,0 +1,295 @@
+"""
+Opt-in sampling profiler for single updates, to see where a slow flow spends its time.
+
+A fraction of updates (PROFILE_FRACTION, default 0) and every update whose callback action or handler name is
+listed in PROFILE_ACTIONS are profiled. While a profiled update is handled, a sampler thread records the
+handler thread's stack every PROFILE_INTERVAL milliseconds, and the code marks its phases (parsing callback
+data, storage I/O, building keyboards and Telegram I/O) with phase(), which also times them exactly. Each
+profiled update is written to PROFILE_DIR as collapsed stacks (flamegraph.pl, speedscope) or, with
+PROFILE_FORMAT=speedscope, as a speedscope file, with the phase as the root frame, and its phase breakdown is
+printed.
+
+With profiling off the decorators hand back the undecorated functions and phase() costs a thread-local lookup;
+with it on, the sampler thread only wakes while a profiled update is being handled.
+"""
+import collections
+import contextlib
+import datetime
+import functools
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+import callbackcodec
+
+PARSE = "parse"
+STORAGE = "storage"
+KEYBOARD = "keyboard"
+TELEGRAM = "telegram"
+OTHER = "other"
+PHASES = (PARSE, STORAGE, KEYBOARD, TELEGRAM, OTHER)
+
+PROFILE_FRACTION = float(os.getenv("PROFILE_FRACTION", "0"))
+# Callback actions (callbackcodec.ACTION_NAMES) or handler names, e.g. "view_orders,start"
+PROFILE_ACTIONS = frozenset(name.strip() for name in os.getenv("PROFILE_ACTIONS", "").split(",") if name.strip())
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_FORMAT = os.getenv("PROFILE_FORMAT", "collapsed")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "1")) / 1000
+
+ENABLED = PROFILE_FRACTION > 0 or bool(PROFILE_ACTIONS)
+
+_local = threading.local()
+_NO_PHASE = contextlib.nullcontext()
+_frame_names = {}
+
+
+def _frame_name(code):
+    name = _frame_names.get(code)
+    if name is None:
+        name = _frame_names[code] = "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename),
+                                                         code.co_firstlineno)
+    return name
+
+
+class Profile:
+    """ The samples and phase timings of one update."""
+
+    def __init__(self, name, update_id, thread_id, root):
+        """
+        :param str name: Callback action or handler name of the update.
+        :param int thread_id: The thread handling the update.
+        :param root: Frame of the profiling wrapper; sampled stacks start below it.
+        """
+        self.name = name
+        self.update_id = update_id
+        self.thread_id = thread_id
+        self.root = root
+        self.start = self._last_sample = time.perf_counter()
+        self.duration = None
+        # Seconds spent in each phase, not counting phases nested in it
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        # Seconds sampled in each (phase, frame, ...) stack, outermost frame first
+        self.samples = collections.Counter()
+        self.num_samples = 0
+        self._stack = [[OTHER, self.start]]
+
+    def enter(self, phase_name):
+        now = time.perf_counter()
+        self._charge(now)
+        self._stack.append([phase_name, now])
+
+    def exit(self):
+        now = time.perf_counter()
+        self._charge(now)
+        self._stack.pop()
+        self._stack[-1][1] = now
+
+    def finish(self):
+        now = time.perf_counter()
+        self._charge(now)
+        self._stack[-1][1] = now
+        self.duration = now - self.start
+
+    def _charge(self, now):
+        phase_name, since = self._stack[-1]
+        self.phases[phase_name] = self.phases.get(phase_name, 0.0) + now - since
+
+    def sample(self, frame, now):
+        """ Record the stack of the handling thread, from the sampler thread."""
+        names = []
+        while frame is not None and frame is not self.root:
+            names.append(_frame_name(frame.f_code))
+            frame = frame.f_back
+        if frame is None:
+            # Not inside the profiled callback (yet)
+            return
+        names.append(self._stack[-1][0])
+        names.reverse()
+        # Weighted by the time since the last sample, which the GIL may have stretched past the interval
+        self.samples[tuple(names)] += now - self._last_sample
+        self._last_sample = now
+        self.num_samples += 1
+
+
+class Sampler:
+    """ Samples the stacks of the threads handling profiled updates, sleeping while there are none."""
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self._profiles = {}
+        self._condition = threading.Condition()
+        self._thread = None
+        self._switch_interval = None
+
+    def add(self, profile):
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sample_forever, name="profiler", daemon=True)
+                self._thread.start()
+            if not self._profiles:
+                # A busy handler thread only gives up the GIL every switch interval, which would space the
+                # samples out to 5ms
+                self._switch_interval = sys.getswitchinterval()
+                sys.setswitchinterval(min(self._switch_interval, self.interval))
+            self._profiles[profile.thread_id] = profile
+            self._condition.notify()
+
+    def remove(self, profile):
+        # Once this returns the sampler no longer touches the profile
+        with self._condition:
+            if self._profiles.pop(profile.thread_id, None) is not None and not self._profiles:
+                sys.setswitchinterval(self._switch_interval)
+
+    def _sample_forever(self):
+        while True:
+            with self._condition:
+                while not self._profiles:
+                    self._condition.wait()
+                frames = sys._current_frames()
+                now = time.perf_counter()
+                for thread_id, profile in self._profiles.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        profile.sample(frame, now)
+                del frames
+            time.sleep(self.interval)
+
+
+sampler = Sampler()
+
+
+def phase(name):
+    """ Context manager marking a block as phase name of the update being profiled on this thread, if any."""
+    profile = getattr(_local, "profile", None)
+    if profile is None:
+        return _NO_PHASE
+    return _Phase(profile, name)
+
+
+class _Phase:
+    __slots__ = ("_profile", "_name")
+
+    def __init__(self, profile, name):
+        self._profile = profile
+        self._name = name
+
+    def __enter__(self):
+        self._profile.enter(self._name)
+
+    def __exit__(self, *exc_info):
+        self._profile.exit()
+
+
+def in_phase(name):
+    """ Decorator form of phase; with profiling off the function is returned as is."""
+    def decorator(function):
+        if not ENABLED:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def update_name(handler, update):
+    """ The callback action of a callback query update, else the handler name."""
+    query = update.callback_query
+    if query is not None:
+        callback = callbackcodec.decode(query.data)
+        if callback is not None and callback.action in callbackcodec.ACTION_NAMES:
+            return callbackcodec.ACTION_NAMES[callback.action]
+    return handler
+
+
+def should_profile(name):
+    return name in PROFILE_ACTIONS or random.random() < PROFILE_FRACTION
+
+
+def profiled(handler):
+    """
+    Decorator for handler callbacks taking (update, context): profiles the updates picked by PROFILE_FRACTION
+    and PROFILE_ACTIONS. With profiling off the callback is returned as is.
+    :param str handler: Name of the handler, for updates that aren't callback queries.
+    """
+    def decorator(callback):
+        if not ENABLED:
+            return callback
+
+        @functools.wraps(callback)
+        def wrapper(update, context):
+            name = update_name(handler, update)
+            if getattr(_local, "profile", None) is not None or not should_profile(name):
+                return callback(update, context)
+            profile = Profile(name, update.update_id, threading.get_ident(), sys._getframe())
+            _local.profile = profile
+            sampler.add(profile)
+            try:
+                return callback(update, context)
+            finally:
+                sampler.remove(profile)
+                _local.profile = None
+                profile.finish()
+                report(profile)
+        return wrapper
+    return decorator
+
+
+def collapsed(profile):
+    """ Lines of the profile's stacks in collapsed format; the values are microseconds."""
+    return ["{} {}".format(";".join(stack), max(1, round(seconds * 1e6)))
+            for stack, seconds in sorted(profile.samples.items())]
+
+
+def speedscope(profile):
+    """ The profile as a speedscope file (https://www.speedscope.app/file-format-schema.json)."""
+    frames = {}
+    samples = []
+    weights = []
+    for stack, seconds in profile.samples.items():
+        samples.append([frames.setdefault(name, len(frames)) for name in stack])
+        weights.append(seconds * 1000)
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": "{} update {}: {}".format(profile.name, profile.update_id, format_phases(profile)),
+        "shared": {"frames": [{"name": name} for name in frames]},
+        "profiles": [{"type": "sampled", "name": profile.name, "unit": "milliseconds", "startValue": 0,
+                      "endValue": sum(weights), "samples": samples, "weights": weights}],
+    }
+
+
+def format_phases(profile):
+    return ", ".join("{} {:.1f}ms".format(name, seconds * 1000) for name, seconds in profile.phases.items())
+
+
+def write(profile, directory=PROFILE_DIR, file_format=PROFILE_FORMAT):
+    """
+    Write the profile to a file in directory.
+    :return: Returns the path of the file.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "{:%Y%m%d-%H%M%S}-{}-{}".format(datetime.datetime.now(), profile.name,
+                                                                    profile.update_id))
+    if file_format == "speedscope":
+        path += ".speedscope.json"
+        with open(path, "w") as f:
+            json.dump(speedscope(profile), f)
+    else:
+        path += ".collapsed"
+        with open(path, "w") as f:
+            f.writelines(line + "\n" for line in collapsed(profile))
+    return path
+
+
+def report(profile):
+    try:
+        path = write(profile)
+    except OSError as e:
+        path = "not written: {}".format(e)
+    print("Profiled {} update {} in {:.1f}ms ({}; {} samples): {}".format(
+        profile.name, profile.update_id, profile.duration * 1000, format_phases(profile), profile.num_samples, path))
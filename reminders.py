@@ -0,0 +1,85 @@
+"""
+Delivery-day reminders: once a day, every user with an order arriving tomorrow is sent a message with the
+order's menu, so they can reschedule or upgrade it in time.
+
+The orders due tomorrow are read page by page (OrderRepository.find_pages_by_delivery_date) and the owners
+of a page are looked up in one batched read, so a run over any number of orders holds one page in memory.
+The messages go out through the send queue as bulk messages, behind interactive replies. Users are reached
+at the chatId recorded on their user document when they open their orders; users without one are skipped, as
+are orders without an owner (see migrations/order_owners.py).
+"""
+import datetime
+import os
+import time
+
+from telegram.error import TelegramError
+
+import metrics
+import sendqueue
+import tiers
+
+# Local time of day the reminders are sent, HH:MM
+REMINDER_TIME = os.getenv("REMINDER_TIME", "10:00")
+PAGE_SIZE = int(os.getenv("REMINDER_PAGE_SIZE", "500"))
+
+REMINDER_TEXT = "Your order {} is arriving tomorrow, {}. Would you like to reschedule it?"
+
+REMINDERS = metrics.REGISTRY.counter("ninja_reminders_total", "Delivery-day reminders by outcome", ["outcome"])
+RUN_DURATION = metrics.REGISTRY.histogram("ninja_reminder_run_seconds", "Duration of reminder runs",
+                                          buckets=(1, 10, 60, 300, 900, 1800, 3600, 7200, 14400))
+
+# Figures of the last run, for /metrics
+last_run = {"sent": 0, "duration": 0.0}
+metrics.REGISTRY.add_collector(lambda: [
+    ("ninja_reminder_last_run_sent", "gauge", "Reminders sent by the last run", last_run["sent"]),
+    ("ninja_reminder_last_run_seconds", "gauge", "Duration of the last reminder run", last_run["duration"]),
+    ("ninja_reminder_last_run_sends_per_second", "gauge", "Send rate of the last reminder run",
+     last_run["sent"] / last_run["duration"] if last_run["duration"] else 0.0),
+])
+
+
+def send_reminders(bot, order_repository, user_repository, format_text, keyboard, day=None, page_size=PAGE_SIZE):
+    """
+    Remind the owners of the orders due on day.
+    :param bot: The telegram.Bot to send with.
+    :param format_text: Called as format_text(order_id, order_dict), returns the message.
+    :param keyboard: Called as keyboard(order_id), returns the message's reply markup.
+    :param datetime.datetime day: Start of the delivery day, if None tomorrow.
+    :return: Returns a dict of counts by outcome.
+    """
+    day = tiers.today().replace(second=0, microsecond=0) + datetime.timedelta(days=1) if day is None else day
+    counts = {"sent": 0, "failed": 0, "no_chat": 0, "no_owner": 0}
+    start = time.perf_counter()
+    with sendqueue.bulk():
+        for page in order_repository.find_pages_by_delivery_date(day, day + datetime.timedelta(days=1), page_size):
+            users = user_repository.get_many({order_dict.get("owner") for _, order_dict in page} - {None})
+            for order_id, order_dict in page:
+                chat_id = (users.get(order_dict.get("owner")) or {}).get("chatId")
+                if order_dict.get("owner") is None:
+                    outcome = "no_owner"
+                elif chat_id is None:
+                    outcome = "no_chat"
+                else:
+                    try:
+                        bot.send_message(chat_id=chat_id, text=format_text(order_id, order_dict),
+                                         reply_markup=keyboard(order_id))
+                        outcome = "sent"
+                    except TelegramError as e:
+                        # Blocked the bot, deleted their account, ...
+                        print("Reminder for order {} failed: {}".format(order_id, e))
+                        outcome = "failed"
+                counts[outcome] += 1
+                REMINDERS.inc(outcome=outcome)
+    duration = time.perf_counter() - start
+    RUN_DURATION.observe(duration)
+    last_run.update(sent=counts["sent"], duration=duration)
+    print("Reminders for {:%d/%m/%Y}: {} sent, {} failed, {} without a chat, {} without an owner in {:.1f}s "
+          "({:.1f}/s)".format(day, counts["sent"], counts["failed"], counts["no_chat"], counts["no_owner"], duration,
+                              counts["sent"] / duration if duration else 0.0))
+    return counts
+
+
+def reminder_time():
+    """ REMINDER_TIME as a datetime.time in the local timezone."""
+    hour, minute = map(int, REMINDER_TIME.split(":"))
+    return datetime.time(hour, minute, tzinfo=datetime.datetime.now().astimezone().tzinfo)
@@ -0,0 +1,93 @@
+"""
+Collects the replies a handler makes to one update and sends them as few Telegram calls as possible.
+
+Consecutive texts are joined into one message and their inline keyboards stacked under it. If the handler
+edited the message the update came from, the texts that follow are merged into that edit instead of being
+sent as new messages.
+
+A chat action ("typing...") sent while the handler works must not reach the chat after the reply, or the chat
+shows it for seconds with nothing to follow: the replies are held back until it is sent, and an action not
+yet started when they go out is dropped.
+"""
+import concurrent.futures
+import functools
+
+from telegram import InlineKeyboardMarkup
+from telegram.constants import MAX_MESSAGE_LENGTH
+
+SEPARATOR = "\n\n"
+# Seconds the replies wait for a chat action being sent
+ACTION_WAIT = 1.0
+
+
+class ReplyBuffer:
+
+    def __init__(self, bot, chat_id):
+        self.bot = bot
+        self.chat_id = chat_id
+        self._texts = []
+        self._rows = []
+        self._message_id = None
+        self._actions = []
+
+    def precede(self, action):
+        """
+        Send the replies after a chat action.
+        :param concurrent.futures.Future action: The call sending the chat action, made on another thread.
+        """
+        self._actions.append(action)
+
+    def send(self, text, reply_markup=None):
+        """ Queue a message to the chat, merged with the ones queued before it."""
+        if reply_markup is not None and not isinstance(reply_markup, InlineKeyboardMarkup):
+            # Reply keyboards can't be merged, send everything so far and this one on its own
+            self.flush()
+            self._settle_actions()
+            return self.bot.send_message(chat_id=self.chat_id, text=text, reply_markup=reply_markup)
+        if self._texts and len(SEPARATOR.join(self._texts + [text])) > MAX_MESSAGE_LENGTH:
+            self.flush()
+        self._texts.append(text)
+        if reply_markup is not None:
+            self._rows.extend(reply_markup.inline_keyboard)
+        return None
+
+    def edit(self, message, text, reply_markup=None):
+        """ Queue an edit of message; texts sent after it are merged into the edit."""
+        self.flush()
+        self._message_id = message.message_id
+        self.send(text, reply_markup)
+
+    def flush(self):
+        """
+        Send what is queued.
+        :return: Returns the sent or edited telegram.Message, or None if nothing was queued.
+        """
+        if not self._texts:
+            return None
+        self._settle_actions()
+        text = SEPARATOR.join(self._texts)
+        reply_markup = InlineKeyboardMarkup(self._rows) if self._rows else None
+        message_id = self._message_id
+        self._texts, self._rows, self._message_id = [], [], None
+        if message_id is not None:
+            return self.bot.edit_message_text(text=text, chat_id=self.chat_id, message_id=message_id,
+                                              reply_markup=reply_markup)
+        return self.bot.send_message(chat_id=self.chat_id, text=text, reply_markup=reply_markup)
+
+    def _settle_actions(self):
+        actions, self._actions = self._actions, []
+        running = [action for action in actions if not action.cancel()]
+        if running:
+            concurrent.futures.wait(running, timeout=ACTION_WAIT)
+
+
+def buffered(callback):
+    """ Give a handler callback a ReplyBuffer as context.replies and flush it once the callback returns."""
+    @functools.wraps(callback)
+    def wrapper(update, context):
+        context.replies = ReplyBuffer(context.bot, update.effective_chat.id)
+        try:
+            return callback(update, context)
+        finally:
+            context.replies.flush()
+    return wrapper
@@ -0,0 +1,146 @@
+"""
+Rate limiting for outbound Telegram messages.
+
+Telegram allows about 30 messages a second across all chats and about one a second per chat, and answers
+bursts above that with 429 RetryAfter. Every send or edit made through NinjaBot takes a slot from the
+SendQueue first, blocking until both the global and the chat's limits allow it. Interactive replies and
+invoices go before bulk notices (sent inside a bulk() block) that are waiting at the same time, and a 429
+pauses the whole queue for its retry_after.
+"""
+import collections
+import contextlib
+import itertools
+import threading
+import time
+
+import metrics
+
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+QUEUE_WAIT = metrics.REGISTRY.histogram("ninja_send_queue_wait_seconds",
+                                        "Time outbound messages waited for a send slot", ["priority"])
+RATE_LIMITED = metrics.REGISTRY.counter("ninja_telegram_rate_limited_total",
+                                        "429 flood-wait responses from Telegram", ["method"])
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def bulk():
+    """ Send the messages of this block, on this thread, behind interactive ones."""
+    previous = getattr(_local, "priority", INTERACTIVE)
+    _local.priority = BULK
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def current_priority():
+    return getattr(_local, "priority", INTERACTIVE)
+
+
+class _Bucket:
+    """ Token bucket refilled at rate tokens a second, holding at most burst tokens."""
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class SendQueue:
+
+    def __init__(self, global_rate=30.0, chat_rate=1.0, chat_burst=3):
+        """
+        :param float global_rate: Messages per second across all chats.
+        :param float chat_rate: Messages per second to one chat, after a burst of chat_burst.
+        """
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._condition = threading.Condition()
+        self._global = _Bucket(global_rate, global_rate, time.monotonic())
+        self._chats = collections.OrderedDict()  # chat_id -> _Bucket, least recently used first
+        self._waiting = []  # (priority, sequence, chat_id) of blocked senders
+        self._sequence = itertools.count()
+        self._paused_until = 0.0
+
+    def depth(self):
+        return len(self._waiting)
+
+    def acquire(self, chat_id=None, priority=None):
+        """ Block until a message to chat_id may be sent."""
+        priority = current_priority() if priority is None else priority
+        entry = (priority, next(self._sequence), chat_id)
+        start = time.monotonic()
+        with self._condition:
+            self._waiting.append(entry)
+            while True:
+                now = time.monotonic()
+                delay = self._delay(entry, now)
+                if delay <= 0:
+                    break
+                self._condition.wait(delay)
+            self._waiting.remove(entry)
+            self._take(chat_id)
+        QUEUE_WAIT.observe(time.monotonic() - start, priority=PRIORITY_NAMES[priority])
+
+    def try_acquire(self, chat_id=None, priority=None):
+        """ Take a slot for a message to chat_id without blocking, for callers on an event loop.
+        :return: Returns 0 if the message may be sent now, else the seconds to wait before trying again.
+        """
+        priority = current_priority() if priority is None else priority
+        with self._condition:
+            delay = self._delay((priority, next(self._sequence), chat_id), time.monotonic())
+            if delay <= 0:
+                self._take(chat_id)
+            return max(delay, 0.0)
+
+    def _take(self, chat_id):
+        self._global.tokens -= 1
+        if chat_id in self._chats:
+            self._chats[chat_id].tokens -= 1
+        self._condition.notify_all()
+
+    def pause(self, seconds):
+        """ Hold every send for seconds, after Telegram answered with RetryAfter."""
+        with self._condition:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _delay(self, entry, now):
+        """ Seconds entry still has to wait, 0 if it can go now."""
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._global.refill(now)
+        chat_wait = self._chat_wait(entry[2], now)
+        if chat_wait > 0:
+            return chat_wait
+        # Leave global slots to waiters ahead of entry whose chats are ready
+        for other in self._waiting:
+            if other < entry and self._chat_wait(other[2], now) <= 0:
+                return max(self._global.wait_time(), 0.01)
+        return self._global.wait_time()
+
+    def _chat_wait(self, chat_id, now):
+        if chat_id is None:
+            return 0.0
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = _Bucket(self.chat_rate, self.chat_burst, now)
+            if len(self._chats) > 10000:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        bucket.refill(now)
+        return bucket.wait_time()
@@ -0,0 +1,140 @@
+"""
+Bot state shared between worker processes.
+
+SHARED_STATE_PATH names a SQLite database that every worker opens (WAL mode, so readers don't block the
+writer); without it state lives in process memory, which is only correct with a single worker. Values are
+pickled and kept under (namespace, key).
+
+StorePersistence keeps python-telegram-bot's chat_data, user_data and conversations in the store. Updates
+are routed to workers by chat (see workers.py), so each chat's data is only ever written by one process.
+bot_data is not persisted, as every process would hold its own copy: read and write shared bot-level state
+through the store directly.
+"""
+import collections
+import json
+import os
+import pickle
+import sqlite3
+import threading
+
+from telegram.ext import BasePersistence
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+"""
+
+
+class MemoryStore:
+    """ In-process stand-in for SQLiteStore."""
+
+    def __init__(self):
+        self._data = collections.defaultdict(dict)
+        self._lock = threading.Lock()
+
+    def get(self, namespace, key, default=None):
+        with self._lock:
+            value = self._data[namespace].get(str(key))
+        return default if value is None else pickle.loads(value)
+
+    def set(self, namespace, key, value):
+        with self._lock:
+            self._data[namespace][str(key)] = pickle.dumps(value)
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._data[namespace].pop(str(key), None)
+
+    def items(self, namespace):
+        with self._lock:
+            values = list(self._data[namespace].items())
+        return [(key, pickle.loads(value)) for key, value in values]
+
+
+class SQLiteStore:
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+
+    def _connect(self):
+        # A connection must not be shared with forked workers, each process opens its own
+        if self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.executescript(SCHEMA)
+            self._pid = os.getpid()
+        return self._connection
+
+    def get(self, namespace, key, default=None):
+        with self._lock:
+            row = self._connect().execute("SELECT value FROM state WHERE namespace = ? AND key = ?",
+                                          (namespace, str(key))).fetchone()
+        return default if row is None else pickle.loads(row[0])
+
+    def set(self, namespace, key, value):
+        with self._lock, self._connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO state VALUES (?, ?, ?)",
+                               (namespace, str(key), pickle.dumps(value)))
+
+    def delete(self, namespace, key):
+        with self._lock, self._connect() as connection:
+            connection.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, str(key)))
+
+    def items(self, namespace):
+        with self._lock:
+            rows = self._connect().execute("SELECT key, value FROM state WHERE namespace = ?",
+                                           (namespace,)).fetchall()
+        return [(key, pickle.loads(value)) for key, value in rows]
+
+
+def get_store():
+    path = os.getenv("SHARED_STATE_PATH")
+    return SQLiteStore(path) if path else MemoryStore()
+
+
+class StorePersistence(BasePersistence):
+
+    def __init__(self, store):
+        super().__init__(store_user_data=True, store_chat_data=True, store_bot_data=False)
+        self.store = store
+
+    def _load(self, namespace):
+        data = collections.defaultdict(dict)
+        for key, value in self.store.items(namespace):
+            data[int(key)] = value
+        return data
+
+    def get_user_data(self):
+        return self._load("user_data")
+
+    def get_chat_data(self):
+        return self._load("chat_data")
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        return {tuple(json.loads(key)): state for key, state in self.store.items("conversation:" + name)}
+
+    def update_conversation(self, name, key, new_state):
+        if new_state is None:
+            self.store.delete("conversation:" + name, json.dumps(key))
+        else:
+            self.store.set("conversation:" + name, json.dumps(key), new_state)
+
+    def update_user_data(self, user_id, data):
+        self.store.set("user_data", user_id, data)
+
+    def update_chat_data(self, chat_id, data):
+        self.store.set("chat_data", chat_id, data)
+
+    def update_bot_data(self, data):
+        pass
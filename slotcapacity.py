@@ -0,0 +1,158 @@
+"""
+Delivery capacity of the time slots, per day and zone.
+
+Every (day, time slot, zone) has a counter of the parcels booked into it, kept as a storage.CounterRepository
+counter split into num_shards shards. Each shard may hold its share of the slot's capacity, so a booking is a
+single atomic increment of one shard that still has room, and bookings of the same slot rarely touch the same
+shard. Rendering the slots of a day reads the counters of its four slots in one batched read, however many
+orders there are.
+
+A shard only goes over its quota when every shard of the slot is full: forced bookings fill the shards with room
+first, releases take from the shards over their quota first and a rebuild spreads the count over the shards. A
+shard with room next to one over its quota would take bookings past the slot's capacity.
+
+An order occupies a slot while its deliveryDate has an hour set; orders without a zone are counted in
+DEFAULT_ZONE. Counters of existing orders are built with: python slotcapacity.py --rebuild [--days N]
+"""
+import argparse
+import datetime
+import os
+import random
+
+import metrics
+import storage
+import tiers
+
+DEFAULT_ZONE = "all"
+
+SLOT_BOOKINGS = metrics.REGISTRY.counter("ninja_slot_bookings_total", "Time slot reservations by outcome",
+                                         ["outcome"])
+
+
+class SlotCapacity:
+
+    def __init__(self, counters, capacity=50, num_shards=4):
+        """
+        :param storage.CounterRepository counters: Where the slot counters are kept.
+        :param int capacity: Parcels one zone can take in one time slot.
+        :param int num_shards: Shards per slot counter.
+        """
+        self.counters = counters
+        self.capacity = capacity
+        self.num_shards = num_shards
+        # Shard i takes up to quotas[i] bookings, the quotas add up to capacity
+        self.quotas = [capacity // num_shards + (1 if i < capacity % num_shards else 0) for i in range(num_shards)]
+
+    @staticmethod
+    def slot_key(date, zone=None):
+        """ Counter name of the slot starting at date, None if date has no time slot."""
+        if date is None or date.hour == 0:
+            return None
+        return "{:%Y-%m-%d}-{:02d}-{}".format(date, date.hour, zone or DEFAULT_ZONE)
+
+    def order_slot(self, order_dict):
+        """ Counter name of the slot the order is booked into, or None."""
+        return self.slot_key(order_dict.get("deliveryDate"), order_dict.get("zone"))
+
+    def free_hours(self, date, zone=None):
+        """ Start hours of the time slots on date that still have room."""
+        keys = {hour: self.slot_key(date.replace(hour=hour), zone) for hour, _ in tiers.TIME_SLOTS}
+        values = self.counters.get_many([(key, shard) for key in keys.values() for shard in range(self.num_shards)])
+        booked = {key: 0 for key in keys.values()}
+        for (key, _), value in values.items():
+            booked[key] += value
+        return [hour for hour, key in keys.items() if booked[key] < self.capacity]
+
+    def reserve(self, key):
+        """
+        Book one parcel into the slot, if it has room.
+        :return: True if booked; always True for key None.
+        """
+        if key is None:
+            return True
+        shards = list(range(self.num_shards))
+        random.shuffle(shards)
+        for shard in shards:
+            if self.counters.add(key, shard, 1, high=self.quotas[shard]):
+                SLOT_BOOKINGS.inc(outcome="reserved")
+                return True
+        SLOT_BOOKINGS.inc(outcome="full")
+        return False
+
+    def book(self, key):
+        """ Book one parcel into the slot whether or not it has room, for moves made by ops."""
+        if key is None:
+            return
+        shards = list(range(self.num_shards))
+        random.shuffle(shards)
+        if not any(self.counters.add(key, shard, 1, high=self.quotas[shard]) for shard in shards):
+            # Full: the booking goes over the quota
+            self.counters.add(key, shards[0], 1)
+        SLOT_BOOKINGS.inc(outcome="forced")
+
+    def release(self, key):
+        """ Give back one parcel's place in the slot."""
+        if key is None:
+            return
+        values = self.counters.get_many([(key, shard) for shard in range(self.num_shards)])
+        shards = list(range(self.num_shards))
+        random.shuffle(shards)
+        # Shards over their quota first, so no shard has room while another is over
+        shards.sort(key=lambda shard: values.get((key, shard), 0) - self.quotas[shard], reverse=True)
+        for shard in shards:
+            if self.counters.add(key, shard, -1):
+                SLOT_BOOKINGS.inc(outcome="released")
+                return
+
+    def apply_changes(self, orders, changes):
+        """
+        Move the bookings of orders changed in bulk (see bulkreschedule.plan_changes).
+        :param list orders: (order_id, order_dict) pairs, before the changes.
+        :param list changes: (order_id, fields) pairs that were committed.
+        """
+        order_dicts = dict(orders)
+        for order_id, fields in changes:
+            old_key = self.order_slot(order_dicts[order_id])
+            new_key = self.order_slot(dict(order_dicts[order_id], **fields))
+            if new_key != old_key:
+                self.book(new_key)
+                self.release(old_key)
+
+    def rebuild(self, order_repository, start, end):
+        """ Recount the slots of orders due from start to end, replacing their counters."""
+        booked = {}
+        for _, order_dict in order_repository.find_by_delivery_date(start, end):
+            key = self.order_slot(order_dict)
+            if key is not None:
+                booked[key] = booked.get(key, 0) + 1
+        for key, count in booked.items():
+            # Each shard filled up to its quota, a slot booked past its capacity has the rest in shard 0
+            values = [min(quota, max(0, count - sum(self.quotas[:shard]))) for shard, quota in enumerate(self.quotas)]
+            values[0] += count - sum(values)
+            for shard, value in enumerate(values):
+                self.counters.put(key, shard, value)
+        return booked
+
+
+def get_slot_capacity(lazy=False):
+    counters = metrics.InstrumentedRepository(storage.get_counter_repository(lazy=lazy), "counters")
+    return SlotCapacity(counters, capacity=int(os.getenv("SLOT_CAPACITY", "50")),
+                        num_shards=int(os.getenv("SLOT_COUNTER_SHARDS", "4")))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time slot capacity counters")
+    parser.add_argument("--rebuild", action="store_true", help="recount the slots of the coming days")
+    parser.add_argument("--days", type=int, default=14, help="days to recount, from today")
+    args = parser.parse_args()
+    if not args.rebuild:
+        parser.error("nothing to do: pass --rebuild")
+
+    order_repository, _ = storage.get_repositories()
+    start = tiers.today().replace(second=0, microsecond=0)
+    booked = get_slot_capacity().rebuild(order_repository, start, start + datetime.timedelta(days=args.days))
+    print(len(booked), "slots,", sum(booked.values()), "bookings")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+Storage backends for orders and users.
+
+STORAGE_BACKEND picks the backend: "firestore" (default), "memory" or "sqlite".
+The SQLite database lives at SQLITE_PATH, and STORAGE_SEED can point at a JSON file of
+{"orders": {id: order}, "users": {username: user}} to load into an offline backend on start.
+With lazy=True, get_repositories returns stand-ins that only connect to the backend when first used.
+get_counter_repository gives the backend's sharded counters, used for time slot capacity, and
+get_event_repository its append-only log of order events.
+"""
+import datetime
+import json
+import os
+import threading
+
+from storage.base import CounterRepository, EventRepository, OrderRepository, UserRepository, order_summary
+from storage.lazy import LazyRepositories, lazy_repository
+from storage.memory_store import MemoryCounterRepository, MemoryEventRepository, MemoryOrderRepository, \
+    MemoryUserRepository
+from storage.sqlite_store import SQLiteCounterRepository, SQLiteEventRepository, SQLiteOrderRepository, \
+    SQLiteUserRepository
+
+BACKENDS = ("firestore", "memory", "sqlite")
+DATE_FIELDS = ("deliveryDate", "pickUpDate")
+
+
+def firestore_client():
+    # Imported here so the offline backends never need firebase_admin or credentials
+    import firebase_admin
+    from firebase_admin import credentials
+    from firebase_admin import firestore
+
+    try:
+        firebase_admin.get_app()
+    except ValueError:
+        firebase_admin.initialize_app(credentials.Certificate(os.getenv("FIREBASE_CERT")))
+    return firestore.client()
+
+
+def create_firestore_repositories():
+    from storage.firestore_store import FirestoreOrderRepository, FirestoreUserRepository
+
+    client = firestore_client()
+    return FirestoreOrderRepository(client), FirestoreUserRepository(client)
+
+
+def create_sqlite_repositories(path):
+    from storage.sqlite_store import connect
+
+    connection = connect(path)
+    lock = threading.RLock()
+    return SQLiteOrderRepository(connection, lock), SQLiteUserRepository(connection, lock)
+
+
+def load_seed(path, order_repository, user_repository):
+    """ Load orders and users from a JSON file; deliveryDate and pickUpDate are ISO 8601 strings."""
+    with open(path) as seed_file:
+        seed = json.load(seed_file)
+    # Users first, putting an order adds its summary to its owner
+    owners = {}
+    for username, user_dict in seed.get("users", {}).items():
+        user_repository.put(username, user_dict)
+        owners.update(dict.fromkeys(user_dict.get("orders", ()), username))
+    for order_id, order_dict in seed.get("orders", {}).items():
+        if order_dict.get("owner") is None and order_id in owners:
+            order_dict["owner"] = owners[order_id]
+        for field in DATE_FIELDS:
+            if isinstance(order_dict.get(field), str):
+                order_dict[field] = datetime.datetime.fromisoformat(order_dict[field])
+        order_repository.put(order_id, order_dict)
+
+
+def get_repositories(backend=None, lazy=False):
+    """
+    Create the order and user repositories for the configured backend.
+    :param str backend: One of BACKENDS, if None STORAGE_BACKEND is used.
+    :param bool lazy: Defer creating the repositories until one of them is first used.
+    :return: Returns a tuple (OrderRepository, UserRepository).
+    """
+    backend = backend or os.getenv("STORAGE_BACKEND", "firestore")
+    if backend not in BACKENDS:
+        raise ValueError("Unknown storage backend {}, expected one of {}".format(backend, ", ".join(BACKENDS)))
+    if lazy:
+        repositories = LazyRepositories(lambda: get_repositories(backend))
+        return repositories.orders, repositories.users
+    if backend == "firestore":
+        return create_firestore_repositories()
+    if backend == "memory":
+        users = MemoryUserRepository()
+        repositories = MemoryOrderRepository(users), users
+    else:
+        repositories = create_sqlite_repositories(os.getenv("SQLITE_PATH", "ninja-scheduler.db"))
+    if os.getenv("STORAGE_SEED"):
+        load_seed(os.getenv("STORAGE_SEED"), *repositories)
+    return repositories
+
+
+def get_counter_repository(backend=None, lazy=False):
+    """
+    Create the sharded counters (see CounterRepository) for the configured backend.
+    :param str backend: One of BACKENDS, if None STORAGE_BACKEND is used.
+    :param bool lazy: Defer creating the repository until it is first used.
+    """
+    backend = backend or os.getenv("STORAGE_BACKEND", "firestore")
+    if backend not in BACKENDS:
+        raise ValueError("Unknown storage backend {}, expected one of {}".format(backend, ", ".join(BACKENDS)))
+    if lazy:
+        return lazy_repository(lambda: get_counter_repository(backend))
+    if backend == "firestore":
+        from storage.firestore_store import FirestoreCounterRepository
+        return FirestoreCounterRepository(firestore_client())
+    if backend == "memory":
+        return MemoryCounterRepository()
+    from storage.sqlite_store import connect
+    return SQLiteCounterRepository(connect(os.getenv("SQLITE_PATH", "ninja-scheduler.db")))
+
+
+def get_event_repository(backend=None, lazy=False):
+    """
+    Create the order event log (see EventRepository) for the configured backend.
+    :param str backend: One of BACKENDS, if None STORAGE_BACKEND is used.
+    :param bool lazy: Defer creating the repository until it is first used.
+    """
+    backend = backend or os.getenv("STORAGE_BACKEND", "firestore")
+    if backend not in BACKENDS:
+        raise ValueError("Unknown storage backend {}, expected one of {}".format(backend, ", ".join(BACKENDS)))
+    if lazy:
+        return lazy_repository(lambda: get_event_repository(backend))
+    if backend == "firestore":
+        from storage.firestore_store import FirestoreEventRepository
+        return FirestoreEventRepository(firestore_client())
+    if backend == "memory":
+        return MemoryEventRepository()
+    from storage.sqlite_store import connect
+    return SQLiteEventRepository(connect(os.getenv("SQLITE_PATH", "ninja-scheduler.db")))
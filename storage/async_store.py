@@ -0,0 +1,63 @@
+"""
+Coroutine versions of the order and user reads, for the asyncio engine.
+
+Firestore reads go through google-cloud-firestore's AsyncClient. The in-memory and SQLite backends answer
+locally, so AsyncAdapter simply exposes the methods of their repositories as coroutines.
+"""
+import os
+
+
+class AsyncAdapter:
+    """ Coroutine methods over a synchronous repository that never waits on the network."""
+
+    def __init__(self, repository):
+        self._repository = repository
+
+    def __getattr__(self, name):
+        attr = getattr(self._repository, name)
+
+        async def call(*args, **kwargs):
+            return attr(*args, **kwargs)
+
+        return call
+
+
+class AsyncFirestoreOrderRepository:
+
+    def __init__(self, client, collection_name=u'orders'):
+        self.client = client
+        self.collection = client.collection(collection_name)
+
+    async def get(self, order_id):
+        return (await self.collection.document(order_id).get()).to_dict()
+
+    async def get_many(self, order_ids):
+        orders = {order_id: None for order_id in order_ids}
+        if orders:
+            refs = [self.collection.document(order_id) for order_id in orders]
+            async for snapshot in self.client.get_all(refs):
+                orders[snapshot.id] = snapshot.to_dict()
+        return orders
+
+
+class AsyncFirestoreUserRepository:
+
+    def __init__(self, client, collection_name=u'users'):
+        self.collection = client.collection(collection_name)
+
+    async def get(self, username):
+        return (await self.collection.document(username).get()).to_dict()
+
+
+def create_async_firestore_repositories():
+    import firebase_admin
+    from firebase_admin import credentials
+    from google.cloud import firestore
+
+    try:
+        app = firebase_admin.get_app()
+    except ValueError:
+        app = firebase_admin.initialize_app(credentials.Certificate(os.getenv("FIREBASE_CERT")))
+    client = firestore.AsyncClient(project=app.project_id, credentials=app.credential.get_credential())
+    return AsyncFirestoreOrderRepository(client), AsyncFirestoreUserRepository(client)
+
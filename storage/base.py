@@ -0,0 +1,136 @@
+import abc
+
+# Order fields copied into the owner's user document, enough to render the order menus
+SUMMARY_FIELDS = ("deliveryDate", "deliveryType", "numReschedules", "pickUpDate")
+
+
+def order_summary(fields):
+    """ The summary fields among an order's fields, {} if there are none."""
+    return {field: fields[field] for field in SUMMARY_FIELDS if field in fields}
+
+
+class OrderRepository(abc.ABC):
+    """
+    Storage for order documents, keyed by order id.
+    Orders are plain dicts using the Firestore field names (deliveryDate, deliveryType, numReschedules, ...).
+    """
+
+    @abc.abstractmethod
+    def get(self, order_id):
+        """ Return the order as a dict, or None if it does not exist."""
+
+    def get_many(self, order_ids):
+        """ Return {order_id: order_dict or None} for all the given orders."""
+        return {order_id: self.get(order_id) for order_id in order_ids}
+
+    @abc.abstractmethod
+    def put(self, order_id, order_dict):
+        """ Create or replace the order."""
+
+    @abc.abstractmethod
+    def update(self, order_id, fields):
+        """ Update some fields of an existing order."""
+
+    def update_many(self, changes):
+        """ Apply a list of (order_id, fields) updates, as one batch where the backend supports it."""
+        for order_id, fields in changes:
+            self.update(order_id, fields)
+
+    @abc.abstractmethod
+    def reschedule(self, order_id, delivery_date):
+        """
+        Move the order to delivery_date and use up one of its reschedules, atomically.
+        :return: The number of reschedules left, or None if the order had none left to use.
+        """
+
+    @abc.abstractmethod
+    def find_by_delivery_date(self, start, end):
+        """ Yield (order_id, order_dict) for orders with start <= deliveryDate < end."""
+
+    def find_pages_by_delivery_date(self, start, end, page_size=500):
+        """
+        Yield lists of up to page_size (order_id, order_dict) for orders with start <= deliveryDate < end, in
+        deliveryDate order. Backends read one page at a time, resuming after the last order of the previous page.
+        """
+        page = []
+        for item in self.find_by_delivery_date(start, end):
+            page.append(item)
+            if len(page) == page_size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    @abc.abstractmethod
+    def find_by_owner(self, owner):
+        """ Yield (order_id, order_dict) for orders belonging to the given username."""
+
+
+class UserRepository(abc.ABC):
+    """
+    Storage for user documents, keyed by Telegram username.
+    Besides its orders, a user document holds orderSummaries, {order_id: summary} with the SUMMARY_FIELDS of
+    each order the user owns. Order repositories keep it up to date in the same write as the order.
+    """
+
+    @abc.abstractmethod
+    def get(self, username):
+        """ Return the user as a dict, or None if it does not exist."""
+
+    def get_many(self, usernames):
+        """ Return {username: user_dict or None} for all the given users."""
+        return {username: self.get(username) for username in usernames}
+
+    @abc.abstractmethod
+    def put(self, username, user_dict):
+        """ Create or replace the user."""
+
+    def update(self, username, fields):
+        """ Set some fields of the user, creating it if needed."""
+        user_dict = self.get(username) or {}
+        user_dict.update(fields)
+        self.put(username, user_dict)
+
+    def update_order_summaries(self, username, summaries):
+        """ Merge {order_id: summary fields} into the user's orderSummaries."""
+        user_dict = self.get(username) or {}
+        for order_id, summary in summaries.items():
+            user_dict.setdefault("orderSummaries", {}).setdefault(order_id, {}).update(summary)
+        self.put(username, user_dict)
+
+
+class CounterRepository(abc.ABC):
+    """
+    Counters split into shards, keyed by (name, shard). A counter's value is the sum of its shards; writers
+    spread over the shards instead of contending for one document.
+    """
+
+    @abc.abstractmethod
+    def get_many(self, keys):
+        """ Return {(name, shard): value} for the given keys, 0 for shards never written."""
+
+    @abc.abstractmethod
+    def add(self, name, shard, amount, low=0, high=None):
+        """
+        Add amount to the shard atomically, unless its new value would fall outside [low, high].
+        :return: True if the amount was added.
+        """
+
+    @abc.abstractmethod
+    def put(self, name, shard, value):
+        """ Set the shard to value."""
+
+
+class EventRepository(abc.ABC):
+    """ Append-only log of order events (see eventlog.py), dicts with the time of the event under "at"."""
+
+    @abc.abstractmethod
+    def append_many(self, events):
+        """ Add the events to the log, as one batch where the backend supports it."""
+
+    @abc.abstractmethod
+    def find_pages(self, start, end, page_size=500):
+        """
+        Yield lists of up to page_size events with start <= at < end, in time order, reading one page at a
+        time.
+        """
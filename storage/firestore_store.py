@@ -0,0 +1,202 @@
+from firebase_admin import firestore
+
+from storage.base import CounterRepository, EventRepository, OrderRepository, UserRepository, order_summary
+
+# Firestore accepts at most 500 writes per batch
+BATCH_SIZE = 500
+
+
+class FirestoreOrderRepository(OrderRepository):
+
+    def __init__(self, client, collection_name=u'orders', users_collection_name=u'users'):
+        self.client = client
+        self.collection = client.collection(collection_name)
+        self.users = client.collection(users_collection_name)
+
+    def get(self, order_id):
+        return self.collection.document(order_id).get().to_dict()
+
+    def get_many(self, order_ids):
+        orders = {order_id: None for order_id in order_ids}
+        if orders:
+            refs = [self.collection.document(order_id) for order_id in orders]
+            for snapshot in self.client.get_all(refs):
+                orders[snapshot.id] = snapshot.to_dict()
+        return orders
+
+    def put(self, order_id, order_dict):
+        batch = self.client.batch()
+        batch.set(self.collection.document(order_id), order_dict)
+        _write_summary(batch, self.users, order_dict.get("owner"), order_id, order_dict)
+        batch.commit()
+
+    def update(self, order_id, fields):
+        if not order_summary(fields):
+            self.collection.document(order_id).update(fields)
+            return
+        owner = (self.collection.document(order_id).get(field_paths=[u'owner']).to_dict() or {}).get(u'owner')
+        batch = self.client.batch()
+        batch.update(self.collection.document(order_id), fields)
+        _write_summary(batch, self.users, owner, order_id, fields)
+        batch.commit()
+
+    def update_many(self, changes):
+        # Up to two writes per order, the order and its owner's summary
+        for i in range(0, len(changes), BATCH_SIZE // 2):
+            chunk = changes[i:i + BATCH_SIZE // 2]
+            owners = self._owners([order_id for order_id, fields in chunk if order_summary(fields)])
+            batch = self.client.batch()
+            for order_id, fields in chunk:
+                batch.update(self.collection.document(order_id), fields)
+                _write_summary(batch, self.users, owners.get(order_id), order_id, fields)
+            batch.commit()
+
+    def reschedule(self, order_id, delivery_date):
+        return _reschedule_in_transaction(self.client.transaction(), self.collection.document(order_id),
+                                          self.users, delivery_date)
+
+    def find_by_delivery_date(self, start, end):
+        query = self.collection.where(u'deliveryDate', u'>=', start).where(u'deliveryDate', u'<', end)
+        for snapshot in query.stream():
+            yield snapshot.id, snapshot.to_dict()
+
+    def find_pages_by_delivery_date(self, start, end, page_size=500):
+        # A cursor per page instead of one long stream(), which the server ends after a minute or so
+        query = self.collection.where(u'deliveryDate', u'>=', start).where(u'deliveryDate', u'<', end) \
+            .order_by(u'deliveryDate').limit(page_size)
+        last = None
+        while True:
+            snapshots = list((query if last is None else query.start_after(last)).stream())
+            if not snapshots:
+                return
+            yield [(snapshot.id, snapshot.to_dict()) for snapshot in snapshots]
+            if len(snapshots) < page_size:
+                return
+            last = snapshots[-1]
+
+    def find_by_owner(self, owner):
+        for snapshot in self.collection.where(u'owner', u'==', owner).stream():
+            yield snapshot.id, snapshot.to_dict()
+
+    def _owners(self, order_ids):
+        if not order_ids:
+            return {}
+        refs = [self.collection.document(order_id) for order_id in order_ids]
+        return {snapshot.id: (snapshot.to_dict() or {}).get(u'owner')
+                for snapshot in self.client.get_all(refs, field_paths=[u'owner'])}
+
+
+class FirestoreUserRepository(UserRepository):
+
+    def __init__(self, client, collection_name=u'users'):
+        self.client = client
+        self.collection = client.collection(collection_name)
+
+    def get(self, username):
+        return self.collection.document(username).get().to_dict()
+
+    def get_many(self, usernames):
+        users = {username: None for username in usernames}
+        if users:
+            for snapshot in self.client.get_all([self.collection.document(username) for username in users]):
+                users[snapshot.id] = snapshot.to_dict()
+        return users
+
+    def put(self, username, user_dict):
+        self.collection.document(username).set(user_dict)
+
+    def update(self, username, fields):
+        self.collection.document(username).set(fields, merge=True)
+
+    def update_order_summaries(self, username, summaries):
+        self.collection.document(username).set({u'orderSummaries': summaries}, merge=True)
+
+
+def _write_summary(writer, users, owner, order_id, fields):
+    """ Add the write of the order's summary in its owner's user document to a batch or transaction."""
+    summary = order_summary(fields)
+    if summary and owner is not None:
+        # A merge creates the nested maps as needed and leaves the user's other summaries alone
+        writer.set(users.document(owner), {u'orderSummaries': {order_id: summary}}, merge=True)
+
+
+class FirestoreCounterRepository(CounterRepository):
+    """ One document per shard, {value: n}, with the id "<name>:<shard>"."""
+
+    def __init__(self, client, collection_name=u'counters'):
+        self.client = client
+        self.collection = client.collection(collection_name)
+
+    def _document(self, name, shard):
+        return self.collection.document(u'{}:{}'.format(name, shard))
+
+    def get_many(self, keys):
+        values = {key: 0 for key in keys}
+        refs = {self._document(name, shard).id: (name, shard) for name, shard in values}
+        if refs:
+            for snapshot in self.client.get_all([self.collection.document(doc_id) for doc_id in refs]):
+                if snapshot.exists:
+                    values[refs[snapshot.id]] = snapshot.get(u'value')
+        return values
+
+    def add(self, name, shard, amount, low=0, high=None):
+        return _add_in_transaction(self.client.transaction(), self._document(name, shard), amount, low, high)
+
+    def put(self, name, shard, value):
+        self._document(name, shard).set({u'value': value})
+
+
+class FirestoreEventRepository(EventRepository):
+    """ One document per event, with a generated id."""
+
+    def __init__(self, client, collection_name=u'orderEvents'):
+        self.client = client
+        self.collection = client.collection(collection_name)
+
+    def append_many(self, events):
+        for i in range(0, len(events), BATCH_SIZE):
+            batch = self.client.batch()
+            for event in events[i:i + BATCH_SIZE]:
+                batch.set(self.collection.document(), event)
+            batch.commit()
+
+    def find_pages(self, start, end, page_size=500):
+        query = self.collection.where(u'at', u'>=', start).where(u'at', u'<', end).order_by(u'at').limit(page_size)
+        last = None
+        while True:
+            snapshots = list((query if last is None else query.start_after(last)).stream())
+            if not snapshots:
+                return
+            yield [snapshot.to_dict() for snapshot in snapshots]
+            if len(snapshots) < page_size:
+                return
+            last = snapshots[-1]
+
+
+@firestore.transactional
+def _add_in_transaction(transaction, doc_ref, amount, low, high):
+    snapshot = doc_ref.get(transaction=transaction)
+    value = (snapshot.get(u'value') if snapshot.exists else 0) + amount
+    if value < low or (high is not None and value > high):
+        return False
+    transaction.set(doc_ref, {u'value': value})
+    return True
+
+
+@firestore.transactional
+def _reschedule_in_transaction(transaction, doc_ref, users, delivery_date):
+    # Reading inside the transaction makes a double-tapped button retry against the first
+    # tap's write instead of using up two reschedules.
+    snapshot = doc_ref.get(transaction=transaction)
+    # Orders not yet migrated (migrations/num_reschedules_to_int.py) store the counter as a string, which
+    # Increment would overwrite with -1; the value written is computed from the one read instead
+    num_reschedules = int(snapshot.get("numReschedules"))
+    if num_reschedules <= 0:
+        return None
+    transaction.update(doc_ref, {
+        "deliveryDate": delivery_date,
+        "numReschedules": num_reschedules - 1
+    })
+    _write_summary(transaction, users, snapshot.to_dict().get("owner"), doc_ref.id,
+                   {"deliveryDate": delivery_date, "numReschedules": num_reschedules - 1})
+    return num_reschedules - 1
@@ -0,0 +1,45 @@
+import threading
+
+
+class LazyRepositories:
+    """
+    Creates the order and user repositories on first use instead of up front, so that connecting to the
+    backend (importing the Google Cloud libraries and authenticating, for Firestore) happens off the
+    start-up path.
+    """
+
+    def __init__(self, factory):
+        """
+        :param factory: Called with no arguments, returns a tuple (OrderRepository, UserRepository).
+        """
+        self._factory = factory
+        self._repositories = None
+        self._lock = threading.Lock()
+        self.orders = _LazyRepository(self, 0)
+        self.users = _LazyRepository(self, 1)
+
+    def get(self):
+        """ The real repositories, created on the first call."""
+        if self._repositories is None:
+            with self._lock:
+                if self._repositories is None:
+                    self._repositories = self._factory()
+        return self._repositories
+
+    def is_ready(self):
+        return self._repositories is not None
+
+
+class _LazyRepository:
+
+    def __init__(self, repositories, index):
+        self._lazy_repositories = repositories
+        self._index = index
+
+    def __getattr__(self, name):
+        return getattr(self._lazy_repositories.get()[self._index], name)
+
+
+def lazy_repository(factory):
+    """ Stand-in for the one repository returned by factory, created on first use."""
+    return LazyRepositories(lambda: (factory(), None)).orders
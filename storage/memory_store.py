@@ -0,0 +1,129 @@
+import bisect
+import copy
+import threading
+
+from storage.base import CounterRepository, EventRepository, OrderRepository, UserRepository, order_summary
+
+
+class MemoryOrderRepository(OrderRepository):
+    """ Orders held in a dict, for local development, load tests and benchmarks."""
+
+    def __init__(self, users=None):
+        """
+        :param MemoryUserRepository users: Where the owners' order summaries are kept up to date.
+        """
+        self._users = users
+        self._orders = {}
+        self._lock = threading.RLock()
+
+    def get(self, order_id):
+        with self._lock:
+            order_dict = self._orders.get(order_id)
+            return dict(order_dict) if order_dict is not None else None
+
+    def put(self, order_id, order_dict):
+        with self._lock:
+            self._orders[order_id] = dict(order_dict)
+            self._summarise(order_id, order_dict)
+
+    def update(self, order_id, fields):
+        with self._lock:
+            if order_id not in self._orders:
+                raise KeyError("No order {}".format(order_id))
+            self._orders[order_id].update(fields)
+            self._summarise(order_id, fields)
+
+    def reschedule(self, order_id, delivery_date):
+        with self._lock:
+            order_dict = self._orders[order_id]
+            num_reschedules = int(order_dict["numReschedules"])
+            if num_reschedules <= 0:
+                return None
+            order_dict.update({"deliveryDate": delivery_date, "numReschedules": num_reschedules - 1})
+            self._summarise(order_id, order_dict)
+        return num_reschedules - 1
+
+    def find_by_delivery_date(self, start, end):
+        with self._lock:
+            found = [(order_id, dict(order_dict)) for order_id, order_dict in self._orders.items()
+                     if start <= order_dict["deliveryDate"] < end]
+        found.sort(key=lambda item: item[1]["deliveryDate"])
+        return iter(found)
+
+    def find_by_owner(self, owner):
+        with self._lock:
+            return iter([(order_id, dict(order_dict)) for order_id, order_dict in self._orders.items()
+                         if order_dict.get("owner") == owner])
+
+    def _summarise(self, order_id, fields):
+        summary = order_summary(fields)
+        owner = self._orders[order_id].get("owner")
+        if self._users is not None and summary and owner is not None:
+            self._users.update_order_summaries(owner, {order_id: summary})
+
+
+class MemoryUserRepository(UserRepository):
+
+    def __init__(self):
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def get(self, username):
+        with self._lock:
+            user_dict = self._users.get(username)
+            return copy.deepcopy(user_dict) if user_dict is not None else None
+
+    def put(self, username, user_dict):
+        with self._lock:
+            self._users[username] = copy.deepcopy(user_dict)
+
+    def update(self, username, fields):
+        with self._lock:
+            self._users.setdefault(username, {}).update(copy.deepcopy(fields))
+
+    def update_order_summaries(self, username, summaries):
+        with self._lock:
+            user_dict = self._users.setdefault(username, {})
+            for order_id, summary in summaries.items():
+                user_dict.setdefault("orderSummaries", {}).setdefault(order_id, {}).update(summary)
+
+
+class MemoryCounterRepository(CounterRepository):
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        with self._lock:
+            return {key: self._values.get(key, 0) for key in keys}
+
+    def add(self, name, shard, amount, low=0, high=None):
+        with self._lock:
+            value = self._values.get((name, shard), 0) + amount
+            if value < low or (high is not None and value > high):
+                return False
+            self._values[(name, shard)] = value
+            return True
+
+    def put(self, name, shard, value):
+        with self._lock:
+            self._values[(name, shard)] = value
+
+
+class MemoryEventRepository(EventRepository):
+
+    def __init__(self):
+        self._events = []  # (at, sequence, event), in order
+        self._lock = threading.Lock()
+
+    def append_many(self, events):
+        with self._lock:
+            for event in events:
+                bisect.insort(self._events, (event["at"], len(self._events), dict(event)))
+
+    def find_pages(self, start, end, page_size=500):
+        with self._lock:
+            found = [dict(event) for at, _, event in self._events if start <= at < end]
+        for i in range(0, len(found), page_size):
+            yield found[i:i + page_size]
@@ -0,0 +1,274 @@
+import datetime
+import json
+import sqlite3
+import threading
+
+from storage.base import CounterRepository, EventRepository, OrderRepository, UserRepository, order_summary
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    id TEXT PRIMARY KEY,
+    owner TEXT,
+    delivery_date TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS orders_delivery_date_id ON orders (delivery_date, id);
+CREATE INDEX IF NOT EXISTS orders_owner ON orders (owner);
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT NOT NULL,
+    shard INTEGER NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (name, shard)
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    at TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_at ON events (at, id);
+"""
+
+
+def _encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return {"$date": value.isoformat()}
+    raise TypeError("Cannot store {!r}".format(value))
+
+
+def _decode_object(obj):
+    if len(obj) == 1 and "$date" in obj:
+        return datetime.datetime.fromisoformat(obj["$date"])
+    return obj
+
+
+def _dumps(document):
+    return json.dumps(document, default=_encode_value)
+
+
+def _loads(data):
+    return json.loads(data, object_hook=_decode_object)
+
+
+def _date_key(date):
+    # Sortable text for the delivery_date index; aware datetimes are compared in UTC
+    if date is None:
+        return None
+    if date.tzinfo is not None:
+        date = date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return date.isoformat()
+
+
+def _merge_order_summaries(connection, username, summaries):
+    row = connection.execute("SELECT data FROM users WHERE username = ?", (username,)).fetchone()
+    user_dict = _loads(row[0]) if row is not None else {}
+    for order_id, summary in summaries.items():
+        user_dict.setdefault("orderSummaries", {}).setdefault(order_id, {}).update(summary)
+    connection.execute("INSERT OR REPLACE INTO users (username, data) VALUES (?, ?)", (username, _dumps(user_dict)))
+
+
+def connect(path):
+    """ Open the database at path (":memory:" for a throwaway one) and create the tables."""
+    # Worker processes may share the file; WAL lets them read while one writes
+    connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+    if path != ":memory:":
+        connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+class SQLiteOrderRepository(OrderRepository):
+    """ Orders stored as JSON in SQLite, indexed on delivery date and owner."""
+
+    def __init__(self, connection, lock=None):
+        self._conn = connection
+        self._lock = lock or threading.RLock()
+
+    def get(self, order_id):
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM orders WHERE id = ?", (order_id,)).fetchone()
+        return _loads(row[0]) if row is not None else None
+
+    def get_many(self, order_ids):
+        orders = {order_id: None for order_id in order_ids}
+        if orders:
+            placeholders = ",".join("?" * len(orders))
+            with self._lock:
+                rows = self._conn.execute("SELECT id, data FROM orders WHERE id IN ({})".format(placeholders),
+                                          list(orders)).fetchall()
+            for order_id, data in rows:
+                orders[order_id] = _loads(data)
+        return orders
+
+    def put(self, order_id, order_dict):
+        with self._lock, self._conn:
+            self._write(order_id, order_dict)
+
+    def update(self, order_id, fields):
+        with self._lock, self._conn:
+            self._merge(order_id, fields)
+
+    def update_many(self, changes):
+        with self._lock, self._conn:
+            for order_id, fields in changes:
+                self._merge(order_id, fields)
+
+    def reschedule(self, order_id, delivery_date):
+        with self._lock, self._conn:
+            order_dict = self._read(order_id)
+            num_reschedules = int(order_dict["numReschedules"])
+            if num_reschedules <= 0:
+                return None
+            order_dict.update({"deliveryDate": delivery_date, "numReschedules": num_reschedules - 1})
+            self._write(order_id, order_dict)
+        return num_reschedules - 1
+
+    def find_by_delivery_date(self, start, end):
+        with self._lock:
+            rows = self._conn.execute("SELECT id, data FROM orders WHERE delivery_date >= ? AND delivery_date < ? "
+                                      "ORDER BY delivery_date", (_date_key(start), _date_key(end))).fetchall()
+        for order_id, data in rows:
+            yield order_id, _loads(data)
+
+    def find_pages_by_delivery_date(self, start, end, page_size=500):
+        after = (_date_key(start), "")
+        while True:
+            # Keyset pagination on the (delivery_date, id) index order, so no page rescans the previous ones
+            with self._lock:
+                rows = self._conn.execute("SELECT id, delivery_date, data FROM orders "
+                                          "WHERE (delivery_date, id) > (?, ?) AND delivery_date < ? "
+                                          "ORDER BY delivery_date, id LIMIT ?",
+                                          after + (_date_key(end), page_size)).fetchall()
+            if not rows:
+                return
+            yield [(order_id, _loads(data)) for order_id, _, data in rows]
+            if len(rows) < page_size:
+                return
+            after = (rows[-1][1], rows[-1][0])
+
+    def find_by_owner(self, owner):
+        with self._lock:
+            rows = self._conn.execute("SELECT id, data FROM orders WHERE owner = ?", (owner,)).fetchall()
+        for order_id, data in rows:
+            yield order_id, _loads(data)
+
+    def _read(self, order_id):
+        row = self._conn.execute("SELECT data FROM orders WHERE id = ?", (order_id,)).fetchone()
+        if row is None:
+            raise KeyError("No order {}".format(order_id))
+        return _loads(row[0])
+
+    def _merge(self, order_id, fields):
+        order_dict = self._read(order_id)
+        order_dict.update(fields)
+        self._write(order_id, order_dict, fields)
+
+    def _write(self, order_id, order_dict, fields=None):
+        """ Write the order and, in the same transaction, its summary in the owner's user row."""
+        self._conn.execute("INSERT OR REPLACE INTO orders (id, owner, delivery_date, data) VALUES (?, ?, ?, ?)",
+                           (order_id, order_dict.get("owner"), _date_key(order_dict.get("deliveryDate")),
+                            _dumps(order_dict)))
+        summary = order_summary(order_dict if fields is None else fields)
+        if summary and order_dict.get("owner") is not None:
+            _merge_order_summaries(self._conn, order_dict["owner"], {order_id: summary})
+
+
+class SQLiteUserRepository(UserRepository):
+
+    def __init__(self, connection, lock=None):
+        self._conn = connection
+        self._lock = lock or threading.RLock()
+
+    def get(self, username):
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM users WHERE username = ?", (username,)).fetchone()
+        return _loads(row[0]) if row is not None else None
+
+    def get_many(self, usernames):
+        users = {username: None for username in usernames}
+        if users:
+            placeholders = ",".join("?" * len(users))
+            with self._lock:
+                rows = self._conn.execute("SELECT username, data FROM users WHERE username IN ({})".format(
+                    placeholders), list(users)).fetchall()
+            for username, data in rows:
+                users[username] = _loads(data)
+        return users
+
+    def put(self, username, user_dict):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO users (username, data) VALUES (?, ?)",
+                               (username, _dumps(user_dict)))
+
+    def update(self, username, fields):
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT data FROM users WHERE username = ?", (username,)).fetchone()
+            user_dict = _loads(row[0]) if row is not None else {}
+            user_dict.update(fields)
+            self._conn.execute("INSERT OR REPLACE INTO users (username, data) VALUES (?, ?)",
+                               (username, _dumps(user_dict)))
+
+    def update_order_summaries(self, username, summaries):
+        with self._lock, self._conn:
+            _merge_order_summaries(self._conn, username, summaries)
+
+
+class SQLiteCounterRepository(CounterRepository):
+
+    def __init__(self, connection, lock=None):
+        self._conn = connection
+        self._lock = lock or threading.RLock()
+
+    def get_many(self, keys):
+        values = {key: 0 for key in keys}
+        names = sorted({name for name, _ in values})
+        if names:
+            placeholders = ",".join("?" * len(names))
+            with self._lock:
+                rows = self._conn.execute("SELECT name, shard, value FROM counters WHERE name IN ({})".format(
+                    placeholders), names).fetchall()
+            for name, shard, value in rows:
+                if (name, shard) in values:
+                    values[(name, shard)] = value
+        return values
+
+    def add(self, name, shard, amount, low=0, high=None):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR IGNORE INTO counters (name, shard, value) VALUES (?, ?, 0)", (name, shard))
+            cursor = self._conn.execute("UPDATE counters SET value = value + ? WHERE name = ? AND shard = ? "
+                                        "AND value + ? >= ? AND (? IS NULL OR value + ? <= ?)",
+                                        (amount, name, shard, amount, low, high, amount, high))
+        return cursor.rowcount == 1
+
+    def put(self, name, shard, value):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO counters (name, shard, value) VALUES (?, ?, ?)",
+                               (name, shard, value))
+
+
+class SQLiteEventRepository(EventRepository):
+
+    def __init__(self, connection, lock=None):
+        self._conn = connection
+        self._lock = lock or threading.RLock()
+
+    def append_many(self, events):
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT INTO events (at, data) VALUES (?, ?)",
+                                   [(_date_key(event["at"]), _dumps(event)) for event in events])
+
+    def find_pages(self, start, end, page_size=500):
+        after = (_date_key(start), 0)
+        while True:
+            with self._lock:
+                rows = self._conn.execute("SELECT id, at, data FROM events WHERE (at, id) > (?, ?) AND at < ? "
+                                          "ORDER BY at, id LIMIT ?", after + (_date_key(end), page_size)).fetchall()
+            if not rows:
+                return
+            yield [_loads(data) for _, _, data in rows]
+            if len(rows) < page_size:
+                return
+            after = (rows[-1][1], rows[-1][0])
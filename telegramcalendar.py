@@ -1,95 +1,124 @@
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
 import datetime
 import calendar
+import functools
+
+import callbackcodec
+import profiler
 
 
 # reschedule type is initial or delivery
 def create_callback_data(order_id, action, year, month, day):
     """ Create the callback data associated to each button"""
-    return "reschedule-order-id-" + order_id + ";" + ";".join([action, str(year), str(month), str(day)])
+    return callbackcodec.encode(action, order_id, datetime.date(year, month, day or 1))
+
 
+# Buttons that do nothing when pressed don't depend on the order, so they are built once and shared
+DATA_IGNORE = callbackcodec.encode(callbackcodec.CALENDAR_IGNORE)
+BLANK_BUTTON = InlineKeyboardButton(" ", callback_data=DATA_IGNORE)
+WEEK_DAYS_ROW = [InlineKeyboardButton(day, callback_data=DATA_IGNORE) for day in ["Mo", "Tu", "We", "Th", "Fr", "Sa", "Su"]]
 
-def create_calendar(order_id, year=None, month=None):
+
+@functools.lru_cache(maxsize=128)
+def get_month_layout(year, month):
+    """
+    Order-independent parts of the calendar for a month, cached per (year, month).
+    :return: Returns a tuple (title row, weeks), where weeks holds the day numbers of each week and 0 for padding.
+    """
+    title_row = [InlineKeyboardButton(calendar.month_name[month] + " " + str(year), callback_data=DATA_IGNORE)]
+    return title_row, tuple(tuple(week) for week in calendar.monthcalendar(year, month))
+
+
+@functools.lru_cache(maxsize=31)
+def get_greyed_day_button(day):
+    # Struck-through day number for days the order cannot be rescheduled to
+    return InlineKeyboardButton("".join(c + "\u0336" for c in str(day)), callback_data=DATA_IGNORE)
+
+
+@profiler.in_phase(profiler.KEYBOARD)
+def create_calendar(order_id, year=None, month=None, min_date=None, max_date=None):
     """
     Create an inline keyboard with the provided year and month
     :param int year: Year to use in the calendar, if None the current year is used.
     :param int month: Month to use in the calendar, if None the current month is used.
+    :param datetime.datetime min_date: Earliest selectable date, days before it are greyed out.
+    :param datetime.datetime max_date: Latest selectable date, days after it are greyed out.
     :return: Returns the InlineKeyboardMarkup object with the calendar.
     """
     now = datetime.datetime.now()
     if year == None: year = now.year
     if month == None: month = now.month
-    data_ignore = create_callback_data(order_id, "IGNORE", year, month, 0)
-    keyboard = []
-    # First row - Month and Year
-    row = []
-    row.append(InlineKeyboardButton(calendar.month_name[month] + " " + str(year), callback_data=data_ignore))
-    keyboard.append(row)
-    # Second row - Week Days
-    row = []
-    for day in ["Mo", "Tu", "We", "Th", "Fr", "Sa", "Su"]:
-        row.append(InlineKeyboardButton(day, callback_data=data_ignore))
-    keyboard.append(row)
+    title_row, weeks = get_month_layout(year, month)
+    # First row - Month and Year, second row - Week Days
+    keyboard = [title_row, WEEK_DAYS_ROW]
 
-    my_calendar = calendar.monthcalendar(year, month)
-    for week in my_calendar:
+    for week in weeks:
         row = []
         for day in week:
             if (day == 0):
-                row.append(InlineKeyboardButton(" ", callback_data=data_ignore))
+                row.append(BLANK_BUTTON)
+            elif ((min_date is not None and datetime.datetime(year, month, day) < min_date) or
+                  (max_date is not None and datetime.datetime(year, month, day) > max_date)):
+                row.append(get_greyed_day_button(day))
             else:
                 row.append(InlineKeyboardButton(str(day),
-                                                callback_data=create_callback_data(order_id, "DAY", year, month, day)))
+                                                callback_data=create_callback_data(order_id, callbackcodec.CALENDAR_DAY, year, month, day)))
         keyboard.append(row)
     # Last row - Buttons
     row = []
-    row.append(InlineKeyboardButton("<", callback_data=create_callback_data(order_id, "PREV-MONTH", year, month, day)))
-    row.append(InlineKeyboardButton(" ", callback_data=data_ignore))
-    row.append(InlineKeyboardButton(">", callback_data=create_callback_data(order_id, "NEXT-MONTH", year, month, day)))
+    row.append(InlineKeyboardButton("<", callback_data=create_callback_data(order_id, callbackcodec.CALENDAR_PREV_MONTH, year, month, 1)))
+    row.append(BLANK_BUTTON)
+    row.append(InlineKeyboardButton(">", callback_data=create_callback_data(order_id, callbackcodec.CALENDAR_NEXT_MONTH, year, month, 1)))
     keyboard.append(row)
 
     return InlineKeyboardMarkup(keyboard)
 
 
+@profiler.in_phase(profiler.PARSE)
 def separate_callback_data(data):
     """ Separate the callback data"""
-    return data.split(";")
+    return callbackcodec.decode(data)
 
 
-def process_calendar_selection(update, context):
+def process_calendar_selection(update, context, min_date=None, max_date=None):
     """
     Process the callback_query. This method generates a new calendar if forward or
     backward is pressed. This method should be called inside a CallbackQueryHandler.
     :param telegram.Bot bot: The bot, as provided by the CallbackQueryHandler
     :param telegram.Update update: The update, as provided by the CallbackQueryHandler
+    :param context: The context, with the update's replybuffer.ReplyBuffer as context.replies
+    :param datetime.datetime min_date: Earliest selectable date for the redrawn calendar.
+    :param datetime.datetime max_date: Latest selectable date for the redrawn calendar.
     :return: Returns a tuple (Boolean,datetime.datetime), indicating if a date is selected
                 and returning the date if so.
     """
     ret_data = (False, None)
     query = update.callback_query
-    (_, action, year, month, day) = separate_callback_data(query.data)
+    callback = separate_callback_data(query.data)
+    action, order_id, date = callback.action, callback.order_id, callback.date
+    if action == callbackcodec.CALENDAR_IGNORE:
+        # query_handler has already answered the callback query
+        return ret_data
+    year, month, day = date.year, date.month, date.day
     curr = datetime.datetime(int(year), int(month), 1)
-    order_id = query.data.split(";")[0][20:]
-    if action == "IGNORE":
-        context.bot.answer_callback_query(callback_query_id=query.id)
-    elif action == "DAY":
-        context.bot.edit_message_text(text=query.message.text,
-                                      chat_id=query.message.chat_id,
-                                      message_id=query.message.message_id
-                                      )
+    if action == callbackcodec.CALENDAR_DAY:
+        # Queued on the update's reply buffer so the handler's answer is merged into this edit
+        context.replies.edit(query.message, query.message.text + " " + date.strftime("%d/%m/%Y"))
         ret_data = True, datetime.datetime(int(year), int(month), int(day))
-    elif action == "PREV-MONTH":
+    elif action == callbackcodec.CALENDAR_PREV_MONTH:
         pre = curr - datetime.timedelta(days=1)
         context.bot.edit_message_text(text=query.message.text,
                                       chat_id=query.message.chat_id,
                                       message_id=query.message.message_id,
-                                      reply_markup=create_calendar(order_id, int(pre.year), int(pre.month)))
-    elif action == "NEXT-MONTH":
+                                      reply_markup=create_calendar(order_id, int(pre.year), int(pre.month),
+                                                                   min_date, max_date))
+    elif action == callbackcodec.CALENDAR_NEXT_MONTH:
         ne = curr + datetime.timedelta(days=31)
         context.bot.edit_message_text(text=query.message.text,
                                       chat_id=query.message.chat_id,
                                       message_id=query.message.message_id,
-                                      reply_markup=create_calendar(order_id, int(ne.year), int(ne.month)))
+                                      reply_markup=create_calendar(order_id, int(ne.year), int(ne.month),
+                                                                   min_date, max_date))
     else:
         context.bot.answer_callback_query(callback_query_id=query.id, text="Something went wrong!")
         # UNKNOWN
@@ -0,0 +1,79 @@
+import datetime
+from collections import namedtuple
+
+# min_days/max_days: reschedule window in days after pick-up
+# timeslot: whether the customer picks a delivery time slot
+# price: price of the tier in SGD, also its rank in the upgrade lattice
+TierPolicy = namedtuple("TierPolicy", ["name", "label", "min_days", "max_days", "timeslot", "price", "description"])
+
+# Ordered from lowest to highest tier
+TIER_POLICIES = (
+    TierPolicy("standard", "Standard Tier", 3, 7, False, 3, "Receive your package within 7 days of pickup."),
+    TierPolicy("express", "Express Tier", 1, 7, False, 5, "Receive your package within 1 day of pickup!"),
+    TierPolicy("timeslot", "TimeSlot Tier", 1, 7, True, 7,
+               "Choose the time slot which you want to receive your parcel (within 7 days)!"),
+    TierPolicy("14day-standard", "14 Day Standard Tier", 3, 14, False, 9,
+               "Not at home in the coming week? Delay your delivery up to 14 days!"),
+    TierPolicy("14day-timeslot", "14 Day Timeslot Tier", 1, 14, True, 11,
+               "Not at home in the coming week? Delay your delivery up to 14 days and choose a timeslot!"),
+)
+
+# (start hour, label) of the delivery time slots offered to timeslot tiers
+TIME_SLOTS = ((9, "9am-12pm"), (12, "12pm-3pm"), (15, "3pm-6pm"), (18, "6pm-10pm"))
+
+TIER_NAMES = tuple(policy.name for policy in TIER_POLICIES)
+TIERS = {policy.name: policy for policy in TIER_POLICIES}
+
+# Everything below is derived once from the table above
+_MIN_DELTAS = {policy.name: datetime.timedelta(days=policy.min_days) for policy in TIER_POLICIES}
+_MAX_DELTAS = {policy.name: datetime.timedelta(days=policy.max_days) for policy in TIER_POLICIES}
+
+# current tier -> {higher tier: price difference}
+UPGRADE_PRICES = {
+    current.name: {new.name: new.price - current.price for new in TIER_POLICIES if new.price > current.price}
+    for current in TIER_POLICIES
+}
+
+
+def today():
+    return datetime.datetime.now().replace(hour=0, minute=0)
+
+
+def reschedule_window(delivery_type, pick_up_date, now=None):
+    """
+    Earliest and latest dates an order can be rescheduled to.
+    :param str delivery_type: The order's deliveryType.
+    :param datetime.datetime pick_up_date: The order's pickUpDate, without tzinfo.
+    :param datetime.datetime now: Start of today, if None the current date is used.
+    :return: Returns a tuple (min_date, max_date).
+    """
+    now = today() if now is None else now
+    return max(now, pick_up_date + _MIN_DELTAS[delivery_type]), pick_up_date + _MAX_DELTAS[delivery_type]
+
+
+def upgrade_price(current_type, new_type):
+    """ Price in SGD of upgrading from current_type to new_type, or None if new_type is not an upgrade."""
+    return UPGRADE_PRICES[current_type].get(new_type)
+
+
+def is_higher_tier(current_type, new_type):
+    return TIERS[current_type].price > TIERS[new_type].price
+
+
+def batch_windows_and_prices(delivery_types, pick_up_dates, now=None):
+    """
+    Reschedule windows and upgrade offers for many orders at once, column by column.
+    :param list delivery_types: deliveryType of each order.
+    :param list pick_up_dates: pickUpDate of each order, without tzinfo.
+    :param datetime.datetime now: Start of today, if None the current date is used.
+    :return: Returns three lists aligned with the inputs: earliest dates, latest dates and
+                {tier: price} upgrade offers. Orders of an unknown tier, or without a pick-up date, get None
+                for their dates, and None for their offers if the tier is unknown.
+    """
+    now = today() if now is None else now
+    min_dates = [None if date is None or delta is None else max(now, date + delta)
+                 for date, delta in zip(pick_up_dates, map(_MIN_DELTAS.get, delivery_types))]
+    max_dates = [None if date is None or delta is None else date + delta
+                 for date, delta in zip(pick_up_dates, map(_MAX_DELTAS.get, delivery_types))]
+    upgrade_offers = list(map(UPGRADE_PRICES.get, delivery_types))
+    return min_dates, max_dates, upgrade_offers
@@ -0,0 +1,141 @@
+"""
+Inline answers to webhook calls, turned on with WEBHOOK_INLINE_REPLY=1.
+
+Telegram accepts one Bot API method call in the body of the webhook response. In this mode the webhook
+request is held until the update's handler makes its first Bot API call; if that call is answerCallbackQuery,
+sendMessage or editMessageText it is written into the response instead of being sent to api.telegram.org,
+saving a round trip. Any later call, and any first call of another method, goes out as usual.
+
+The handler gets True back for an inlined call instead of the sent Message, and Telegram does not report
+errors for it, so only updates handled on the dispatcher thread are answered inline (run_async handlers,
+which may need the Message, never are).
+"""
+import datetime
+import json
+import os
+import threading
+
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+import tornado.util
+from telegram import Update
+from telegram.ext import TypeHandler
+from telegram.utils.webhookhandler import WebhookHandler
+
+import metrics
+
+ENABLED = os.getenv("WEBHOOK_INLINE_REPLY", "0") == "1"
+# How long the webhook response waits for the handler's first call
+TIMEOUT = float(os.getenv("WEBHOOK_INLINE_TIMEOUT", "2"))
+
+INLINE_METHODS = frozenset(["answerCallbackQuery", "sendMessage", "editMessageText"])
+
+INLINE_REPLIES = metrics.REGISTRY.counter("ninja_webhook_inline_replies_total",
+                                          "Bot API calls answered in the webhook response", ["method"])
+
+# update_id -> InlineReply of webhook requests waiting for their update to be handled
+_pending = {}
+_current = threading.local()
+
+
+class InlineReply:
+    """ The webhook response of one update, filled in from the dispatcher thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._io_loop = tornado.ioloop.IOLoop.current()
+        self.future = tornado.concurrent.Future()
+        self.payload = None
+        self._open = True
+
+    def offer(self, endpoint, data):
+        """
+        Offer a Bot API call for the webhook response. Only the first call made for an update is considered.
+        :return: Returns True if the call will be sent in the response.
+        """
+        with self._lock:
+            if not self._open:
+                return False
+            self._open = False
+            if endpoint in INLINE_METHODS:
+                self.payload = dict(data or {}, method=endpoint)
+        self._io_loop.add_callback(self._resolve)
+        return self.payload is not None
+
+    def close(self):
+        """ Give up on answering inline, the webhook responds with an empty body."""
+        with self._lock:
+            if not self._open:
+                return
+            self._open = False
+        self._io_loop.add_callback(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class InlineWebhookHandler(WebhookHandler):
+
+    async def post(self):
+        self._validate_post()
+        update = Update.de_json(json.loads(self.request.body.decode()), self.bot)
+        self.set_status(200)
+        if not update:
+            return
+        if update.update_id in _pending:
+            # Redelivered while the first delivery is still being handled: that one gets the inline answer,
+            # and writing it into both responses would make Telegram run the call twice
+            return
+        reply = _pending[update.update_id] = InlineReply()
+        self.update_queue.put(update)
+        try:
+            await tornado.gen.with_timeout(datetime.timedelta(seconds=TIMEOUT), reply.future)
+        except tornado.util.TimeoutError:
+            reply.close()
+        finally:
+            _pending.pop(update.update_id, None)
+        if reply.payload is not None:
+            INLINE_REPLIES.inc(method=reply.payload["method"])
+            self.write(json.dumps(reply.payload))
+
+
+def offer(endpoint, data):
+    """ Called by the bot for every Bot API call; True means the call went into the webhook response."""
+    reply = getattr(_current, "reply", None)
+    if reply is None:
+        return False
+    _current.reply = None
+    return reply.offer(endpoint, data)
+
+
+def _begin(update, context):
+    _current.reply = _pending.get(update.update_id)
+
+
+def close_current():
+    """ Give up on answering the update being handled inline, e.g. when it is dropped before its handlers."""
+    reply = getattr(_current, "reply", None)
+    _current.reply = None
+    if reply is not None:
+        reply.close()
+
+
+def _end(update, context):
+    close_current()
+
+
+def add_handlers(dispatcher):
+    """ Track the update being handled on the dispatcher thread, around all of the bot's own handlers."""
+    dispatcher.add_handler(TypeHandler(Update, _begin), group=-100)
+    dispatcher.add_handler(TypeHandler(Update, _end), group=100)
+
+
+def add_route(updater, url_path):
+    """ Take over the webhook path of the server started by updater.start_webhook, once it has started."""
+    app = updater.httpd.http_server.request_callback
+    if not url_path.startswith("/"):
+        url_path = "/" + url_path
+    # Host rules are matched before the webhook's own catch-all rule
+    app.add_handlers(r".*", [(url_path + "/?", InlineWebhookHandler, app.shared_objects)])
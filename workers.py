@@ -0,0 +1,114 @@
+"""
+Multi-process mode, turned on with WORKERS > 1.
+
+The process serving the webhook does no handling itself: a WorkerPool takes the place of the Updater's update
+queue and passes every update to one of WORKERS forked worker processes, each running its own Dispatcher.
+Updates are sharded by chat, so one chat's updates are handled in order by a single worker while different
+chats are handled in parallel on different cores. State shared between the workers goes through
+sharedstate.
+
+Workers are forked before the Updater starts any threads, and open their own storage and Telegram
+connections. Every WORKER_METRICS_INTERVAL seconds (default 5) each worker sends a snapshot of its metrics to
+the webhook process, which adds them to its own on /metrics.
+"""
+import multiprocessing
+import os
+import threading
+
+from telegram import Update
+
+import metrics
+
+METRICS_INTERVAL = float(os.getenv("WORKER_METRICS_INTERVAL", "5"))
+
+
+def shard_key(update):
+    """ The chat an update belongs to; private chats share their id with the user."""
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return update.update_id
+
+
+class WorkerPool:
+
+    def __init__(self, num_workers, setup, teardown=None, metrics_interval=METRICS_INTERVAL):
+        """
+        :param int num_workers: Number of worker processes.
+        :param setup: Called in each worker, returns the telegram.ext.Dispatcher that handles its updates.
+        :param teardown: If given, called in each worker once it has stopped handling updates.
+        :param float metrics_interval: Seconds between the metrics snapshots sent by each worker.
+        """
+        context = multiprocessing.get_context("fork")
+        self.queues = [context.Queue() for _ in range(num_workers)]
+        self.processed = [context.Value("Q", 0) for _ in range(num_workers)]
+        # (worker index, metrics snapshot) sent by the workers, and the latest snapshot of each
+        self._metrics_queue = context.Queue()
+        self._snapshots = {}
+        self.processes = [context.Process(target=_work,
+                                          args=(setup, teardown, updates, processed, i, self._metrics_queue,
+                                                metrics_interval),
+                                          name="worker-{}".format(i), daemon=True)
+                          for i, (updates, processed) in enumerate(zip(self.queues, self.processed))]
+        for process in self.processes:
+            process.start()
+        threading.Thread(target=self._receive_metrics, name="worker-metrics", daemon=True).start()
+
+    def put(self, update, block=True, timeout=None):
+        """ Queue an update on its chat's worker; has the signature of Queue.put so it can replace the
+        Updater's update queue."""
+        self.queues[shard_key(update) % len(self.queues)].put(update.to_dict())
+
+    def depth(self):
+        return sum(updates.qsize() for updates in self.queues)
+
+    def total_processed(self):
+        return sum(processed.value for processed in self.processed)
+
+    def metric_snapshots(self):
+        """ The latest metrics snapshot of each worker, for metrics.REGISTRY.add_snapshots."""
+        return list(self._snapshots.values())
+
+    def _receive_metrics(self):
+        while True:
+            index, snapshot = self._metrics_queue.get()
+            self._snapshots[index] = snapshot
+
+    def stop(self, timeout=10):
+        for updates in self.queues:
+            updates.put(None)
+        for process in self.processes:
+            process.join(timeout)
+
+
+def _send_metrics(index, metrics_queue, interval, stopped):
+    while not stopped.wait(interval):
+        metrics_queue.put((index, metrics.REGISTRY.snapshot()))
+
+
+def _work(setup, teardown, updates, processed, index, metrics_queue, metrics_interval):
+    # Values counted by the webhook process before the fork are reported by it
+    metrics.REGISTRY.reset()
+    stopped = threading.Event()
+    threading.Thread(target=_send_metrics, args=(index, metrics_queue, metrics_interval, stopped),
+                     name="send-metrics", daemon=True).start()
+    dispatcher = setup()
+    if dispatcher.job_queue is not None:
+        dispatcher.job_queue.start()
+    try:
+        while True:
+            data = updates.get()
+            if data is None:
+                break
+            dispatcher.process_update(Update.de_json(data, dispatcher.bot))
+            with processed.get_lock():
+                processed.value += 1
+    finally:
+        if dispatcher.job_queue is not None:
+            dispatcher.job_queue.stop()
+        dispatcher.stop()
+        if teardown is not None:
+            teardown()
+        stopped.set()
+        metrics_queue.put((index, metrics.REGISTRY.snapshot()))